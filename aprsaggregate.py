@@ -0,0 +1,57 @@
+# aprsaggregate.py
+# Keep the summary tables behind the statistics views, and the live window, current
+
+import time
+
+class AggregateRefresher:
+    """Run refresh_aggregates() and refresh_live_window() (see migrations/002_aggregates.sql,
+    003_live_window.sql, and 008_pending_ids.sql) at most once per interval.  The collector calls
+    maybe_refresh() after it commits, so the summary and recent tables trail the packet tables by
+    about one interval.  Each refresh takes the packets committed since the last one, by any writer.
+    """
+
+    def __init__(self, conn, interval_s=10, window_s=3600):
+        """
+        conn: psycopg2 database connection (refreshes commit on it)
+        interval_s: least time between refreshes, in seconds (0 to refresh only when asked)
+        window_s: seconds of packets kept for the live-window views
+        """
+        self.conn = conn
+        self.cur = conn.cursor()
+        self.interval = float(interval_s)
+        self.window = float(window_s)
+        self.last = time.monotonic()
+        self.refreshes = 0
+        self.packets = 0 # Packets counted into the summaries
+        self.elapsed = 0.0 # Time spent refreshing
+
+    def due(self):
+        """returns: True if automatic refreshes are on and the interval has passed"""
+        return self.interval > 0 and time.monotonic() - self.last >= self.interval
+
+    def maybe_refresh(self):
+        """Refresh if due (call between transactions)"""
+        if self.due():
+            self.refresh()
+
+    def refresh(self, rebuild=False):
+        """
+        Count packets added since the last refresh into the summary tables, update the live window, and commit
+        rebuild: recount every stored packet instead (e.g. after dropping old partitions, or to recover counts
+            from before migration 008); this waits for, and holds off, other writers until it commits
+        returns: number of packets counted
+        """
+        start = time.monotonic()
+        self.cur.execute("SELECT rebuild_aggregates();" if rebuild else "SELECT refresh_aggregates();")
+        counted = self.cur.fetchone()[0]
+        self.cur.execute("SELECT refresh_live_window(%s);", (self.window,))
+        self.conn.commit()
+        self.last = time.monotonic()
+        self.refreshes += 1
+        self.packets += counted
+        self.elapsed += self.last - start
+        return counted
+
+    def stats(self):
+        """returns: one-line summary of refresh work"""
+        return("aggregates: {} refreshes, {} packets counted in {:.2f} s".format(self.refreshes, self.packets, self.elapsed))
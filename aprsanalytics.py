@@ -0,0 +1,282 @@
+# aprsanalytics.py
+# Vectorized hop-distance and digipeater coverage statistics (NumPy), kept up to date incrementally
+
+import argparse, os, sys, time
+import numpy
+import aprssettle # Which pids are complete
+
+EARTH_RADIUS_KM = 6371.0088 # Mean radius
+
+# Hop endpoints: the route's digipeaters, or for the source station's own hop, the position in its packet
+HOPS_SQL = """SELECT p.pid, c.rxtime, p.hop, p.route_id,
+        coalesce(ST_Y(ds.loc), CASE WHEN r.src=c.src THEN l.latitude END), coalesce(ST_X(ds.loc), CASE WHEN r.src=c.src THEN l.longitude END),
+        ST_Y(dd.loc), ST_X(dd.loc)
+    FROM unnest(%s::bigint[], %s::bigint[]) AS g(after, upto)
+        INNER JOIN paths AS p ON p.pid > g.after AND p.pid <= g.upto
+        INNER JOIN common AS c ON c.pid=p.pid
+        INNER JOIN routes AS r ON r.route_id=p.route_id
+        LEFT JOIN digis AS ds ON ds.call=r.src
+        LEFT JOIN digis AS dd ON dd.call=r.dest
+        LEFT JOIN map_entry AS m ON m.pid=p.pid
+        LEFT JOIN location AS l ON l.lid=m.lid;"""
+
+# Arrays kept per hop, and their types
+HOP_FIELDS = [('pid', numpy.int64), ('rxtime', numpy.float64), ('hop', numpy.int32), ('route_id', numpy.int32),
+        ('src_lat', numpy.float64), ('src_lon', numpy.float64), ('dest_lat', numpy.float64), ('dest_lon', numpy.float64)]
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance, element by element
+    lat1, lon1, lat2, lon2: arrays of coordinates in degrees (NaN where unknown)
+    returns: array of distances in km (NaN where an endpoint is unknown)
+    """
+    (lat1, lon1, lat2, lon2) = (numpy.radians(x) for x in (lat1, lon1, lat2, lon2))
+    a = numpy.sin((lat2 - lat1)/2)**2 + numpy.cos(lat1)*numpy.cos(lat2)*numpy.sin((lon2 - lon1)/2)**2
+    return 2*EARTH_RADIUS_KM*numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+def group_percentiles(keys, values, percentiles):
+    """
+    Percentiles of values within each group, all groups at once (one sort)
+    keys: integer group of each value
+    values: values (NaNs are left out)
+    percentiles: percentiles to compute, 0-100 (interpolated as numpy.percentile does)
+    returns: (groups, counts, table), with table[i, j] percentile j of groups[i]
+    """
+    known = ~numpy.isnan(values)
+    (keys, values) = (keys[known], values[known])
+    order = numpy.lexsort((values, keys))
+    (keys, values) = (keys[order], values[order])
+    (groups, starts, counts) = numpy.unique(keys, return_index=True, return_counts=True)
+    position = starts[:, None] + (counts[:, None] - 1)*(numpy.asarray(percentiles, dtype=numpy.float64)/100.0)[None, :]
+    (low, high) = (numpy.floor(position).astype(numpy.int64), numpy.ceil(position).astype(numpy.int64))
+    fraction = position - low
+    return(groups, counts, values[low]*(1 - fraction) + values[high]*fraction)
+
+class HopTable:
+    """Every stored hop as NumPy arrays (pid, rxtime, hop, route, both endpoints, and distance), for
+    statistics that SQL would work out row by row.  update() loads only the packets added since the
+    highest pid it has seen, and reports are cached until that changes; with a cache file, the arrays
+    are kept between runs, so a repeated report only reads the new packets from the database.
+    Endpoints are where the digipeaters were when their hops were loaded.  As with --export, packets
+    received within the settle time are left for a later update, and pids that were missing (not yet
+    committed by another writer) are looked for again (see aprssettle.py).
+    """
+
+    def __init__(self, path=None):
+        """
+        path: .npz file to keep the arrays in between runs (None to keep them in memory only)
+        """
+        self.path = path
+        self.max_pid = 0
+        self.gaps = [] # Runs of missing pids to look in again, [after, upto, first missed utc_s]
+        self.hops = {name: numpy.zeros(0, dtype) for (name, dtype) in HOP_FIELDS}
+        self.hops['dist_km'] = numpy.zeros(0, numpy.float64)
+        self.calls = numpy.zeros(0, '<U9') # Call of each call code
+        self.route_src = numpy.zeros(0, numpy.int32) # Call code of each route's source, by route_id (-1 for none loaded)
+        self.route_dest = numpy.zeros(0, numpy.int32) # Call code of each route's destination
+        self.results = {} # (report, arguments): result, for the current max_pid
+        self.loaded = 0 # Hops read from the database by this object
+        self.elapsed = 0.0 # Time spent reading them
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def load(self):
+        """Read the arrays saved by save()"""
+        with numpy.load(self.path) as saved:
+            self.max_pid = int(saved['max_pid'])
+            self.gaps = [[int(x[0]), int(x[1]), float(x[2])] for x in saved['gaps'].tolist()] if 'gaps' in saved else []
+            for name in self.hops:
+                self.hops[name] = saved[name]
+            (self.calls, self.route_src, self.route_dest) = (saved['calls'], saved['route_src'], saved['route_dest'])
+        self.results = {}
+
+    def save(self):
+        """Write the arrays to the cache file (all at once, replacing the old one)"""
+        temporary = self.path + '.tmp.npz'
+        numpy.savez(temporary, max_pid=self.max_pid, gaps=numpy.array(self.gaps, numpy.float64).reshape(-1, 3), calls=self.calls, route_src=self.route_src, route_dest=self.route_dest, **self.hops)
+        os.replace(temporary, self.path)
+
+    def update(self, conn, chunk=100000, settle_s=aprssettle.SETTLE_S):
+        """
+        Load the hops of packets added since the last update (and of pids missing before), in one read-only snapshot
+        conn: psycopg2 database connection (only read from)
+        chunk: rows fetched at a time
+        settle_s: seconds since a packet was received before its hops are loaded
+        returns: number of hops added
+        """
+        start = time.monotonic()
+        conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        try:
+            cur = conn.cursor()
+            to_pid = aprssettle.settled_pid(cur, self.max_pid, settle_s)
+            if to_pid == self.max_pid and self.gaps == []:
+                conn.rollback()
+                return 0
+            named = conn.cursor(name='aprsdb_analytics') # Server-side: rows arrive a chunk at a time
+            named.itersize = chunk
+            named.execute(HOPS_SQL, aprssettle.pid_ranges(self.gaps, self.max_pid, to_pid))
+            pieces = []
+            while True:
+                rows = named.fetchmany(chunk)
+                if rows == []:
+                    break
+                pieces.append(numpy.array(rows, dtype=numpy.float64)) # Every column is numeric; NULL becomes NaN
+            named.close()
+            new = numpy.concatenate(pieces) if pieces != [] else numpy.zeros((0, len(HOP_FIELDS)))
+            self._update_routes(cur, numpy.unique(new[:, 3]).astype(numpy.int64))
+            gaps = aprssettle.find_gaps(cur, self.gaps, self.max_pid, to_pid)
+            conn.rollback() # End the snapshot
+        finally:
+            conn.set_session(isolation_level='DEFAULT', readonly=False)
+        for (n, (name, dtype)) in enumerate(HOP_FIELDS):
+            self.hops[name] = numpy.concatenate((self.hops[name], new[:, n].astype(dtype)))
+        self.hops['dist_km'] = numpy.concatenate((self.hops['dist_km'], haversine_km(new[:, 4], new[:, 5], new[:, 6], new[:, 7])))
+        (self.max_pid, self.gaps) = (to_pid, gaps)
+        self.results = {}
+        self.loaded += len(new)
+        self.elapsed += time.monotonic() - start
+        if self.path is not None:
+            self.save()
+        return len(new)
+
+    def _update_routes(self, cur, route_ids):
+        """
+        Add the routes created since the last update to the route tables, and any the new hops use that
+        weren't loaded (committed after a route with a higher id)
+        route_ids: route ids the new hops use
+        """
+        first = len(self.route_src)
+        missing = [int(x) for x in route_ids if x < first and self.route_src[x] == -1]
+        cur.execute("SELECT route_id, src, dest FROM routes WHERE route_id >= %s OR route_id = ANY(%s);", (first, missing))
+        rows = cur.fetchall()
+        if rows == []:
+            return
+        codes = {call: n for (n, call) in enumerate(self.calls.tolist())}
+        for (route_id, src, dest) in rows:
+            for call in (src, dest):
+                codes.setdefault(call, len(codes))
+        self.calls = numpy.array(sorted(codes, key=codes.get), dtype='<U9')
+        size = max([x[0] + 1 for x in rows] + [first])
+        (route_src, route_dest) = (numpy.full(size, -1, numpy.int32), numpy.full(size, -1, numpy.int32))
+        (route_src[:first], route_dest[:first]) = (self.route_src, self.route_dest)
+        for (route_id, src, dest) in rows:
+            (route_src[route_id], route_dest[route_id]) = (codes[src], codes[dest])
+        (self.route_src, self.route_dest) = (route_src, route_dest)
+
+    def cached(self, report, arguments, compute):
+        """
+        report: name of the report
+        arguments: its arguments (hashable)
+        compute: function(*arguments) working it out
+        returns: the report, worked out once per max_pid
+        """
+        key = (report, arguments)
+        if key not in self.results:
+            self.results[key] = compute(*arguments)
+        return self.results[key]
+
+    def _group(self, by):
+        """
+        by: 'digi' (the hop's receiving digipeater) or 'link' (the route)
+        returns: group key of each hop
+        """
+        if by == 'digi':
+            return self.route_dest[self.hops['route_id']].astype(numpy.int64)
+        if by == 'link':
+            return self.hops['route_id'].astype(numpy.int64)
+        raise ValueError("Unknown grouping {} (digi or link)".format(by))
+
+    def call(self, code):
+        """returns: call for a call code, or 'unknown' for -1 (a route that isn't loaded)"""
+        return str(self.calls[code]) if code >= 0 else 'unknown'
+
+    def label(self, by, key):
+        """returns: readable name of a group key, e.g. a digi's call, or SRC>DEST for a link"""
+        if by == 'digi':
+            return self.call(key)
+        return self.call(self.route_src[key]) + '>' + self.call(self.route_dest[key])
+
+    def percentiles(self, by='digi', percentiles=(50, 90, 99)):
+        """
+        Hop distance percentiles for each digipeater (hops it heard) or link
+        by: 'digi' or 'link'
+        percentiles: percentiles to compute, 0-100
+        returns: list of (name, hops with a distance, [distance percentiles in km]), most hops first
+        """
+        def compute(by, percentiles):
+            (groups, counts, table) = group_percentiles(self._group(by), self.hops['dist_km'], percentiles)
+            order = numpy.argsort(-counts, kind='stable')
+            return([(self.label(by, groups[i]), int(counts[i]), table[i].tolist()) for i in order])
+        return self.cached('percentiles', (by, tuple(percentiles)), compute)
+
+    def rings(self, edges=(10, 25, 50, 100, 200)):
+        """
+        Coverage rings: how many hops each digipeater heard from within each distance band
+        edges: band edges in km (the last band is beyond the last edge)
+        returns: list of (digi, [hops per band]), most hops first
+        """
+        def compute(edges):
+            dist = self.hops['dist_km']
+            known = ~numpy.isnan(dist)
+            (groups, index) = numpy.unique(self._group('digi')[known], return_inverse=True)
+            bands = len(edges) + 1
+            table = numpy.bincount(index*bands + numpy.digitize(dist[known], edges), minlength=len(groups)*bands).reshape(len(groups), bands)
+            order = numpy.argsort(-table.sum(axis=1), kind='stable')
+            return([(self.label('digi', groups[i]), table[i].tolist()) for i in order])
+        return self.cached('rings', (tuple(edges),), compute)
+
+    def bucket_counts(self, bucket_s=3600, by=None):
+        """
+        Hops per time bucket, overall or for each digipeater or link
+        bucket_s: bucket length in seconds (buckets start at multiples of it since 1970, UTC)
+        by: None, 'digi', or 'link'
+        returns: list of (bucket start in seconds since 1970, hops) overall, or of (name, bucket start, hops)
+        """
+        def compute(bucket_s, by):
+            rxtime = self.hops['rxtime']
+            known = ~numpy.isnan(rxtime)
+            buckets = numpy.floor(rxtime[known]/bucket_s).astype(numpy.int64)
+            if by is None:
+                (found, counts) = numpy.unique(buckets, return_counts=True)
+                return([(float(b*bucket_s), int(n)) for (b, n) in zip(found, counts)])
+            pairs = numpy.stack((self._group(by)[known], buckets), axis=1)
+            (found, counts) = numpy.unique(pairs, axis=0, return_counts=True)
+            return([(self.label(by, g), float(b*bucket_s), int(n)) for ((g, b), n) in zip(found, counts)])
+        return self.cached('bucket_counts', (bucket_s, by), compute)
+
+    def stats(self):
+        """returns: one-line summary of what is loaded"""
+        return("hops: {} loaded through pid {} ({} read in {:.2f} s)".format(len(self.hops['pid']), self.max_pid, self.loaded, self.elapsed))
+
+if __name__ == "__main__": # Print a report, keeping the hops in a cache file between runs
+    import aprsdb # Config and connection
+    parser = argparse.ArgumentParser(description='Hop distance and digipeater coverage statistics')
+    parser.add_argument('report', choices=['digis', 'links', 'rings', 'buckets'], help='digis/links: distance percentiles; rings: hops per distance band; buckets: hops per time bucket')
+    parser.add_argument('-c', '--config', help='aprsdb config file')
+    parser.add_argument('--cache', metavar='FILE', help='.npz file keeping the loaded hops between runs')
+    parser.add_argument('--percentiles', default='50,90,99', help='Percentiles for digis/links')
+    parser.add_argument('--edges', default='10,25,50,100,200', help='Ring edges in km')
+    parser.add_argument('--bucket-s', type=float, default=3600, help='Bucket length in seconds')
+    parser.add_argument('--by', choices=['digi', 'link'], help='Count buckets per digi or link')
+    parser.add_argument('--top', type=int, default=20, help='Rows to print (0 for all)')
+    parser.add_argument('--settle-s', type=float, default=aprssettle.SETTLE_S, help='Seconds since a packet was received before its hops are loaded')
+    args = parser.parse_args(sys.argv[1:])
+    table = HopTable(args.cache)
+    conn = aprsdb.connect_db(aprsdb.read_config(args.config))
+    print("{} new hops".format(table.update(conn, settle_s=args.settle_s)))
+    conn.close()
+    if args.report in ('digis', 'links'):
+        percentiles = [float(x) for x in args.percentiles.split(',')]
+        rows = [[name, count] + ['{:.1f}'.format(x) for x in values] for (name, count, values) in table.percentiles(args.report[:-1], percentiles)]
+        header = ['digi' if args.report == 'digis' else 'link', 'hops'] + ['p{:g} km'.format(x) for x in percentiles]
+    elif args.report == 'rings':
+        edges = [float(x) for x in args.edges.split(',')]
+        rows = [[name] + counts for (name, counts) in table.rings(edges)]
+        header = ['digi'] + ['<{:g} km'.format(x) for x in edges] + ['>={:g} km'.format(edges[-1])]
+    else:
+        rows = [[time.strftime('%Y-%m-%d %H:%M', time.gmtime(row[-2]))] + list(row[:-2]) + [row[-1]] for row in table.bucket_counts(args.bucket_s, args.by)]
+        header = ['bucket (UTC)'] + ([args.by] if args.by else []) + ['hops']
+    print('\t'.join(header))
+    for row in rows[:args.top or None]:
+        print('\t'.join(str(x) for x in row))
+    print(table.stats())
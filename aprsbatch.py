@@ -0,0 +1,195 @@
+# aprsbatch.py
+# Batched, single-transaction ingest for aprsdb
+
+import time
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+class PacketBatch:
+    """Buffer packet rows and write them to the database in one transaction.
+    Rows are kept per packet (inside a savepoint), so a packet that fails can be
+    rolled back and sent to aprsdb_errs without losing the rest of the batch.
+    Statements that return ids (location, digis, routes) still run as the packet
+    is processed; everything else is sent with multi-row inserts on flush().
+    """
+
+    def __init__(self, conn, size=100, max_ms=1000, caches=None, after_commit=None):
+        """
+        conn: psycopg2 database connection (the batch owns its transactions)
+        size: number of packets to buffer before flushing
+        max_ms: maximum age of the oldest buffered packet, in milliseconds
+        caches: aprscache.LookupCache objects to commit and roll back along with the database
+        after_commit: function to call after each flush commits (e.g. to refresh summary tables)
+        """
+        self.conn = conn
+        self.cur = conn.cursor()
+        self.size = max(int(size), 1)
+        self.max_age = max(float(max_ms), 0)/1000.0
+        self.packets = [] # (raw, rxtime, rxsession, rows) for each buffered packet
+        self.rows = None # Rows of the packet in progress, None between packets
+        self.meta = None # (raw, rxtime, rxsession) of the packet in progress
+        self.pids = [] # Reserved common.pid values
+        self.started = None # When the oldest buffered packet arrived (monotonic clock)
+        self.caches = caches or []
+        self.marks = [] # Cache savepoints for the packet in progress
+        self.after_commit = after_commit
+
+    def in_packet(self):
+        """returns: True while a packet is being processed"""
+        return self.rows is not None
+
+    def idle(self):
+        """returns: True if nothing is buffered or in progress"""
+        return self.rows is None and self.packets == []
+
+    def next_pid(self):
+        """Get a common.pid value, reserving a block from the sequence as needed
+        returns: pid (bigint)"""
+        if self.pids == []:
+            self.cur.execute("SELECT nextval(pg_get_serial_sequence('common', 'pid')) FROM generate_series(1, %s);", (self.size,))
+            self.pids = [x[0] for x in self.cur.fetchall()]
+            self.pids.reverse() # pop() hands them out in ascending order
+        return self.pids.pop()
+
+    def release_pids(self):
+        """Drop the unused reserved pids (skipping those sequence values), so the next packet reserves
+        pids above any committed so far (call between batches, e.g. when pausing several writers)"""
+        self.pids = []
+
+    def begin_packet(self, raw, rxtime, rxsession):
+        """Start buffering a new packet, setting a savepoint to roll back to
+        raw: raw packet text (used for aprsdb_errs if the packet fails)
+        rxtime: receive time, seconds since epoch
+        rxsession: session_id of the receiving session
+        """
+        if self.started is None:
+            self.started = time.monotonic()
+        self.cur.execute("SAVEPOINT aprsdb_packet;")
+        self.marks = [cache.savepoint() for cache in self.caches]
+        self.rows = []
+        self.meta = (raw, rxtime, rxsession)
+
+    def add(self, table, row):
+        """Queue a row for insertion
+        table: table the row goes into
+        row: dictionary of column:value pairs
+        """
+        self.rows.append((table, dict(row)))
+
+    def rollback_packet(self):
+        """Undo everything the packet in progress has done, keeping its savepoint"""
+        self.cur.execute("ROLLBACK TO SAVEPOINT aprsdb_packet;")
+        for (cache, mark) in zip(self.caches, self.marks):
+            cache.rollback(mark)
+        self.rows = []
+
+    def end_packet(self):
+        """Accept the packet in progress into the batch"""
+        self.cur.execute("RELEASE SAVEPOINT aprsdb_packet;")
+        self.packets.append(self.meta + (self.rows,))
+        self.rows = None
+        self.meta = None
+
+    def abort_packet(self):
+        """Drop the packet in progress from the batch"""
+        if self.rows is None:
+            return
+        self.rollback_packet()
+        self.cur.execute("RELEASE SAVEPOINT aprsdb_packet;")
+        self.rows = None
+        self.meta = None
+
+    def add_error(self, raw, rxtime, rxsession, msg):
+        """Queue an aprsdb_errs entry for a packet that could not be stored"""
+        if self.started is None:
+            self.started = time.monotonic()
+        row = {'rxtime':rxtime, 'rxsession':rxsession, 'raw':raw, 'msg':msg}
+        self.packets.append((raw, rxtime, rxsession, [('aprsdb_errs', row)]))
+
+    def reset(self, conn):
+        """Forget everything buffered or reserved (e.g. after the connection was lost), and write on conn from now on
+        conn: psycopg2 database connection
+        """
+        self.conn = conn
+        self.cur = conn.cursor()
+        self.packets = []
+        self.rows = None
+        self.meta = None
+        self.pids = []
+        self.started = None
+        self.marks = []
+
+    def due(self):
+        """returns: True if the batch is full or its oldest packet is too old"""
+        if self.started is None:
+            return False
+        return len(self.packets) >= self.size or self.timeout() == 0
+
+    def timeout(self):
+        """returns: seconds until the batch is due by age, or None if it is empty"""
+        if self.started is None:
+            return None
+        return max(self.started + self.max_age - time.monotonic(), 0)
+
+    def flush(self):
+        """Write all buffered packets and commit the transaction.
+        If a multi-row insert is rejected, the batch is retried one packet at a
+        time, and only the packets that fail are sent to aprsdb_errs.
+        """
+        if self.rows is not None:
+            raise RuntimeError("Cannot flush a batch with a packet in progress")
+        if self.packets != []:
+            self.cur.execute("SAVEPOINT aprsdb_flush;")
+            try:
+                self._insert_all()
+                self.cur.execute("RELEASE SAVEPOINT aprsdb_flush;")
+            except (psycopg2.DataError, psycopg2.IntegrityError):
+                self.cur.execute("ROLLBACK TO SAVEPOINT aprsdb_flush;")
+                insert_each(self.cur, self.packets)
+        self.conn.commit()
+        for cache in self.caches:
+            cache.commit()
+        self.packets = []
+        self.started = None
+        if self.after_commit is not None:
+            self.after_commit()
+
+    def _insert_all(self):
+        """Insert the buffered rows, one multi-row INSERT per table and column set"""
+        groups = {}
+        for packet in self.packets:
+            for (table, row) in packet[3]:
+                groups.setdefault((table, tuple(row.keys())), []).append(tuple(row.values()))
+        # common goes first, since the other tables reference its pids
+        for (table, columns) in sorted(groups, key=lambda k: k[0] != 'common'):
+            myquery = sql.SQL("INSERT INTO {} ({}) VALUES %s;").format(
+                    sql.Identifier(table),
+                    sql.SQL(', ').join(map(sql.Identifier, columns)))
+            execute_values(self.cur, myquery, groups[(table, columns)], page_size=1000)
+
+def insert_each(cur, packets):
+    """
+    Insert buffered rows packet by packet, logging packets that fail to aprsdb_errs
+    cur: psycopg2 database cursor
+    packets: list of (raw, rxtime, rxsession, rows), where rows is a list of (table, row dictionary)
+    """
+    for (raw, rxtime, rxsession, rows) in packets:
+        cur.execute("SAVEPOINT aprsdb_packet;")
+        try:
+            for (table, row) in sorted(rows, key=lambda r: r[0] != 'common'):
+                myquery = sql.SQL("INSERT INTO {} ({}) VALUES ({});").format(
+                        sql.Identifier(table),
+                        sql.SQL(', ').join(map(sql.Identifier, row.keys())),
+                        sql.SQL(', ').join(map(sql.Placeholder, row.keys())))
+                cur.execute(myquery, row)
+            cur.execute("RELEASE SAVEPOINT aprsdb_packet;")
+        except (psycopg2.DataError, psycopg2.IntegrityError) as de:
+            cur.execute("ROLLBACK TO SAVEPOINT aprsdb_packet;")
+            print(de.pgerror) # DEBUG
+            try:
+                cur.execute("INSERT INTO aprsdb_errs (rxtime, rxsession, raw, msg) VALUES (%s, %s, %s, %s);", (rxtime, rxsession, raw, de.pgerror))
+                cur.execute("RELEASE SAVEPOINT aprsdb_packet;")
+            except (psycopg2.DataError, psycopg2.IntegrityError):
+                cur.execute("ROLLBACK TO SAVEPOINT aprsdb_packet;") # Can't even log it; drop it
+                cur.execute("RELEASE SAVEPOINT aprsdb_packet;")
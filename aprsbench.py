@@ -0,0 +1,266 @@
+#! /usr/bin/python
+
+# aprsbench.py
+# Ingest benchmarks for aprsdb, run against a throwaway PostgreSQL database
+
+import argparse, configparser, getpass, json, os, shlex, subprocess, sys, tempfile, time
+import psycopg2 # Database interface
+import psycopg2.extensions
+from psycopg2 import sql
+import aprsgen # Synthetic traffic
+import aprsmigrate # Schema migrations
+
+INSTALL_DIR = os.path.dirname(os.path.abspath(__file__))
+
+class QueryCounter:
+    """Running totals of statements sent and commits made"""
+
+    def __init__(self):
+        self.statements = 0
+        self.commits = 0
+
+counter = QueryCounter()
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """Cursor that counts the statements it sends"""
+
+    def execute(self, query, vars=None):
+        counter.statements += 1
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        counter.statements += 1
+        return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        counter.statements += 1
+        return super().copy_expert(sql, file, size)
+
+class CountingConnection(psycopg2.extensions.connection):
+    """Connection whose cursors count statements, and which counts its commits"""
+
+    def cursor(self, *args, **kwargs):
+        if kwargs.get('cursor_factory') is None:
+            kwargs['cursor_factory'] = CountingCursor
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        counter.commits += 1
+        return super().commit()
+
+def percentile(values, pct):
+    """
+    values: list of numbers
+    pct: percentile (0-100)
+    returns: nearest-rank percentile, or 0 for an empty list
+    """
+    if values == []:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered)*pct/100.0), len(ordered) - 1)]
+
+def connect_args(config, dbname):
+    """returns: psycopg2.connect keyword arguments for the writer account in an aprsdb config"""
+    if config.getboolean('psqlw', 'localuser'):
+        return {'dbname':dbname, 'user':getpass.getuser()}
+    return {'dbname':dbname, 'user':config.get('psqlw', 'dbuser'), 'host':config.get('psqlw', 'dbhost'),
+            'port':config.get('psqlw', 'dbport'), 'password':config.get('psqlw', 'dbpass')}
+
+def create_database(config, dbname, setup_sql):
+    """
+    Create an empty aprsdb database (the writer account needs CREATEDB)
+    config: aprsdb ConfigParser
+    dbname: database to (re)create
+    setup_sql: scripts to run before aprsdb_creation.sql (e.g. enable_postgis.sql)
+    """
+    admin = psycopg2.connect(**connect_args(config, 'postgres'))
+    admin.autocommit = True
+    admin.cursor().execute(sql.SQL("DROP DATABASE IF EXISTS {};").format(sql.Identifier(dbname)))
+    admin.cursor().execute(sql.SQL("CREATE DATABASE {};").format(sql.Identifier(dbname)))
+    admin.close()
+    conn = psycopg2.connect(**connect_args(config, dbname))
+    for filename in setup_sql + [os.path.join(INSTALL_DIR, 'aprsdb_creation.sql')]:
+        with open(filename) as script:
+            conn.cursor().execute(script.read())
+        conn.commit()
+    aprsmigrate.migrate(conn)
+    conn.close()
+
+def drop_database(config, dbname):
+    """Drop the throwaway database"""
+    admin = psycopg2.connect(**connect_args(config, 'postgres'))
+    admin.autocommit = True
+    admin.cursor().execute(sql.SQL("DROP DATABASE IF EXISTS {};").format(sql.Identifier(dbname)))
+    admin.close()
+
+def load_aprsdb(config_file, aprsdb_args):
+    """
+    Create an aprsdb.Ingester with counting connections, and connect it
+    config_file: aprsdb config for the throwaway database
+    aprsdb_args: extra aprsdb command-line arguments (e.g. ['-b', '100'])
+    returns: the aprsdb.Ingester, ready to process packets
+    """
+    import aprsdb
+    global counter
+    args = aprsdb.make_parser().parse_args(['-c', config_file] + aprsdb_args)
+    ingester = aprsdb.Ingester(aprsdb.read_config(config_file), args.batch_size, args.batch_ms, args.server_insert, args.metrics, args.clock_offset)
+    connect = psycopg2.connect
+    def counting_connect(*args, **kwargs):
+        if kwargs.get('connection_factory') is None: # aprsdb --metrics brings its own counting connection
+            kwargs['connection_factory'] = CountingConnection
+        return connect(*args, **kwargs)
+    psycopg2.connect = counting_connect
+    try:
+        ingester.connect()
+    finally:
+        psycopg2.connect = connect
+    if ingester.metrics is not None:
+        counter = ingester.metrics
+    return ingester
+
+def bench_process_packet(ingester, lines):
+    """
+    Time process_packet on each line
+    ingester: the loaded aprsdb.Ingester
+    lines: list of (format, Direwolf line) from aprsgen
+    returns: (results dictionary, list of (path, pid, src, rxtime) for bench_process_path)
+    """
+    latency = {} # format: [seconds]
+    queries = {} # format: statements sent
+    codes = {} # process_packet return code (negative) or 'ok': count
+    stored = []
+    q_start = counter.statements
+    c_start = counter.commits
+    start = time.perf_counter()
+    for (kind, line) in lines:
+        (channel, rxtime, packet) = ingester.process_direwolf(ingester.direwolf_escape(line))
+        q = counter.statements
+        t = time.perf_counter()
+        result = ingester.process_packet(packet, rxtime)
+        latency.setdefault(kind, []).append(time.perf_counter() - t)
+        queries[kind] = queries.get(kind, 0) + counter.statements - q
+        code = 'ok' if result is not None and result > 0 else str(result)
+        codes[code] = codes.get(code, 0) + 1
+        if code == 'ok':
+            (header, info) = packet.split(':', 1)
+            (src, route) = header.split('>', 1)
+            stored.append((route.split(',')[1:], result, src, rxtime))
+    ingester.flush()
+    elapsed = time.perf_counter() - start
+    results = {'packets':len(lines), 'seconds':elapsed, 'packets_per_s':len(lines)/elapsed,
+            'queries_per_packet':(counter.statements - q_start)/len(lines), 'commits_per_packet':(counter.commits - c_start)/len(lines),
+            'return_codes':codes, 'formats':{}}
+    for kind in sorted(latency):
+        results['formats'][kind] = {'count':len(latency[kind]), 'p50_ms':percentile(latency[kind], 50)*1000,
+                'p99_ms':percentile(latency[kind], 99)*1000, 'queries_per_packet':queries[kind]/len(latency[kind])}
+    return results, stored
+
+def bench_process_path(ingester, stored):
+    """
+    Time process_path (and its commit) on the paths of stored packets, adding duplicate hops
+    ingester: the loaded aprsdb.Ingester (not batching)
+    stored: list of (path, pid, src, rxtime) from bench_process_packet
+    returns: results dictionary
+    """
+    latency = []
+    q_start = counter.statements
+    for (path, pid, src, rxtime) in stored:
+        t = time.perf_counter()
+        ingester.process_path(list(path), pid, src, rxtime)
+        ingester.commit()
+        latency.append(time.perf_counter() - t)
+    elapsed = sum(latency)
+    return {'calls':len(stored), 'seconds':elapsed, 'calls_per_s':len(stored)/elapsed if elapsed > 0 else 0,
+            'queries_per_call':(counter.statements - q_start)/max(len(stored), 1),
+            'p50_ms':percentile(latency, 50)*1000, 'p99_ms':percentile(latency, 99)*1000}
+
+def bench_main(config_file, aprsdb_args, lines):
+    """
+    Time the aprsdb.py main loop reading the lines from stdin, less its start-up time
+    config_file: aprsdb config for the throwaway database
+    aprsdb_args: extra aprsdb command-line arguments
+    lines: list of (format, Direwolf line) from aprsgen
+    returns: results dictionary
+    """
+    command = [sys.executable, os.path.join(INSTALL_DIR, 'aprsdb.py'), '-c', config_file] + aprsdb_args
+    def run(text):
+        start = time.perf_counter()
+        subprocess.run(command, input=text, text=True, stdout=subprocess.DEVNULL, check=True)
+        return time.perf_counter() - start
+    startup = run('')
+    total = run(''.join(line + '\n' for (kind, line) in lines))
+    elapsed = max(total - startup, 1e-9)
+    return {'packets':len(lines), 'seconds':elapsed, 'startup_s':startup, 'packets_per_s':len(lines)/elapsed}
+
+def report(results):
+    """Print the benchmark results as a table"""
+    pp = results['process_packet']
+    print("process_packet: {} packets in {:.2f} s ({:.0f} packets/s), {:.2f} queries/packet, {:.2f} commits/packet".format(
+        pp['packets'], pp['seconds'], pp['packets_per_s'], pp['queries_per_packet'], pp['commits_per_packet']))
+    print("  {:<14} {:>7} {:>9} {:>9} {:>9}".format('format', 'count', 'p50 ms', 'p99 ms', 'queries'))
+    for (kind, f) in pp['formats'].items():
+        print("  {:<14} {:>7} {:>9.3f} {:>9.3f} {:>9.2f}".format(kind, f['count'], f['p50_ms'], f['p99_ms'], f['queries_per_packet']))
+    print("  return codes: " + ', '.join("{}: {}".format(k, v) for (k, v) in sorted(pp['return_codes'].items())))
+    if 'parse_cache' in results:
+        print("  " + results['parse_cache'])
+    if 'process_path' in results:
+        pa = results['process_path']
+        print("process_path: {} calls ({:.0f} calls/s), {:.2f} queries/call, p50 {:.3f} ms, p99 {:.3f} ms".format(
+            pa['calls'], pa['calls_per_s'], pa['queries_per_call'], pa['p50_ms'], pa['p99_ms']))
+    if 'main' in results:
+        ml = results['main']
+        print("main loop: {} packets in {:.2f} s ({:.0f} packets/s, after {:.2f} s start-up)".format(
+            ml['packets'], ml['seconds'], ml['packets_per_s'], ml['startup_s']))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark aprsdb ingest against a throwaway database')
+    parser.add_argument('-c', '--config', required=True, help='APRSDB config file (its [psqlw] account needs CREATEDB)')
+    parser.add_argument('-n', '--count', type=int, default=2000, help='Packets per benchmark')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for the synthetic traffic')
+    parser.add_argument('--stations', type=int, default=200, help='Number of distinct stations')
+    parser.add_argument('--digis', type=int, default=20, help='Number of digipeaters')
+    parser.add_argument('--path-depth', type=int, default=3, help='Most digipeaters in a path')
+    parser.add_argument('--mix', type=aprsgen.parse_mix, help='Format weights, e.g. uncompressed=30,mic_e=20')
+    parser.add_argument('--dup-rate', type=float, default=0.1, help='Fraction of packets heard twice')
+    parser.add_argument('--dbname', default='aprsdb_bench', help='Throwaway database to create (and drop)')
+    parser.add_argument('--setup-sql', nargs='*', default=[os.path.join(INSTALL_DIR, 'enable_postgis.sql')], help='Scripts to run before aprsdb_creation.sql')
+    parser.add_argument('--aprsdb-args', default='', help='Extra aprsdb.py arguments, e.g. "-b 100"')
+    parser.add_argument('--skip-main', action='store_true', help="Don't benchmark the aprsdb.py main loop")
+    parser.add_argument('--keep', action='store_true', help="Don't drop the database afterwards")
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args(argv)
+
+    config = configparser.ConfigParser()
+    config.read_file(open(args.config))
+    aprsdb_args = shlex.split(args.aprsdb_args)
+    generate = lambda seed: list(aprsgen.Generator(seed, args.stations, args.digis, args.path_depth, args.mix, args.dup_rate).packets(args.count))
+
+    create_database(config, args.dbname, args.setup_sql)
+    (fd, config_file) = tempfile.mkstemp(suffix='.conf')
+    try:
+        config.set('psql', 'dbname', args.dbname)
+        with os.fdopen(fd, 'w') as bench_config:
+            config.write(bench_config)
+        results = {'settings':{k:v for (k, v) in vars(args).items() if k not in ('config', 'json')}}
+        ingester = load_aprsdb(config_file, aprsdb_args)
+        (results['process_packet'], stored) = bench_process_packet(ingester, generate(args.seed))
+        if ingester.batch is None:
+            results['process_path'] = bench_process_path(ingester, stored)
+        if ingester.parse_cache is not None:
+            results['parse_cache'] = ingester.parse_cache.stats()
+        if ingester.metrics is not None:
+            print(ingester.metrics.report())
+        ingester.close()
+        if not args.skip_main:
+            results['main'] = bench_main(config_file, aprsdb_args, generate(args.seed + 1))
+    finally:
+        os.remove(config_file)
+        if not args.keep:
+            drop_database(config, args.dbname)
+    report(results)
+    if args.json is not None:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
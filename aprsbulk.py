@@ -0,0 +1,399 @@
+# aprsbulk.py
+# COPY-based bulk loading of historical APRS captures for aprsdb
+
+import io, time
+import aprslib # APRS parsing
+import psycopg2 # Database interface
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+import aprsbatch # Packet-at-a-time fallback for rejected chunks
+import aprsgeom # Client-side geometry encoding
+import aprsparse # Field normalization
+
+# Tables written by the bulk loader, for index handling
+LOADED_TABLES = ['common', 'aprsdb_errs', 'location', 'map_entry', 'uncompressed', 'compressed', 'object', 'mic_e', 'message', 'status', 'wx', 'thirdparty', 'telemetry_message', 'digis', 'routes', 'paths']
+CALL_LENGTH = 9 # digis.call, routes.src, and routes.dest are VARCHAR(9)
+BULK_LOCK = 0x61707273 # Advisory lock held by a bulk load while its indexes are dropped ('aprs')
+
+def pg_array(items):
+    """
+    Format a list the way PostgreSQL prints a text array (e.g. common.path)
+    items: list of strings (or of lists, for a multidimensional array)
+    returns: string, e.g. {WIDE1-1,WIDE2-1}
+    """
+    elements = []
+    for item in items:
+        if item is None:
+            elements.append('NULL')
+            continue
+        if type(item) is list: # Multidimensional, e.g. telemetry EQNS
+            elements.append(pg_array(item))
+            continue
+        item = str(item)
+        if item == '' or item.upper() == 'NULL' or any(c in item for c in '{}",\\ \t\n\r\v\f'):
+            item = '"' + item.replace('\\', '\\\\').replace('"', '\\"') + '"'
+        elements.append(item)
+    return('{' + ','.join(elements) + '}')
+
+def copy_text(value):
+    """
+    Format a value for a PostgreSQL COPY text-format row
+    value: Python value (None, bool, number, string, or list)
+    returns: escaped string
+    """
+    if value is None:
+        return('\\N')
+    if value is True:
+        return('t')
+    if value is False:
+        return('f')
+    if type(value) is list:
+        value = pg_array(value)
+    return(str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r'))
+
+class BulkLoader:
+    """Load parsed packets with COPY, doing the work of process_parsed client-side.
+    Lookups for digis, routes, and locations are held in memory, and pid, lid,
+    route_id, and digi_id values come from blocks reserved from their sequences.
+    Packets are written in chunks, one transaction per chunk.
+    """
+
+    def __init__(self, conn, schema, rxcall, chunk_size=10000):
+        """
+        conn: psycopg2 database connection
+        schema: dictionary of table:[column names] (e.g. my_schema)
+        rxcall: callsign of the receiving station, the last hop of every path
+        chunk_size: number of packets per COPY transaction
+        """
+        self.conn = conn
+        self.cur = conn.cursor()
+        self.schema = schema
+        self.rxcall = rxcall
+        self.chunk_size = max(int(chunk_size), 1)
+        self.packets = [] # (raw, rxtime, rxsession, rows) for each packet, as in aprsbatch
+        self.new_dims = [] # (table, row) for locations and routes first seen in this chunk
+        self.new_digis = set() # Calls of digis first seen in this chunk
+        self.changed_digis = set() # Calls of known digis that moved or changed symbol
+        self.ids = {} # (table, column): reserved ids
+        self.locked = False # Holding BULK_LOCK (indexes dropped)
+
+        # Load the lookup tables
+        self.cur.execute("SELECT call, digi_id, aprs_sym, aprs_table, ST_X(loc), ST_Y(loc) FROM digis;")
+        self.digis = {x[0]: list(x[1:]) for x in self.cur.fetchall()} # call: [digi_id, sym, table, lon, lat]
+        self.cur.execute("SELECT src, dest, route_id FROM routes;")
+        self.routes = {(x[0], x[1]): x[2] for x in self.cur.fetchall()}
+        self.cur.execute("SELECT latitude, longitude, lid FROM location ORDER BY lid DESC;")
+        self.locations = {(x[0], x[1]): x[2] for x in self.cur.fetchall()} # Lowest lid wins
+        self.conn.commit()
+
+    def next_id(self, table, column):
+        """Get the next value for a serial column, reserving a block from its sequence as needed
+        returns: id (integer)"""
+        if self.ids.get((table, column), []) == []:
+            self.cur.execute("SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s);", (table, column, self.chunk_size))
+            self.ids[(table, column)] = [x[0] for x in self.cur.fetchall()]
+            self.ids[(table, column)].reverse() # pop() hands them out in ascending order
+        return self.ids[(table, column)].pop()
+
+    def add(self, raw, parsed, rxtime, rxsession, rx_loc_id):
+        """
+        Queue an aprslib parsed packet, flushing when the chunk is full
+        raw: raw packet text (used for aprsdb_errs if the packet fails)
+        parsed: parsed aprs packet dictionary from aprslib
+        rxtime: time packet was received, as seconds since epoch
+        rxsession: session_id of the loading session
+        rx_loc_id: location id of the receiving station
+        returns: packet_id if queued, -7 if the packet was sent to aprsdb_errs
+        """
+        rows = []
+        parsed.update({'rxtime':rxtime, 'rxsession':rxsession, 'is_subpacket':False})
+        try:
+            mypacketid = self._process(parsed, rows, rxtime, rx_loc_id)
+        except (KeyError, ValueError) as e:
+            self.add_error(raw, rxtime, rxsession, str(e))
+            return -7
+        self.packets.append((raw, rxtime, rxsession, rows))
+        if len(self.packets) >= self.chunk_size:
+            self.flush()
+        return mypacketid
+
+    def add_error(self, raw, rxtime, rxsession, msg):
+        """Queue an aprsdb_errs entry for a packet that could not be stored"""
+        row = {'rxtime':rxtime, 'rxsession':rxsession, 'raw':raw, 'msg':msg}
+        self.packets.append((raw, rxtime, rxsession, [('aprsdb_errs', row)]))
+
+    def _columns(self, table, parsed):
+        """returns: dictionary of the fields in parsed that belong in table, dictionaries stringified"""
+        in_schema = {x: parsed[x] for x in self.schema[table] if x in parsed}
+        for x in in_schema:
+            if type(in_schema[x]) is dict:
+                in_schema[x] = str(in_schema[x])
+        return in_schema
+
+    def _check_call(self, call):
+        """Raise ValueError for a callsign too long for the digis and routes tables"""
+        if len(call) > CALL_LENGTH:
+            raise ValueError("Callsign too long: " + call)
+
+    def _process(self, parsed, rows, rxtime, rx_loc_id, is_subpacket=False):
+        """
+        Build the rows for a parsed packet, as process_parsed would insert them
+        parsed: parsed aprs packet dictionary from aprslib
+        rows: list of (table, row) for the packet, appended to
+        returns: packet_id
+        """
+        parsed['is_subpacket']=is_subpacket
+        parsed['rxtime']=rxtime
+        parsed['rx_loc_id']=rx_loc_id
+        parsed = aprsparse.normalize_parsed(parsed)
+
+        mypacketid = self.next_id('common', 'pid')
+        parsed['pid'] = mypacketid
+        rows.append(('common', {x: parsed[x] for x in self.schema['common'] if x in parsed}))
+
+        # Check for digis
+        if 'symbol' in parsed.keys():
+            if parsed['symbol'] in ['#','&']:
+                self._process_digi(parsed)
+            if parsed['src'] in self.digis and parsed['format'] not in ('object','item'):
+                self._process_digi(parsed)
+
+        # Handle third-party packets
+        if parsed['format']=='thirdparty':
+            self._known_digi(parsed['src'])
+            parsed['subpacket_type'] = parsed['subpacket']['format']
+            parsed['subpacket_id'] = self._process(parsed['subpacket'], rows, rxtime, rx_loc_id, True)
+
+        # Handle weather packets
+        if 'weather' in parsed.keys():
+            parsed['has_wx']=True
+            for key in parsed['weather'].keys():
+                parsed[key]=parsed['weather'][key]
+            if parsed['format']!='wx': # Objects/positions with weather
+                rows.append(('wx', self._columns('wx', parsed)))
+
+        # Handle location entries
+        if 'latitude' in parsed.keys() and 'longitude' in parsed.keys():
+            parsed['linestring'] = aprsgeom.point_ewkb(parsed['longitude'], parsed['latitude'])
+            mylid = self.locations.get((parsed['latitude'], parsed['longitude']))
+            if mylid is None: # New location
+                mylid = self.next_id('location', 'lid')
+                parsed['lid'] = mylid
+                self.locations[(parsed['latitude'], parsed['longitude'])] = mylid
+                self.new_dims.append(('location', self._columns('location', parsed)))
+            parsed['lid'] = mylid
+            rows.append(('map_entry', self._columns('map_entry', parsed)))
+
+        # Format-specific data
+        if parsed['format'] in self.schema:
+            rows.append((parsed['format'], self._columns(parsed['format'], parsed)))
+
+        # Path, only for RF paths
+        if is_subpacket==False:
+            self._process_path(parsed['path'], mypacketid, parsed['src'], rows, rxtime)
+
+        return mypacketid
+
+    def _known_digi(self, call):
+        """Add a call to digis if it isn't there yet"""
+        self._check_call(call)
+        if call not in self.digis:
+            self.digis[call] = [self.next_id('digis', 'digi_id'), None, None, None, None]
+            self.new_digis.add(call)
+
+    def _process_digi(self, parsed):
+        """Add or update a digi from its own position packet (see process_digi)"""
+        for key in ['longitude','latitude','src','symbol','symbol_table']:
+            if (key not in parsed.keys()):
+                raise KeyError("Missing key: " + key)
+        self._check_call(parsed['src'])
+        state = [parsed['symbol'], parsed['symbol_table'], float(parsed['longitude']), float(parsed['latitude'])]
+        digi = self.digis.get(parsed['src'])
+        if digi is None: # New digi
+            self.digis[parsed['src']] = [self.next_id('digis', 'digi_id')] + state
+            self.new_digis.add(parsed['src'])
+        elif digi[1] == '#' and parsed['symbol'] != '#': # Ignore non-unique gates
+            return
+        elif digi[1:] != state: # Moved or changed symbol [table]
+            digi[1:] = state
+            if parsed['src'] not in self.new_digis:
+                self.changed_digis.add(parsed['src'])
+
+    def _process_path(self, path, packet_id, src, rows, rxtime=None):
+        """Build the paths rows (and any new routes and digis) for a packet (see process_path)"""
+        path = aprslib.util.remove_WIDEn_N(path) # Get rid of WIDEn-N and asterisks
+        if 'NULL' in path:
+            path.remove('NULL') # remove first NULL value
+        for call in path:
+            self._check_call(call)
+
+        digi_src = False
+        if src in self.digis: # Source is a known digi
+            path.insert(0, src)
+            digi_src = True
+
+        if (path == None or path == []): # No route info
+            return
+
+        for call in path: # Check for new digis!
+            self._known_digi(call)
+
+        path.append(self.rxcall) # All packets end at RX site
+
+        for i in range(len(path)-1): # Split path into single hops
+            hop = i+1
+            if (digi_src): # 0-index for digi-sourced packets
+                hop = i
+            route = (path[i], path[i+1])
+            route_id = self.routes.get(route)
+            if route_id is None: # Route is new
+                route_id = self.next_id('routes', 'route_id')
+                self.routes[route] = route_id
+                self.new_dims.append(('routes', {'route_id':route_id, 'src':route[0], 'dest':route[1]}))
+            row = {'pid':packet_id, 'hop':hop, 'route_id':route_id}
+            if 'rxtime' in self.schema.get('paths', []): # Partitioned tables carry rxtime
+                row['rxtime'] = rxtime
+            rows.append(('paths', row))
+
+    def copy_rows(self, rows):
+        """
+        Stream rows into the database with COPY, one COPY per table and column set
+        rows: list of (table, row dictionary); common rows are sent first
+        """
+        groups = {}
+        for (table, row) in rows:
+            groups.setdefault((table, tuple(row.keys())), []).append(tuple(row.values()))
+        for (table, columns) in sorted(groups, key=lambda k: k[0] != 'common'):
+            buf = io.StringIO()
+            for values in groups[(table, columns)]:
+                buf.write('\t'.join(copy_text(x) for x in values) + '\n')
+            buf.seek(0)
+            myquery = sql.SQL("COPY {} ({}) FROM STDIN;").format(
+                    sql.Identifier(table),
+                    sql.SQL(', ').join(map(sql.Identifier, columns)))
+            self.cur.copy_expert(myquery.as_string(self.cur), buf)
+
+    def _dim_rows(self):
+        """returns: list of (table, row) for the new locations, routes, and digis"""
+        digi_rows = []
+        for call in self.new_digis:
+            [digi_id, sym, table, lon, lat] = self.digis[call]
+            loc = aprsgeom.point_ewkb(lon, lat) if lon is not None else None
+            digi_rows.append(('digis', {'digi_id':digi_id, 'call':call, 'aprs_sym':sym, 'aprs_table':table, 'loc':loc}))
+        return self.new_dims + digi_rows
+
+    def _write_dims(self):
+        """Write the new locations, routes, and digis, and update changed digis"""
+        self.copy_rows(self._dim_rows())
+        self._update_digis()
+
+    def _update_digis(self):
+        """Update the digis that moved or changed symbol"""
+        if self.changed_digis:
+            execute_values(self.cur, "UPDATE digis SET aprs_sym=v.sym, aprs_table=v.tab, loc=v.loc::geometry FROM (VALUES %s) AS v(digi_id, sym, tab, loc) WHERE digis.digi_id=v.digi_id;",
+                    [(digi_id, sym, table, aprsgeom.point_ewkb(lon, lat)) for [digi_id, sym, table, lon, lat] in (self.digis[call] for call in self.changed_digis)])
+
+    def _write_dims_each(self):
+        """
+        Write the new locations, routes, and digis one row at a time (flush()'s fallback)
+        A route or digi that another writer (e.g. a running collector) added since the lookups
+        were loaded is left as it is, and its id is used instead of the reserved one.  A row the
+        database rejects is skipped, and insert_each() sends the packets needing it to aprsdb_errs.
+        """
+        remap = {} # Reserved route_id: route_id already in the database
+        for (table, row) in self._dim_rows():
+            self.cur.execute("SAVEPOINT aprsdb_dim;")
+            try:
+                myquery = sql.SQL("INSERT INTO {} ({}) VALUES ({}) ON CONFLICT DO NOTHING;").format(
+                        sql.Identifier(table),
+                        sql.SQL(', ').join(map(sql.Identifier, row.keys())),
+                        sql.SQL(', ').join(map(sql.Placeholder, row.keys())))
+                self.cur.execute(myquery, row)
+                if self.cur.rowcount == 0 and table == 'routes': # Added since the lookups were loaded
+                    self.cur.execute("SELECT route_id FROM routes WHERE src=%s AND dest=%s;", (row['src'], row['dest']))
+                    remap[row['route_id']] = self.routes[(row['src'], row['dest'])] = self.cur.fetchone()[0]
+                elif self.cur.rowcount == 0 and table == 'digis':
+                    self.cur.execute("SELECT digi_id FROM digis WHERE call=%s;", (row['call'],))
+                    self.digis[row['call']][0] = self.cur.fetchone()[0]
+                self.cur.execute("RELEASE SAVEPOINT aprsdb_dim;")
+            except (psycopg2.DataError, psycopg2.IntegrityError) as de:
+                self.cur.execute("ROLLBACK TO SAVEPOINT aprsdb_dim;")
+                print(de.pgerror) # DEBUG
+                if table == 'location': # Forget the reserved id, so later chunks don't refer to it
+                    self.locations.pop((row.get('latitude'), row.get('longitude')), None)
+                elif table == 'routes':
+                    self.routes.pop((row['src'], row['dest']), None)
+                else:
+                    self.digis.pop(row['call'], None)
+                    self.changed_digis.discard(row['call'])
+        if remap != {}:
+            for packet in self.packets:
+                for (table, row) in packet[3]:
+                    if table == 'paths' and row['route_id'] in remap:
+                        row['route_id'] = remap[row['route_id']]
+        self._update_digis()
+
+    def flush(self):
+        """Write the queued packets in one transaction.
+        If the database rejects the chunk, it is written again one packet at a
+        time, and only the packets that fail are sent to aprsdb_errs.
+        """
+        try:
+            self._write_dims()
+            self.copy_rows([row for packet in self.packets for row in packet[3]])
+            self.conn.commit()
+        except (psycopg2.DataError, psycopg2.IntegrityError) as de:
+            self.conn.rollback()
+            print(de.pgerror) # DEBUG
+            self._write_dims_each()
+            aprsbatch.insert_each(self.cur, self.packets)
+            self.conn.commit()
+        self.packets = []
+        self.new_dims = []
+        self.new_digis = set()
+        self.changed_digis = set()
+
+    def drop_indexes(self):
+        """Drop the non-unique secondary indexes on the loaded tables, to be rebuilt by restore_indexes()
+        The definitions are saved in bulk_dropped_indexes in the same transaction, and an advisory
+        lock is held until they are rebuilt, so a load that dies leaves them for restore_dropped_indexes()."""
+        self.cur.execute("SELECT pg_advisory_lock(%s);", (BULK_LOCK,)) # One load at a time; released with the session if this one dies
+        self.locked = True
+        self.cur.execute("SELECT indexname, indexdef FROM pg_indexes WHERE schemaname=current_schema() AND tablename=ANY(%s) AND indexdef NOT LIKE 'CREATE UNIQUE%%';", (LOADED_TABLES,))
+        for (name, definition) in self.cur.fetchall():
+            print("Dropping index " + name + " until the load is done")
+            self.cur.execute("INSERT INTO bulk_dropped_indexes (name, definition, dropped_utc_s) VALUES (%s, %s, %s) ON CONFLICT (name) DO NOTHING;", (name, definition, time.time()))
+            self.cur.execute(sql.SQL("DROP INDEX {};").format(sql.Identifier(name))) # On a partitioned table, this drops the partitions' indexes too
+        self.conn.commit()
+
+    def restore_indexes(self):
+        """Rebuild the indexes dropped by drop_indexes() (and any left by an earlier load), and refresh planner statistics"""
+        restore_dropped_indexes(self.conn)
+        if self.locked:
+            self.cur.execute("SELECT pg_advisory_unlock(%s);", (BULK_LOCK,))
+            self.locked = False
+        for table in LOADED_TABLES:
+            self.cur.execute(sql.SQL("ANALYZE {};").format(sql.Identifier(table)))
+        self.conn.commit()
+
+def restore_dropped_indexes(conn):
+    """
+    Rebuild the indexes listed in bulk_dropped_indexes, unless a bulk load (another session) is still running
+    conn: psycopg2 database connection
+    returns: names of the indexes rebuilt
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT pg_try_advisory_xact_lock(%s);", (BULK_LOCK,)) # Granted again to the loading session itself
+    if not cur.fetchone()[0]:
+        conn.rollback()
+        return []
+    cur.execute("SELECT name, definition FROM bulk_dropped_indexes ORDER BY dropped_utc_s;")
+    dropped = cur.fetchall()
+    for (name, definition) in dropped:
+        print("Rebuilding index " + name)
+        cur.execute("SELECT to_regclass(%s) IS NULL;", (name,))
+        if cur.fetchone()[0]: # Not rebuilt some other way since
+            cur.execute(definition.replace(' ON ONLY ', ' ON ', 1)) # Partitioned tables' indexes are listed as ON ONLY
+        cur.execute("DELETE FROM bulk_dropped_indexes WHERE name=%s;", (name,))
+    conn.commit()
+    return [x[0] for x in dropped]
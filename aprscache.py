@@ -0,0 +1,84 @@
+# aprscache.py
+# In-process lookup caches for aprsdb
+
+from collections import OrderedDict
+
+MISSING = object() # Marks a key that was absent before a write
+
+class LookupCache:
+    """In-memory lookup table with hit/miss counts and an optional LRU size bound.
+    Writes are journaled until commit(), so entries for rows that were rolled
+    back in the database can be undone with rollback().
+    """
+
+    def __init__(self, name, max_size=None):
+        """
+        name: name used in stats()
+        max_size: maximum number of entries (least recently used are evicted), or None for no limit
+        """
+        self.name = name
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.journal = [] # (key, previous value or MISSING) for uncommitted writes
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        Look up a key, counting the hit or miss
+        returns: cached value, or None if not cached
+        """
+        value = self.entries.get(key, MISSING)
+        if value is MISSING:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.max_size is not None:
+            self.entries.move_to_end(key) # Most recently used
+        return value
+
+    def load(self, items):
+        """Fill the cache from (key, value) pairs already in the database (not journaled)"""
+        for (key, value) in items:
+            self.entries[key] = value
+            self._evict()
+
+    def put(self, key, value):
+        """Add or replace an entry written in the current transaction"""
+        self.journal.append((key, self.entries.get(key, MISSING)))
+        self.entries[key] = value
+        if self.max_size is not None:
+            self.entries.move_to_end(key)
+        self._evict()
+
+    def _evict(self):
+        """Drop least recently used entries beyond max_size"""
+        if self.max_size is not None:
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def savepoint(self):
+        """returns: marker for rollback() to undo later writes only"""
+        return len(self.journal)
+
+    def rollback(self, mark=0):
+        """Undo writes made since mark (default: since the last commit)"""
+        while len(self.journal) > mark:
+            (key, value) = self.journal.pop()
+            if value is MISSING:
+                self.entries.pop(key, None)
+            else:
+                self.entries[key] = value
+
+    def commit(self):
+        """Keep all journaled writes"""
+        self.journal = []
+
+    def stats(self):
+        """returns: one-line summary of size and hit rate"""
+        total = self.hits + self.misses
+        rate = 100.0*self.hits/total if total > 0 else 0.0
+        return("{}: {} entries, {} hits, {} misses ({:.1f}% hit)".format(self.name, len(self.entries), self.hits, self.misses, rate))
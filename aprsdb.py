@@ -6,117 +6,78 @@
 # Functions for moving APRS data from aprslib into a psql database
 
 import psycopg2 # Database interface
+import psycopg2.extras # JSON parameters (server_insert mode)
 import aprslib # APRS parsing
 import sys, os # General system utilities
 import argparse # Parse arguments
-import datetime, time, re, configparser, getpass # Time, regex, config, and password entry
+import datetime, time, re, configparser, getpass, json # Time, regex, config, password entry, and JSON
 import decimal # For truncating floats (e.g. lat/long)
 from psycopg2 import sql
+import threading # Read stdin on its own thread (batched ingest)
+import aprsbatch # Batched, single-transaction ingest
+import aprsparse # Packet parsing and field normalization
+import aprsbulk # COPY-based bulk loading
+import aprscache # In-process lookup caches
+import aprsgeom # Client-side geometry encoding
+import aprsdirewolf # Direwolf line decoding
+from aprsdirewolf import get_direwolf_timestamp, process_direwolf, hex_replace, direwolf_escape
+import aprspipeline # Threaded read/parse/write pipeline
+import aprsparallel # Multi-core parsing for offline replays
+import aprsmigrate # Versioned schema migrations
+import aprspartition # Time partitioning and retention
+import aprsaggregate # Summary tables for the statistics views
+import aprsmetrics # Per-stage latency and round-trip instrumentation
+import aprsstatements # Prepared INSERT statements
+import aprsspool # Durable spool for riding out database outages
+import aprsretime # Applying session offsets to stored receive times
+import aprskiss # KISS TCP collector for several receivers
+import aprslive # In-memory live station table for maps
+import queue # Pipeline queue timeouts
 try:
     import gpsd # Use the GPS library if we have it
     import aprsgps # custom functions that require gpsd
     use_gps = True
 except:
     use_gps = False  # GPS library not found (nor required)
-
-# Parse arguments
-parser = argparse.ArgumentParser()
-parser.add_argument('-c', '--config', help='APRSDB config file')
-args = parser.parse_args(sys.argv[1:])
-# Read the config file
-config = configparser.ConfigParser()
 try:
-    config.read_file(open(vars(args)['config'])) # Try to open the preferred config
-except TypeError:
-    try:
-        config.read_file(open(os.path.expanduser("~") + os.path.sep + 'aprsdb.conf')) # Default to a locally-configured config
-    except FileNotFoundError:
-        try:
-            config.read_file(open(os.path.split(sys.argv[0])[0] + 'aprsdb.conf')) # Fallback to the install directory
-        except FileNotFoundError:
-            config.read_file(open(os.path.join(os.path.split(sys.argv[0])[0], 'generic_aprsdb.conf'))) # Fallback to the generic one
-
-# Set info for receive station
-rxinfo={'call':config.get('aprs', 'rxcall'), 'symbol':config.get('aprs', 'rxsymbol'), 'symbol_table': config.get('aprs', 'rxtable'), 'latitude':config.get('aprs', 'latitude'), 'longitude':config.get('aprs','longitude')}
-
-
-# Set up the timestamp regex
-dwts = re.compile("^\[([0-9]*?) ([0-9]{4})([0-9]{2})([0-9]{2})_([0-9]{2})([0-9]{2})([0-9]{2})\]") # Match direwolf timestamp format [0 YYYYMMDD_hhmmss], grouped conveniently
-
-
-# Set up data for database connection
-session_id = 0 # Will attempt to update
-my_schema = {'common':[], 'aprsdb_errs':[], 'location':[], 'map_entry':[], 'mic_e':[], 'thirdparty':[], 'uncompressed':[], 'compressed':[], 'status':[], 'object':[], 'wx':[], 'message':[], 'telemetry_message':[]} # Fields will be drawn from the database itself
-
-conn=None
-try: # Establish database connection
-    if config.getboolean('psqlw', 'localuser')==True: # Use local user authentication
-        conn=psycopg2.connect(dbname=config.get('psql', 'dbname'), user=getpass.getuser())
-    else: # Use authentication from config
-        conn = psycopg2.connect(dbname=config.get('psql', 'dbname'), user=config.get('psqlw', 'dbuser'), host=config.get('psqlw', 'dbhost'), port=config.get('psqlw','dbport'), password=config.get('psqlw', 'dbpass'))
-except:
-    print("Unable to connect to the database")
-    raise
-cur = conn.cursor() # Create a database cursor
-
-try: # Establish session ID and time
-    cur.execute("INSERT INTO sessions (start_time_utc_s, session_offset) VALUES (%s, %s) RETURNING session_id;", (time.time(), 0))
-    session_id = cur.fetchone()[0]
-    conn.commit()
-except:
-    print("Error entering session metadata to database")
-    raise # DB connection is mission-critical, so error out here
+    import aprsexport # Columnar export, which needs pyarrow
+    use_export = True
+except ImportError:
+    use_export = False # Only needed for --export
 
-for packet_format in my_schema: # Get the column names for each packet format
-    cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name=%s;", (packet_format,)) # Query column names for the table
-    my_schema[packet_format] = [x[0] for x in cur.fetchall()] # Update column names
+# Tables whose column names are read from the database (Ingester.my_schema)
+SCHEMA_TABLES = ['common', 'aprsdb_errs', 'location', 'map_entry', 'mic_e', 'thirdparty', 'uncompressed', 'compressed', 'status', 'object', 'wx', 'message', 'telemetry_message', 'paths']
 
-def check_rx_station(conn, parsed):
+def read_config(filename=None):
     """
-    Check if the receiving station is in digis and location, adding if needed.
-    conn: psycopg2 database connection
-    parsed: dictionary with fields call, symbol, symbol_table, latitude, and longitude (e.g. rxinfo)
-    returns: void
+    Read the aprsdb config file
+    filename: preferred config file; if None, ~/aprsdb.conf, then aprsdb.conf or generic_aprsdb.conf in the install directory
+    returns: configparser.ConfigParser
     """
-    cur = conn.cursor()
-    mylid = None
-    [digi_id, mycall, mysym, mytable, oldloc] = [None for _ in range(5)]
+    config = configparser.ConfigParser()
     try:
-        # Look to see if rx "digi" is known
-        cur.execute("SELECT * FROM digis WHERE call=%s;", (parsed['call'],))
-        myresult = cur.fetchone()
-        # Get the info for a known digi
-        if myresult != None:
-            [digi_id, mycall, mysym, mytable, oldloc] = myresult
-    
-        # Compute the linestring for the rx location
-        cur.execute("SELECT ST_SetSRID(ST_MakePoint(CAST(%s AS FLOAT), CAST(%s AS FLOAT)), 4326);", (parsed['longitude'],parsed['latitude']))
-        myloc = cur.fetchone()[0]
-
-        # If the rx digi is new, add it
-        if digi_id == None:
-            cur.execute("INSERT INTO digis (call, aprs_sym, aprs_table, loc) VALUES (%s, %s, %s, %s)", (parsed['call'], parsed['symbol'], parsed['symbol_table'], myloc))
-
-        else: # Digi is known
-            # Check if rx digi has changed info
-            if not (myloc==oldloc and mysym == parsed['symbol'] and mytable == parsed['symbol_table']):
-                # Update rx digi info if needed
-                cur.execute("UPDATE digis SET aprs_sym=%s, aprs_table=%s, loc=%s WHERE digi_id=%s;", (parsed['symbol'], parsed['symbol_table'], myloc, digi_id))
-
-        # Check for an existing entry in the location table
-        cur.execute("SELECT lid FROM location WHERE linestring=%s;", (myloc,))
-        mylid = cur.fetchone()
-        if mylid == None: # If location is new, add it
-            cur.execute("INSERT INTO location (latitude, longitude, linestring) VALUES(%s, %s, %s) RETURNING lid;", (parsed['latitude'], parsed['longitude'], myloc))
-            mylid = cur.fetchone()
-        mylid = mylid[0]
-
-        conn.commit()
-    except:
-        conn.rollback()  # If errors are encountered, abort
-        raise
-    return mylid
+        config.read_file(open(filename)) # Try to open the preferred config
+    except TypeError:
+        try:
+            config.read_file(open(os.path.expanduser("~") + os.path.sep + 'aprsdb.conf')) # Default to a locally-configured config
+        except FileNotFoundError:
+            try:
+                config.read_file(open(os.path.split(sys.argv[0])[0] + 'aprsdb.conf')) # Fallback to the install directory
+            except FileNotFoundError:
+                config.read_file(open(os.path.join(os.path.split(sys.argv[0])[0], 'generic_aprsdb.conf'))) # Fallback to the generic one
+    return config
 
+def connect_db(config, connection_factory=None):
+    """
+    Open a write-enabled database connection as configured
+    config: configparser.ConfigParser with [psql] and [psqlw] sections
+    connection_factory: psycopg2 connection factory (e.g. for metrics), or None
+    returns: psycopg2 database connection
+    """
+    if config.getboolean('psqlw', 'localuser')==True: # Use local user authentication
+        return psycopg2.connect(dbname=config.get('psql', 'dbname'), user=getpass.getuser(), connection_factory=connection_factory)
+    # Use authentication from config
+    return psycopg2.connect(dbname=config.get('psql', 'dbname'), user=config.get('psqlw', 'dbuser'), host=config.get('psqlw', 'dbhost'), port=config.get('psqlw','dbport'), password=config.get('psqlw', 'dbpass'), connection_factory=connection_factory)
 
 def insert_sql_from_dict(table, mydict, codastring=''):
     """
@@ -134,77 +95,6 @@ def insert_sql_from_dict(table, mydict, codastring=''):
 
     return(myquery)
 
-def insert_digi(parsed, cur):
-    """Insert values for a new digipeater.
-    parsed: location packet for digi to be inserted
-    cur: database cursor
-    """
-    # Check that required information is present
-    for key in ['longitude','latitude','src','symbol','symbol_table']:
-        if (key not in parsed.keys()):
-            raise KeyError("Missing key: " + key) # Something went badly wrong
-    # Data checked basic test, insert it.
-    try:
-        cur.execute("INSERT INTO digis (call, aprs_sym, aprs_table, loc) VALUES (%s, %s, %s, ST_SetSRID(ST_MakePoint(CAST(%s AS FLOAT), CAST(%s AS FLOAT)), 4326));", (parsed['src'], parsed['symbol'], parsed['symbol_table'], parsed['longitude'], parsed['latitude']))
-    except:
-        raise
-
-def check_update_digi(parsed, digi_id, cur):
-    """
-    Check if digipeater location has changed, updating if necessary
-    parsed: aprslib parsed packet for digi to be checked/updated
-    digi_id: digi_id from digis table to be checked against, and updated if needed
-    cur: psycopg2 database cursor
-    """
-    # Check for requisite info, error if missing
-    for key in ['longitude','latitude','src','symbol','symbol_table']:
-        if (key not in parsed.keys()):
-            raise KeyError("Missing key: " + key)
-
-    # Get the old symbol for this digi
-    cur.execute("SELECT aprs_sym FROM digis WHERE call=%s;", (parsed['src'],))
-    old_sym = cur.fetchone()[0]
-    
-    if (old_sym == '#' and parsed['symbol'] != old_sym): # Ignore non-unique gates
-        return
-
-    # Get existing digi location, symbol, and symbol table
-    cur.execute("SELECT loc, aprs_sym, aprs_table FROM digis WHERE digi_id=%s;", (digi_id,))
-    [old_loc, old_sym, old_table] = cur.fetchone()
-
-    # Prepare the new linestring with the digi's location
-    if 'linestring' not in parsed.keys():
-        cur.execute("SELECT ST_SetSRID(ST_MakePoint(CAST(%s AS FLOAT), CAST(%s AS FLOAT)), 4326);", (parsed['longitude'], parsed['latitude']))
-        curr_loc = cur.fetchone()[0]
-    else:
-        curr_loc = parsed['linestring']
-
-# Update digi record if it has moved or changed symbol [table]
-    if ((curr_loc != old_loc) or (parsed['symbol'] != old_sym) or (parsed['symbol_table'] != old_table)):
-        cur.execute("UPDATE digis SET loc=%s, aprs_sym=%s, aprs_table=%s WHERE digi_id=%s;", (curr_loc, parsed['symbol'], parsed['symbol_table'], digi_id))
-
-
-
-def process_digi(parsed, cur):
-    """Insert values for a new digipeater from a parsed packet
-    parsed: an aprslib parsed packet
-    cur: psycopg2 database cursor
-    """
-
-    # Check for crucial information
-    if ('symbol' not in parsed.keys()):
-        raise KeyError("Missing key: symbol")
-
-    # Get existing record for digi
-    cur.execute("SELECT digi_id, aprs_sym FROM digis WHERE call=%s;", (parsed['src'],))
-    if (cur.rowcount == 0): # No matching digi
-        insert_digi(parsed, cur)
-    else: #Digis are forced unique by callsign, so can only be one row matching
-        myresult = cur.fetchone()
-        # Check if updates are needed and make them
-        check_update_digi(parsed, myresult[0], cur)
-
-
 def remove_NULL_path(path):
     """
     Remove NULL entries from APRS path
@@ -216,286 +106,11 @@ def remove_NULL_path(path):
         if digi!='NULL':
             digipath.append(digi)
     return(digipath)
-    
-def process_path(path, packet_id, conn):
-    """
-    Insert the path routing info to the database
-    path: Python list of path routing elements (e.g. N0QVC-1, WIDE1*, N0PBA-1,WIDE2-1)
-    packet_id: packet_id from packets table corresponding to the entry being processed
-    conn: psycopg2 database connection
-    """
-    cur = conn.cursor()
-    path = aprslib.util.remove_WIDEn_N(path) # Get rid of WIDEn-N and asterisks
-    if 'NULL' in path:
-        path.remove('NULL') # remove first NULL value
-    
-    digi_src = False
-    cur.execute("SELECT d1.call FROM common AS c1 INNER JOIN digis AS d1 ON d1.call=c1.src WHERE c1.pid=%s;", (packet_id, )) # Check if source is a known digi
-    if cur.rowcount == 1: # 1 digi matched
-        myresult = cur.fetchone()[0]
-        path.insert(0, myresult) # Add first hop to inter-digi list
-        digi_src = True
-
-
-    if (path == None or path == []): # No route info
-        return
-
-    for call in path:  # Check for new digis!
-        cur.execute("SELECT call FROM digis WHERE call=%s;", (call,))
-        myresult = cur.fetchone()
-        if myresult == None: # Found new digi
-            cur.execute("INSERT INTO digis (call) VALUES (%s);", (call,))
-
-    path.append(rxinfo['call']) # All packets end at RX site
-
-    for i in range(len(path)-1): # Split path into single hops
-        src = path[i]
-        dest = path[i+1]
-        hop = i+1
-        if (digi_src): # 0-index for digi-sourced packets
-            hop = i
-        route_id = 0
-
-        # Check if route exists, and get its ID if it does
-        cur.execute("SELECT route_id FROM routes WHERE src=%s AND dest=%s;", (src, dest))
-        myresult = cur.fetchone()
-        if myresult != None: # Route exists
-            route_id = myresult[0]
-        else: # Route is new
-            cur.execute("INSERT INTO routes (src, dest) VALUES (%s, %s) RETURNING route_id;", (src, dest))
-            route_id = cur.fetchone()[0]
-
-        # Add the hop and route to the paths table
-        cur.execute("INSERT INTO paths (pid, hop, route_id) VALUES (%s, %s, %s);", (packet_id, hop, route_id)) 
-
-    conn.commit()
-
-
-def process_packet(packet, conn, rxtime=None, is_subpacket=False): 
-    """
-    Load an unparsed APRS packet into the database
-    packet: APRS packet string
-    conn: psycopg2 database connection
-    rxtime: time packet was received, as seconds since epoch (1/1/1970); if omitted or wrong format, uses system clock
-    is_subpacket: boolean flag for whether this is a sub-packet
-    returns packet_id (positive bigint) if successful, negative integer if not
-    """
-    # Check for reasonable timestamp
-    if (type(rxtime) is not float and type(rxtime) is not int or (rxtime is None)):
-        rxtime=time.time()
-
-    try:  # Parse it
-        parsed = aprslib.parse(packet)
-    except aprslib.exceptions.ParseError as pe:
-        try: # Salvage what data we can from the header of an unparseable packet
-            parsed = pe.parsed
-            parsed['format']="parseerror"
-        except: # Couldn't salvage anything
-            print("Unable to partially parse packet: '" + packet + "' at time "+ str(rxtime)) # DEBUG
-            return(-6) # Unable to partially parse packet
-
-    except aprslib.exceptions.UnknownFormat as uf:
-        # Save what headers we can if the format is unknown
-        parsed = uf.parsed
-        parsed['format']="unknown"
-    except:
-        # Something else went wrong
-        print("Unable to parse packet") # DEBUG
-        try:
-            cur=conn.cursor()
-            cursor.execute("INSERT INTO aprsdb_errs (rxtime, rxsession, raw, message) VALUES (%s, %s, %s, %s);", (rxtime, session_id, packet, "Unable to parse packet"))
-        except:
-            pass
-        return(-5) # Unable to parse packet
-
-    # Add the receiving station metadata to the parsed data
-    parsed.update({'rxtime':rxtime, 'rxsession':session_id, 'is_subpacket':is_subpacket})
-
-    # Send the parsed data on for further processing
-    return(process_parsed(parsed, conn, rxtime, is_subpacket))
-
-def process_parsed(parsed, conn, rxtime=time.time(), is_subpacket=False):
-    """
-    Load a parsed APRS packet into the database
-    parsed: parsed aprs packet dictionary from aprslib
-    conn: psycopg2 database connection
-    rxtime: time packet was received, as seconds since epoch (1/1/1970); if omitted or wrong format, uses system clock
-    is_subpacket: boolean flag for whether this is a sub-packet
-    returns packet_id (positive bigint) if successful, negative integer if not
-    """
-    parsed['is_subpacket']=is_subpacket
-    parsed['rxtime']=rxtime
-    parsed['rx_loc_id'] = rxinfo['rx_loc_id'] # Get current loc_id for rx station
-    if use_gps: #GPS features enabled (i.e. rover)
-        if time.time() - rxinfo['gps_loc_time'] > 30: # seconds since prev. GPS point
-            try:
-                (mylat, mylon) = aprsgps.getLoc2D() # Get truncated coordinates
-                rxinfo['latitude'] = mylat
-                rxinfo['longitude'] = mylon
-                rxinfo['rx_loc_id'] = check_rx_station(conn, rxinfo) # Update rx_station location, getting the location id back (for inserting in the common table)
-                parsed['rx_loc_id'] = rxinfo['rx_loc_id'] # Put it into the parsed packet structure for insertion
-                rxinfo['gps_loc_time'] = time.time() # Update the timestamp for the rx_loc
-            except:
-                print("Unable to get GPS coordinates") # DEBUG
-
-
-    # Work around potential SQL reserved words, characters, and case-sensitivity
-    parsed['dest'] = parsed.pop('to')
-    parsed['src'] = parsed.pop('from')
-    if parsed['format'] == 'mic-e':
-        parsed['format'] = 'mic_e'
-    if parsed['format'] == 'telemetry-message':
-        parsed['format'] = 'telemetry_message'
-    try:
-        parsed['addressee'] = parsed['addresse']
-    except:
-        pass
-
-    # Ensure all field names are lower-case
-    parsed = dict((k.lower(), v) for k,v in parsed.items())
-            
-
-    # Insert data into common table
-    # Start by finding the fields we have that go in common
-    in_common = {x: parsed[x] for x in my_schema['common'] if x in parsed}
-    try:
-        # Put them in, and get the pid back for future reference
-        cur.execute(insert_sql_from_dict('common', in_common, 'RETURNING pid'), in_common)
-        mypacketid = cur.fetchone()[0]
-        parsed['pid']=mypacketid
-        conn.commit()
-    except psycopg2.DataError as de:
-        conn.rollback()
-        print(de.pgerror)
-        parsed['msg']=de.pgerror
-        try:
-            in_errs = {x:parsed[x] for x in my_schema['aprsdb_errs'] if x in parsed}
-            cur.execute(insert_sql_from_dict('aprsdb_errs', in_errs), in_errs)
-            conn.commit()
-            return -7
-        except:
-            conn.rollback()
-            raise
-            return -8
-    except:
-        # Take it all back if something fails
-        conn.rollback()
-        raise
-        return -2 # Unable to insert common table data
-    
-    # Check for digis
-    if 'symbol' in parsed.keys():
-        # Digis and igates are # and &
-        if parsed['symbol'] in ['#','&']:
-            process_digi(parsed, cur)
-        # Watch out for digis not using standard symbols
-        cur.execute("SELECT call FROM digis WHERE call=%s;", (parsed['src'],))
-        if cur.fetchone() != None: # Call is a known digi
-            if parsed['format'] not in ('object','item'): # Don't use digipeater data from objects or items
-                process_digi(parsed, cur)
-
-    # Handle third-party packets
-    if parsed['format']=='thirdparty':
-        # Source is a digi; check that it is known
-        cur.execute("SELECT call FROM digis WHERE call=%s;", (parsed['src'],))
-        myresult = cur.fetchone()
-        if myresult == None: # Found new digi
-            cur.execute("INSERT INTO digis (call) VALUES (%s);", (parsed['src'],))
-
-        # Get the subpacket type
-        parsed['subpacket_type'] = parsed['subpacket']['format']
-        # Process the subpacket, getting its pid for back reference
-        parsed['subpacket_id'] = process_parsed(parsed['subpacket'], conn, rxtime, True)
-        if parsed['subpacket_id'] <0: # Error encountered
-            conn.rollback()
-            return -4 # Unable to handle third-party packet
-
-    # Handle weather packets
-    if 'weather' in parsed.keys():
-        parsed['has_wx']=True
-        for key in parsed['weather'].keys():
-            parsed[key]=parsed['weather'][key]
-        if parsed['format']!='wx': # Watch out for objects/positions with weather
-            # Find wx fields in the packet and their values
-            in_schema = {x: parsed[x] for x in my_schema['wx'] if x in parsed}
-            for x in in_schema:
-                if type(in_schema[x]) is dict:
-                    # Stringify dictionaries
-                    in_schema[x] = str(in_schema[x])
-            # wx format packets will be entered later, but objects need their wx data entered now
-            cur.execute(insert_sql_from_dict('wx', in_schema), in_schema)
-            conn.commit()
-
-    # Handle linestring creation and location entries
-    if 'latitude' in parsed.keys() and 'longitude' in parsed.keys():
-        try:
-            # Get the linestring (text representation of geospatial data)
-            cur.execute("SELECT ST_SetSRID(ST_MakePoint(CAST(%s AS FLOAT), CAST(%s AS FLOAT)), 4326);", (parsed['longitude'], parsed['latitude']))
-            parsed['linestring'] = cur.fetchone()[0]
-
-            # Check if we know this location
-            cur.execute("SELECT lid FROM location WHERE latitude=%s AND longitude=%s;", (parsed['latitude'], parsed['longitude']))
-            myresult = cur.fetchall()
-            if len(myresult)==0: # No results found
-                # Enter location data into a table
-                in_schema = {x: parsed[x] for x in my_schema['location'] if x in parsed}
-                for x in in_schema:
-                    # Stringify dictionaries
-                    if type(in_schema[x]) is dict:
-                        in_schema[x] = str(in_schema[x])
-                cur.execute(insert_sql_from_dict('location', in_schema, 'RETURNING lid'), in_schema)
-                parsed['lid']=cur.fetchall()[0]
-                conn.commit()
-            else: # Location known, we just need its id
-                parsed['lid']=myresult[0]
-
-            # Enter symbol/table, course/speed, and PHG into map_entry table
-            in_schema = {x: parsed[x] for x in my_schema['map_entry'] if x in parsed}
-            for x in in_schema:
-                if type(in_schema[x]) is dict:
-                    in_schema[x] = str(in_schema[x])
-            cur.execute(insert_sql_from_dict('map_entry', in_schema), in_schema)
-
-            conn.commit()
-        except:
-            conn.rollback()
-            raise
-
-
-    # Insert format-specific data into proper table
-    try:
-        in_schema = {x: parsed[x] for x in my_schema[parsed['format']] if x in parsed}
-    except KeyError:
-        # Format missing; salvage path info
-        conn.commit()
-        # Process path, but only if the path is RF
-        if is_subpacket==False:
-            process_path(parsed['path'], mypacketid, conn)
-        return mypacketid
-
-    # Get the main packet data ready for insertion
-    for x in in_schema:
-        if type(in_schema[x]) is dict: # Stringify dictionaries
-            in_schema[x] = str(in_schema[x])
-    try:
-        # Insert the packet's data into the format table
-        cur.execute(insert_sql_from_dict(parsed['format'], in_schema), in_schema)
-        conn.commit()
-    except:
-        conn.rollback()
-        raise
-        #return -3
-
-    # Process path, only for RF paths
-    if is_subpacket==False:
-        process_path(parsed['path'], mypacketid, conn)
-
-    return mypacketid
-
 
 def set_session_offset (session_id, conn, start_year=2018, start_month=1, start_day=1, start_hour=0, start_minute=0, start_second=0, start_usec=0, start_tz=datetime.timezone.utc):
     """
     Set the session_offest field for a session, given a starting date/time.
+    The session's stored receive times are corrected by aprsdb.py --retime.
     conn: psycopg2 database cursor
     start_tz: defaults to UTC
     Returns: True if successful, False if error
@@ -514,53 +129,6 @@ def set_session_offset (session_id, conn, start_year=2018, start_month=1, start_
         return(False)
     return(True)
 
-def get_direwolf_timestamp(packet):
-    """
-    Parse the timestamp from a direwolf packet header
-    packet: the direwolf output line to decode
-    returns: seconds since 1970 (possibly fractional) or None
-    """
-    # This really needs to be redone to pull the format from the config
-    # Use %z flag for UTC offset
-    # Use %s flag for epoch
-    myresult = re.match(dwts, packet)
-    try:
-        (Y, m, d, H, M, S) = (int(x) for x in myresult.group(2,3,4,5,6,7))
-    except:
-        return None
-
-    packet_time = datetime.datetime(Y, m, d, H, M, S).timestamp()-time.localtime().tm_gmtoff
-
-def process_direwolf(line):
-    """Parse direwolf output, returning the packet and epoch timestamp (or None).
-    line: single line of raw Direwolf output
-    returns: (channel=None, epoch=None, packet)
-    """
-    # Build regex for the direwolf header (radio channel and optional timestamp)
-    # Save the packet, too
-    m = re.match("^\[([0-9]*) *([0-9_\-]*)] (.*)", line)
-    try:
-        channel=int(m.group(1)) # Radio channel should be an integer
-    except:
-        try:
-            return(None, None, m.group(3).strip()) # Return what the regex thinks is the packet
-        except:
-            return(None, None, line.strip()) # Return the whole line
-
-    try:
-        epoch=int(m.group(2)) # Look for a timestamp
-    except:
-        try:
-            return(channel, None, m.group(3).strip()) # Channel and packet, no time
-        except:
-        # Should we check for a packet in group 2?
-            return(channel, None, line.strip()) # Something probably went wrong;  return it anyway because maybe it actually works
-
-    try:
-        return(channel, epoch, m.group(3).strip()) # It's all there!  Wonderful!
-    except:
-        return(channel, epoch, line.strip()) # Something is probably wrong, but we'll return what we can and it can fail later
-
 def get_valid_line():
     """Get a valid line from stdin
     returns: boolean: is_valid, string: text"""
@@ -574,37 +142,1309 @@ def get_valid_line():
     return (is_valid, text)
 
 
-def hex_replace(matchobj):
-    """Replacement formula for doing regex of non-printing ASCII characters
-    matchobj: an re.match object, which should be a two-digit hex code
-    returns: the character corresponding to the two-digit hex code, or null string
+class Ingester:
+    """Moves APRS packets into the database for one receive station.
+    It owns the database connection, the session, the receive station info (rxinfo),
+    the column names of the packet tables (my_schema), and the lookup caches.
+    Creating one only reads settings from the config: the database is connected, the
+    session started, and the schema read on first use (or by connect()).  An Ingester
+    can be pickled (e.g. to hand to worker processes); the copy keeps the settings,
+    session, rxinfo, and schema, and opens its own connection when it is used.
     """
-    if int(matchobj.group(1), 16) != 0:
-        return(chr(int(matchobj.group(1), 16)))
-    else:
-        return("")
 
-def direwolf_escape(text):
-    """Escapes direwolf non-printable characters"""
-    # Use the hex_replace function to determine how to substitute the matched text (i.e. non-printing ASCII)
-    return(re.sub(r"<0x([0-9A-Fa-f]{2})>", hex_replace, text))
+    # Attributes that survive pickling; everything else belongs to a connection or thread
+    PICKLED = ('config', 'rxinfo', 'receiver', 'session_id', 'session_offset', 'batch_size', 'batch_ms', 'server_insert', 'use_metrics', 'decoder', 'my_schema', 'autocommit_lookups')
+
+    def __init__(self, config, batch_size=None, batch_ms=None, server_insert=False, use_metrics=False, clock_offset=None, rxinfo=None, receiver=None):
+        """
+        config: configparser.ConfigParser (see generic_aprsdb.conf)
+        batch_size: packets per database transaction (default from [ingest]; 1 writes each packet as it arrives)
+        batch_ms: longest a packet waits in a batch, in milliseconds (default from [ingest])
+        server_insert: store each packet with one call to insert_packet() (or set in [ingest])
+        use_metrics: collect per-stage metrics (or enabled in [metrics])
+        clock_offset: seconds added to receive times (default [aprs] clock_offset_s)
+        rxinfo: receive station, a dictionary with call, symbol, symbol_table, latitude, and longitude (default from [aprs])
+        receiver: name of the receiver, stored with the session (e.g. a [receiver NAME] config section)
+        """
+        self.config = config
+        # Set info for receive station
+        self.rxinfo = rxinfo
+        if rxinfo is None:
+            self.rxinfo={'call':config.get('aprs', 'rxcall'), 'symbol':config.get('aprs', 'rxsymbol'), 'symbol_table': config.get('aprs', 'rxtable'), 'latitude':config.get('aprs', 'latitude'), 'longitude':config.get('aprs','longitude')}
+        self.receiver = receiver
+        self.session_id = None # Started on connect
+        self.session_offset = clock_offset if clock_offset is not None else config.getfloat('aprs', 'clock_offset_s', fallback=0) # Added to this session's receive times as they are stamped
+        # Set up batched ingest, if enabled (arguments override config)
+        self.batch_size = batch_size or config.getint('ingest', 'batch_size', fallback=1)
+        self.batch_ms = batch_ms or config.getint('ingest', 'batch_ms', fallback=1000)
+        # Or send each packet to the database in a single call, for collectors far from the database
+        self.server_insert = server_insert or config.getboolean('ingest', 'server_insert', fallback=False)
+        if self.server_insert and self.batch_size > 1:
+            print("Server-side inserts store packets one call each; batching is off")
+            self.batch_size = 1
+        # Metrics cost nothing unless enabled: without them, the stages and connection are left as they are
+        self.use_metrics = use_metrics or config.getboolean('metrics', 'enabled', fallback=False)
+        # Decode Direwolf lines with the configured timestamp format (kissutil -T), correcting them by the session's offset
+        timestamp_format = config.get('direwolf', 'timestamp_format', raw=True, fallback=aprsdirewolf.DEFAULT_FORMAT)
+        if timestamp_format.strip() in ('', '%Z'): # Placeholder in configs from before the format was read
+            timestamp_format = aprsdirewolf.DEFAULT_FORMAT
+        self.decoder = aprsdirewolf.LineDecoder(timestamp_format, self.session_offset)
+        self.my_schema = None # Column names of each table in SCHEMA_TABLES, read on connect
+        self.autocommit_lookups = False # Add digis and routes on their own connection, committing each at once (see lookup_cursor)
+        self._reset()
+
+    def __getstate__(self):
+        return {k: self.__dict__[k] for k in self.PICKLED}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset()
+
+    def _reset(self):
+        """Set up the parts that aren't pickled: no connection yet, and empty caches"""
+        config = self.config
+        self.conn = None
+        self.cur = None
+        self.lookup_cur = None # Cursor on the autocommit_lookups connection, once connected
+        self.gps = None # Rover mode's aprsgps.PositionProvider, once started
+        self.batch = None
+        self.aggregates = None
+        self.metrics = None
+        self.live = None # aprslive.LiveTable updated with each stored position, if serving one (shared by a process's writers)
+        # Lookup caches; digis and routes are small and cached whole, locations are LRU-bounded
+        self.digi_cache = aprscache.LookupCache('digis') # call: [digi_id, aprs_sym, aprs_table, longitude, latitude]
+        self.route_cache = aprscache.LookupCache('routes') # (src, dest): route_id
+        self.location_cache = aprscache.LookupCache('location', config.getint('ingest', 'location_cache_size', fallback=100000)) # (latitude, longitude): lid
+        self.caches = [self.digi_cache, self.route_cache, self.location_cache]
+        # Prepare each INSERT shape once per session (0 turns this off, e.g. behind a transaction-pooling proxy)
+        self.statements = None
+        if config.getint('ingest', 'statement_cache', fallback=256) > 0:
+            self.statements = aprsstatements.StatementCache(config.getint('ingest', 'statement_cache', fallback=256))
+        # Parse each packet once, however many digipeaters repeat it (0 seconds turns this off)
+        self.parse_cache = None
+        if config.getfloat('ingest', 'parse_cache_s', fallback=30) > 0:
+            self.parse_cache = aprsparse.ParseCache(config.getfloat('ingest', 'parse_cache_s', fallback=30), config.getint('ingest', 'parse_cache_size', fallback=10000))
+        # Line decoding stages (replaced by timed wrappers when metrics are on)
+        self.direwolf_escape = direwolf_escape
+        self.process_direwolf = self.decoder.decode
+
+    def connect(self):
+        """
+        Connect to the database and get ready to store packets (done on first use if not called)
+        Starts the session, reads the table columns, warms the lookup caches, and records the receive station.
+        raises: RuntimeError if the database schema needs migrating
+        """
+        if self.conn is not None:
+            return
+        config = self.config
+        if self.use_metrics and self.metrics is None:
+            self.metrics = aprsmetrics.Metrics(config.getfloat('metrics', 'report_s', fallback=60), config.get('metrics', 'file', fallback='') or None)
+        metrics = self.metrics
+        try: # Establish database connection
+            conn = connect_db(config, metrics and metrics.connect)
+        except:
+            print("Unable to connect to the database")
+            raise
+        cur = conn.cursor() # Create a database cursor
+        try: # Refuse to write to a schema we don't match
+            aprsmigrate.check_version(conn)
+        except:
+            conn.close()
+            raise
+        if aprspartition.is_partitioned(cur): # Make sure the collector has partitions to write into
+            aprspartition.create_partitions(conn, config.get('partitions', 'interval', fallback='month'), config.getint('partitions', 'premake', fallback=3))
+
+        if self.session_id is None:
+            try: # Establish session ID and time
+                cur.execute("INSERT INTO sessions (start_time_utc_s, session_offset, applied_offset, receiver) VALUES (%s, %s, %s, %s) RETURNING session_id;", (time.time(), self.session_offset, self.session_offset, self.receiver))
+                self.session_id = cur.fetchone()[0]
+                conn.commit()
+            except:
+                print("Error entering session metadata to database")
+                raise # DB connection is mission-critical, so error out here
+
+        if self.my_schema is None:
+            my_schema = {}
+            for packet_format in SCHEMA_TABLES: # Get the column names for each packet format
+                cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name=%s;", (packet_format,)) # Query column names for the table
+                my_schema[packet_format] = [x[0] for x in cur.fetchall()] # Update column names
+            self.my_schema = my_schema
+
+        # Warm the lookup caches
+        cur.execute("SELECT call, digi_id, aprs_sym, aprs_table, ST_X(loc), ST_Y(loc) FROM digis;")
+        self.digi_cache.load((x[0], list(x[1:])) for x in cur.fetchall())
+        cur.execute("SELECT src, dest, route_id FROM routes;")
+        self.route_cache.load(((x[0], x[1]), x[2]) for x in cur.fetchall())
+        cur.execute("SELECT latitude, longitude, lid FROM location ORDER BY lid DESC LIMIT %s;", (self.location_cache.max_size,))
+        self.location_cache.load(((x[0], x[1]), x[2]) for x in reversed(cur.fetchall())) # Newest are most recently used
+        conn.commit()
+        (self.conn, self.cur) = (conn, cur)
+        if self.autocommit_lookups:
+            self.lookup_cur = self.connect_lookups()
+
+        # Keep the statistics summary tables current, refreshing between packets or after batches
+        self.aggregates = aprsaggregate.AggregateRefresher(conn, config.getfloat('ingest', 'aggregate_s', fallback=10), config.getfloat('ingest', 'live_window_s', fallback=3600))
+        if self.batch_size > 1:
+            self.batch = aprsbatch.PacketBatch(conn, self.batch_size, self.batch_ms, self.caches, self.aggregates.maybe_refresh)
+        if metrics is not None:
+            self._meter(metrics)
+        if 'rx_loc_id' not in self.rxinfo:
+            self.rxinfo['rx_loc_id'] = self.check_rx_station(self.rxinfo) # Test connectivity to database, and get rx_loc_id while we're at it
+
+    def _meter(self, metrics):
+        """Time each stage; with metrics off these stay unwrapped"""
+        self.direwolf_escape = metrics.timed('direwolf_escape', self.direwolf_escape)
+        self.process_direwolf = metrics.timed('process_direwolf', self.process_direwolf)
+        if not getattr(aprsparse.parse_packet, 'metered', False): # Shared by every Ingester in the process
+            aprsparse.parse_packet = metrics.timed('parse', aprsparse.parse_packet)
+            aprsparse.parse_packet.metered = True
+        if self.parse_cache is not None: # 'parse' then only counts the cache's misses
+            self.parse = metrics.timed('parse_cache', self.parse)
+        self.insert_common = metrics.timed('insert_common', self.insert_common)
+        self.process_digi = metrics.timed('process_digi', self.process_digi)
+        self.process_path = metrics.timed('process_path', self.process_path)
+        self.store_packet = metrics.packets_wrapper(self.store_packet)
+        if self.batch is not None:
+            self.batch.flush = metrics.timed('batch_flush', self.batch.flush)
+        statements = self.statements
+        if statements is not None:
+            metrics.gauge('prepared_statements', 'INSERT statements currently prepared', lambda: len(statements.statements))
+            metrics.gauge('statement_cache_hits', 'INSERTs sent as EXECUTE of an already prepared statement', lambda: statements.hits)
+            metrics.gauge('statement_cache_prepares', 'INSERT statements prepared', lambda: statements.prepared)
+        parse_cache = self.parse_cache
+        if parse_cache is not None:
+            metrics.gauge('parse_cache_hits', 'Packets whose parse was reused', lambda: parse_cache.hits)
+            metrics.gauge('parse_cache_misses', 'Packets parsed', lambda: parse_cache.misses)
+
+    def close(self):
+        """Stop the GPS thread and close the database connection (it is opened again on next use)"""
+        if self.gps is not None:
+            self.gps.stop(1)
+        if self.conn is not None:
+            self.conn.close()
+        if self.lookup_cur is not None:
+            self.lookup_cur.connection.close()
+        self._reset()
+
+    def commit(self):
+        """
+        Commit the current transaction, unless batched packets are waiting on it
+        """
+        if self.batch is None or self.batch.idle():
+            self.conn.commit()
+            for cache in self.caches:
+                cache.commit()
+
+    def rollback(self):
+        """
+        Roll back the current transaction, or only the packet in progress when batching
+        """
+        if self.batch is not None and self.batch.in_packet():
+            self.batch.rollback_packet()
+        else:
+            self.conn.rollback()
+            for cache in self.caches:
+                cache.rollback()
+
+    def flush(self):
+        """Write any batched packets now"""
+        if self.batch is not None:
+            self.batch.flush()
+
+    def switch_station(self, rxinfo, session_id):
+        """
+        Store the packets that follow as heard by another receive station, so one
+        Ingester can write for several receivers (see aprskiss.KissCollector)
+        rxinfo: the station's rxinfo, with its rx_loc_id
+        session_id: the station's session
+        """
+        self.rxinfo = rxinfo
+        self.session_id = session_id
+
+    def connect_lookups(self):
+        """
+        Open the connection that adds digis and routes when autocommit_lookups is set
+        Writers sharing a database (see aprskiss.KissCollector) otherwise hold each new digi
+        or route locked until their batch commits, and wait on, or deadlock with, each other.
+        returns: cursor on a new autocommitting connection
+        """
+        lookup_conn = connect_db(self.config)
+        lookup_conn.autocommit = True
+        return lookup_conn.cursor()
+
+    def lookup_cursor(self, cur):
+        """
+        cur: psycopg2 database cursor of the packet being stored
+        returns: the cursor to add and update digis and routes with (cur, unless autocommit_lookups is set)
+        """
+        if self.lookup_cur is None:
+            return cur
+        return self.lookup_cur
+
+    def known_digi(self, cur, call):
+        """
+        Make sure a call is in digis, adding it (call only) if it is new
+        cur: psycopg2 database cursor
+        call: callsign of the digi
+        returns: the digi's cache entry, [digi_id, aprs_sym, aprs_table, longitude, latitude]
+        """
+        digi = self.digi_cache.get(call)
+        if digi is None: # Found new digi
+            cur = self.lookup_cursor(cur)
+            cur.execute("INSERT INTO digis (call) VALUES (%s) ON CONFLICT (call) DO NOTHING RETURNING digi_id, aprs_sym, aprs_table, ST_X(loc), ST_Y(loc);", (call,))
+            myresult = cur.fetchone()
+            if myresult is None: # Added by another writer since the cache was loaded
+                cur.execute("SELECT digi_id, aprs_sym, aprs_table, ST_X(loc), ST_Y(loc) FROM digis WHERE call=%s;", (call,))
+                myresult = cur.fetchone()
+            digi = list(myresult)
+            self.digi_cache.put(call, digi)
+        return digi
+
+    def lookup_location(self, cur, latitude, longitude):
+        """
+        Find the lid of a known location
+        cur: psycopg2 database cursor
+        returns: lid, or None if the location is new
+        """
+        mylid = self.location_cache.get((latitude, longitude))
+        if mylid is None: # Not cached; it may still be in the table
+            cur.execute("SELECT lid FROM location WHERE latitude=%s AND longitude=%s;", (latitude, longitude))
+            myresult = cur.fetchone()
+            if myresult is not None:
+                mylid = myresult[0]
+                self.location_cache.put((latitude, longitude), mylid)
+        return mylid
+
+    def insert_row(self, cur, table, mydict):
+        """
+        Insert the keys/values in mydict into table, or queue them when batching
+        cur: psycopg2 database cursor
+        table: the table where values will be inserted
+        mydict: dictionary of field:value pairs
+        """
+        if self.batch is None:
+            self.execute_insert(cur, table, mydict)
+        else:
+            self.batch.add(table, mydict)
+
+    def record_error(self, packet, rxtime, msg, rxsession=None):
+        """
+        Save a packet that could not be stored to aprsdb_errs
+        packet: raw packet text
+        rxtime: time packet was received, as seconds since epoch
+        msg: description of the error
+        rxsession: session_id the packet was received in, if not this one (e.g. spooled by an earlier run)
+        """
+        if rxsession is None:
+            rxsession = self.session_id
+        if self.batch is not None:
+            self.batch.add_error(packet, rxtime, rxsession, msg)
+            return
+        try:
+            cur = self.conn.cursor()
+            cur.execute("INSERT INTO aprsdb_errs (rxtime, rxsession, raw, msg) VALUES (%s, %s, %s, %s);", (rxtime, rxsession, packet, msg))
+            self.commit()
+        except:
+            self.rollback()
+
+    def check_rx_station(self, parsed):
+        """
+        Check if the receiving station is in digis and location, adding if needed.
+        parsed: dictionary with fields call, symbol, symbol_table, latitude, and longitude (e.g. rxinfo)
+        returns: lid of the station's location
+        """
+        self.connect()
+        cur = self.conn.cursor()
+        mylid = None
+        [digi_id, mysym, mytable, oldlon, oldlat] = [None for _ in range(5)]
+        try:
+            # Look to see if rx "digi" is known
+            myresult = self.digi_cache.get(parsed['call'])
+            # Get the info for a known digi
+            if myresult != None:
+                [digi_id, mysym, mytable, oldlon, oldlat] = myresult
+
+            # Compute the linestring for the rx location
+            (mylon, mylat) = (float(parsed['longitude']), float(parsed['latitude']))
+            myloc = aprsgeom.point_ewkb(mylon, mylat)
+
+            # If the rx digi is new, add it
+            if digi_id == None:
+                cur.execute("INSERT INTO digis (call, aprs_sym, aprs_table, loc) VALUES (%s, %s, %s, %s) RETURNING digi_id;", (parsed['call'], parsed['symbol'], parsed['symbol_table'], myloc))
+                self.digi_cache.put(parsed['call'], [cur.fetchone()[0], parsed['symbol'], parsed['symbol_table'], mylon, mylat])
+
+            else: # Digi is known
+                # Check if rx digi has changed info
+                if not ((mylon, mylat)==(oldlon, oldlat) and mysym == parsed['symbol'] and mytable == parsed['symbol_table']):
+                    # Update rx digi info if needed
+                    cur.execute("UPDATE digis SET aprs_sym=%s, aprs_table=%s, loc=%s WHERE digi_id=%s;", (parsed['symbol'], parsed['symbol_table'], myloc, digi_id))
+                    self.digi_cache.put(parsed['call'], [digi_id, parsed['symbol'], parsed['symbol_table'], mylon, mylat])
+
+            # Check for an existing entry in the location table
+            cur.execute("SELECT lid FROM location WHERE linestring=%s;", (myloc,))
+            mylid = cur.fetchone()
+            if mylid == None: # If location is new, add it
+                cur.execute("INSERT INTO location (latitude, longitude, linestring) VALUES(%s, %s, %s) RETURNING lid;", (parsed['latitude'], parsed['longitude'], myloc))
+                mylid = cur.fetchone()
+            mylid = mylid[0]
 
+            self.commit()
+        except:
+            self.rollback()  # If errors are encountered, abort
+            raise
+        return mylid
+
+    def insert_common(self, cur, in_common):
+        """
+        Insert a packet's row in common
+        cur: psycopg2 database cursor
+        in_common: dictionary of common field:value pairs
+        returns: the new packet's pid
+        """
+        self.execute_insert(cur, 'common', in_common, 'RETURNING pid')
+        return cur.fetchone()[0]
+
+    def execute_insert(self, cur, table, mydict, codastring=''):
+        """
+        Insert the keys/values in mydict into table, with a prepared statement when the statement cache is on
+        cur: psycopg2 database cursor
+        table: the table where values will be inserted
+        mydict: dictionary of field:value pairs, all of which will be inserted
+        codastring: string to go at the query's end ('RETURNING pid')
+        """
+        if self.statements is None:
+            cur.execute(insert_sql_from_dict(table, mydict, codastring), mydict)
+        else:
+            self.statements.execute(cur, table, mydict, codastring)
+
+    def insert_digi(self, parsed, cur):
+        """Insert values for a new digipeater.
+        parsed: location packet for digi to be inserted
+        cur: database cursor
+        """
+        # Check that required information is present
+        for key in ['longitude','latitude','src','symbol','symbol_table']:
+            if (key not in parsed.keys()):
+                raise KeyError("Missing key: " + key) # Something went badly wrong
+        # Data checked basic test, insert it.
+        (mylon, mylat) = (float(parsed['longitude']), float(parsed['latitude']))
+        cur = self.lookup_cursor(cur)
+        try:
+            # Another writer may have added it since the cache was loaded; this position is newer
+            cur.execute("INSERT INTO digis (call, aprs_sym, aprs_table, loc) VALUES (%s, %s, %s, %s) ON CONFLICT (call) DO UPDATE SET aprs_sym=EXCLUDED.aprs_sym, aprs_table=EXCLUDED.aprs_table, loc=EXCLUDED.loc RETURNING digi_id;",
+                    (parsed['src'], parsed['symbol'], parsed['symbol_table'], aprsgeom.point_ewkb(mylon, mylat)))
+            self.digi_cache.put(parsed['src'], [cur.fetchone()[0], parsed['symbol'], parsed['symbol_table'], mylon, mylat])
+        except:
+            raise
 
-if __name__ == "__main__": # Program is running directly
-    rxinfo['rx_loc_id'] = check_rx_station(conn, rxinfo) # Test connectivity to database, and get rx_loc_id while we're at it
-    print("Connection OK")
-    lastline = 'a'
-    rxinfo['gps_loc_time'] = time.time()
-    while lastline != '': # Keep parsing packets from stdin
+    def check_update_digi(self, parsed, digi_id, cur):
+        """
+        Check if digipeater location has changed, updating if necessary
+        parsed: aprslib parsed packet for digi to be checked/updated
+        digi_id: digi_id from digis table to be checked against, and updated if needed
+        cur: psycopg2 database cursor
+        """
+        # Check for requisite info, error if missing
+        for key in ['longitude','latitude','src','symbol','symbol_table']:
+            if (key not in parsed.keys()):
+                raise KeyError("Missing key: " + key)
+
+        # Get existing digi symbol, symbol table, and location
+        [digi_id, old_sym, old_table, old_lon, old_lat] = self.digi_cache.get(parsed['src'])
+
+        if (old_sym == '#' and parsed['symbol'] != old_sym): # Ignore non-unique gates
+            return
+
+        # Compare coordinates here rather than geometry from the server
+        (curr_lon, curr_lat) = (float(parsed['longitude']), float(parsed['latitude']))
+
+    # Update digi record if it has moved or changed symbol [table]
+        if (((curr_lon, curr_lat) != (old_lon, old_lat)) or (parsed['symbol'] != old_sym) or (parsed['symbol_table'] != old_table)):
+            cur = self.lookup_cursor(cur)
+            cur.execute("UPDATE digis SET loc=%s, aprs_sym=%s, aprs_table=%s WHERE digi_id=%s;", (aprsgeom.point_ewkb(curr_lon, curr_lat), parsed['symbol'], parsed['symbol_table'], digi_id))
+            self.digi_cache.put(parsed['src'], [digi_id, parsed['symbol'], parsed['symbol_table'], curr_lon, curr_lat])
+
+
+
+    def process_digi(self, parsed, cur):
+        """Insert values for a new digipeater from a parsed packet
+        parsed: an aprslib parsed packet
+        cur: psycopg2 database cursor
+        """
+
+        # Check for crucial information
+        if ('symbol' not in parsed.keys()):
+            raise KeyError("Missing key: symbol")
+
+        # Get existing record for digi
+        myresult = self.digi_cache.get(parsed['src'])
+        if (myresult == None): # No matching digi
+            self.insert_digi(parsed, cur)
+        else: #Digis are forced unique by callsign, so can only be one row matching
+            # Check if updates are needed and make them
+            self.check_update_digi(parsed, myresult[0], cur)
+
+
+    def move_rx_station(self, gps_conn, latitude, longitude):
+        """
+        Record a new location for a roving receive station (called from the GPS thread)
+        gps_conn: psycopg2 database connection used only by the GPS thread
+        latitude, longitude: new location, truncated
+        returns: lid of the location, for rx_loc_id
+        """
+        cur = gps_conn.cursor()
+        myloc = aprsgeom.point_ewkb(longitude, latitude)
+        try:
+            cur.execute("UPDATE digis SET loc=%s WHERE call=%s;", (myloc, self.rxinfo['call']))
+            cur.execute("SELECT lid FROM location WHERE linestring=%s;", (myloc,))
+            mylid = cur.fetchone()
+            if mylid == None: # If location is new, add it
+                cur.execute("INSERT INTO location (latitude, longitude, linestring) VALUES(%s, %s, %s) RETURNING lid;", (latitude, longitude, myloc))
+                mylid = cur.fetchone()
+            gps_conn.commit()
+        except:
+            gps_conn.rollback()
+            raise
+        return mylid[0]
+
+    def start_gps(self):
+        """Rover: follow the GPS on its own thread and connection, if gpsd-py3 is installed and [gps] is enabled"""
+        config = self.config
+        if not use_gps or not config.getboolean('gps', 'enabled', fallback=True):
+            return
+        gps_conn = connect_db(config)
+        self.gps = aprsgps.PositionProvider(lambda latitude, longitude: self.move_rx_station(gps_conn, latitude, longitude),
+                config.getfloat('gps', 'interval_s', fallback=30), config.getfloat('gps', 'min_move_m', fallback=50),
+                config.get('gps', 'host', fallback='127.0.0.1'), config.getint('gps', 'port', fallback=2947))
+        self.gps.start()
+
+    def process_path(self, path, packet_id, src=None, rxtime=None):
+        """
+        Insert the path routing info to the database
+        path: Python list of path routing elements (e.g. N0QVC-1, WIDE1*, N0PBA-1,WIDE2-1)
+        packet_id: packet_id from packets table corresponding to the entry being processed
+        src: source call of the packet; if omitted, it is looked up from common by packet_id
+        rxtime: receive time of the packet (stored with each hop when the tables are partitioned)
+        """
+        cur = self.conn.cursor()
+        path = aprslib.util.remove_WIDEn_N(path) # Get rid of WIDEn-N and asterisks
+        if 'NULL' in path:
+            path.remove('NULL') # remove first NULL value
+
+        digi_src = False
+        if src is None: # Look up the source call if the caller didn't give it
+            cur.execute("SELECT src FROM common WHERE pid=%s;", (packet_id, ))
+            src = cur.fetchone()[0]
+        if self.digi_cache.get(src) != None: # Source is a known digi
+            path.insert(0, src) # Add first hop to inter-digi list
+            digi_src = True
+
+
+        if (path == None or path == []): # No route info
+            return
+
+        for call in path:  # Check for new digis!
+            self.known_digi(cur, call)
+
+        path.append(self.rxinfo['call']) # All packets end at RX site
+
+        for i in range(len(path)-1): # Split path into single hops
+            src = path[i]
+            dest = path[i+1]
+            hop = i+1
+            if (digi_src): # 0-index for digi-sourced packets
+                hop = i
+            route_id = 0
+
+            # Check if route exists, and get its ID if it does
+            myresult = self.route_cache.get((src, dest))
+            if myresult != None: # Route exists
+                route_id = myresult
+            else: # Route is new
+                lookup_cur = self.lookup_cursor(cur)
+                lookup_cur.execute("INSERT INTO routes (src, dest) VALUES (%s, %s) ON CONFLICT (src, dest) DO NOTHING RETURNING route_id;", (src, dest))
+                myresult = lookup_cur.fetchone()
+                if myresult is None: # Added by another writer since the cache was loaded
+                    lookup_cur.execute("SELECT route_id FROM routes WHERE src=%s AND dest=%s;", (src, dest))
+                    myresult = lookup_cur.fetchone()
+                route_id = myresult[0]
+                self.route_cache.put((src, dest), route_id)
+
+            # Add the hop and route to the paths table
+            in_paths = {'pid':packet_id, 'hop':hop, 'route_id':route_id}
+            if 'rxtime' in self.my_schema['paths']: # Partitioned tables carry rxtime
+                in_paths['rxtime'] = rxtime
+            self.insert_row(cur, 'paths', in_paths)
+
+        self.commit()
+
+
+    def parse(self, packet):
+        """
+        Parse a raw APRS packet, through the parse cache if it is enabled
+        packet: APRS packet string
+        returns: as aprsparse.parse_packet
+        """
+        if self.parse_cache is None:
+            return(aprsparse.parse_packet(packet))
+        return(self.parse_cache.parse(packet))
+
+    def process_packet(self, packet, rxtime=None, is_subpacket=False):
+        """
+        Load an unparsed APRS packet into the database
+        packet: APRS packet string
+        rxtime: time packet was received, as seconds since epoch (1/1/1970); if omitted or wrong format, uses system clock (plus the session offset)
+        is_subpacket: boolean flag for whether this is a sub-packet
+        returns packet_id (positive bigint) if successful, negative integer if not
+        """
+        # Check for reasonable timestamp
+        if (type(rxtime) is not float and type(rxtime) is not int or (rxtime is None)):
+            rxtime=self.decoder.now()
+
+        # Parse it, then store it
+        return(self.store_packet(self.parse(packet), packet, rxtime, is_subpacket))
+
+    def store_packet(self, parsed, packet, rxtime, is_subpacket=False, rxsession=None):
+        """
+        Load the result of aprsparse.parse_packet into the database
+        parsed: parsed aprs packet dictionary, or negative integer if parsing failed
+        packet: APRS packet string
+        rxtime: time packet was received, as seconds since epoch (1/1/1970)
+        is_subpacket: boolean flag for whether this is a sub-packet
+        rxsession: session_id the packet was received in, if not this one (e.g. spooled by an earlier run)
+        returns packet_id (positive bigint) if successful, negative integer if not
+        """
+        self.connect()
+        if rxsession is None:
+            rxsession = self.session_id
+        if parsed == -6: # Couldn't salvage anything
+            print("Unable to partially parse packet: '" + packet + "' at time "+ str(rxtime)) # DEBUG
+            return(-6) # Unable to partially parse packet
+        if parsed == -5: # Something else went wrong
+            print("Unable to parse packet") # DEBUG
+            self.record_error(packet, rxtime, "Unable to parse packet", rxsession)
+            return(-5) # Unable to parse packet
+
+        # Add the receiving station metadata to the parsed data
+        parsed.update({'rxtime':rxtime, 'rxsession':rxsession, 'is_subpacket':is_subpacket})
+
+        # Send the parsed data on for further processing
+        if self.batch is None:
+            if self.server_insert:
+                mypacketid = self.process_server(parsed, rxtime, is_subpacket)
+            else:
+                mypacketid = self.process_parsed(parsed, rxtime, is_subpacket)
+            self.aggregates.maybe_refresh() # Only between packets, so a refresh never sees half of one
+        else:
+            mypacketid = self.process_batched(parsed, packet, rxtime, is_subpacket, rxsession)
+
+        # Keep the live station table current (parsed now has src, dest, and format under their database names)
+        if self.live is not None and mypacketid > 0 and is_subpacket == False and 'latitude' in parsed and 'longitude' in parsed:
+            self.live.update(parsed, mypacketid)
+        return(mypacketid)
+
+    def process_batched(self, parsed, packet, rxtime, is_subpacket=False, rxsession=None):
+        """
+        Load a parsed APRS packet into the current batch, flushing the batch when it is full
+        parsed: parsed aprs packet dictionary from aprslib
+        packet: raw APRS packet string (saved to aprsdb_errs if the packet fails)
+        rxtime: time packet was received, as seconds since epoch (1/1/1970)
+        is_subpacket: boolean flag for whether this is a sub-packet
+        rxsession: session_id the packet was received in (default: this one)
+        returns packet_id (positive bigint) if successful, negative integer if not
+        Note: rows are written when the batch is flushed; a packet rejected then is
+        moved to aprsdb_errs, and the packet_id returned for it is never used.
+        """
+        batch = self.batch
+        if rxsession is None:
+            rxsession = self.session_id
+        batch.begin_packet(packet, rxtime, rxsession)
+        try:
+            mypacketid = self.process_parsed(parsed, rxtime, is_subpacket)
+        except psycopg2.DataError as de: # Bad packet data; log it and drop only this packet
+            batch.abort_packet()
+            print(de.pgerror) # DEBUG
+            self.record_error(packet, rxtime, de.pgerror, rxsession)
+            mypacketid = -7
+        except:
+            batch.abort_packet()
+            raise
+        else:
+            if mypacketid < 0:
+                batch.abort_packet()
+            else:
+                batch.end_packet()
+
+        if batch.due():
+            batch.flush()
+        return mypacketid
+
+    def prepare_parsed(self, parsed, rxtime, is_subpacket=False):
+        """
+        Add the receive details to a parsed packet, and normalize its field names
+        parsed: parsed aprs packet dictionary from aprslib
+        rxtime: time packet was received, as seconds since epoch (1/1/1970)
+        is_subpacket: boolean flag for whether this is a sub-packet
+        returns: the normalized packet dictionary
+        """
+        parsed['is_subpacket']=is_subpacket
+        parsed['rxtime']=rxtime
+        parsed['rx_loc_id'] = self.rxinfo['rx_loc_id'] # Get current loc_id for rx station
+        if self.gps is not None: # Rover: use the latest location published by the GPS thread
+            fix = self.gps.fix
+            if fix is not None:
+                parsed['rx_loc_id'] = fix.rx_loc_id
+
+        # Work around potential SQL reserved words, characters, and case-sensitivity
+        return(aprsparse.normalize_parsed(parsed))
+
+    def row_from_parsed(self, parsed, table, ids=()):
+        """
+        Pick a table's columns out of a parsed packet, for the insert_packet() database function
+        parsed: normalized packet dictionary
+        table: table the row is for
+        ids: id columns (pid, lid, subpacket_id) for the server to fill in, if the table has them
+        returns: row dictionary, with dictionaries stringified and lists in PostgreSQL array text
+        """
+        row = {}
+        for x in self.my_schema[table]:
+            if x in parsed:
+                row[x] = parsed[x]
+                if type(row[x]) is dict:
+                    row[x] = str(row[x])
+                elif type(row[x]) is list:
+                    row[x] = aprsbulk.pg_array(row[x])
+            elif x in ids:
+                row[x] = None
+        return row
+
+    def packet_document(self, parsed, rxtime, is_subpacket=False):
+        """
+        Describe a parsed packet for the insert_packet() database function, taking
+        the same steps process_parsed does (see migrations/004_insert_packet.sql)
+        parsed: parsed aprs packet dictionary from aprslib
+        rxtime: time packet was received, as seconds since epoch (1/1/1970)
+        is_subpacket: boolean flag for whether this is a sub-packet
+        returns: dictionary to send as JSON
+        """
+        my_schema = self.my_schema
+        parsed = self.prepare_parsed(parsed, rxtime, is_subpacket)
+        doc = {'common':self.row_from_parsed(parsed, 'common'), 'errs':{x:parsed[x] for x in my_schema['aprsdb_errs'] if x in parsed}}
+        if 'symbol' in parsed: # Possibly a digi
+            doc['digi'] = {'call':parsed['src'], 'symbol':parsed['symbol'], 'symbol_table':parsed.get('symbol_table'), 'loc':None}
+            if 'latitude' in parsed and 'longitude' in parsed:
+                (mylon, mylat) = (float(parsed['longitude']), float(parsed['latitude']))
+                doc['digi'].update({'longitude':mylon, 'latitude':mylat, 'loc':aprsgeom.point_ewkb(mylon, mylat)})
+        if parsed['format']=='thirdparty':
+            doc['thirdparty_src'] = parsed['src']
+            parsed['subpacket_type'] = parsed['subpacket']['format']
+            doc['subpacket'] = self.packet_document(parsed['subpacket'], rxtime, True)
+        if 'weather' in parsed.keys():
+            parsed['has_wx']=True
+            for key in parsed['weather'].keys():
+                parsed[key]=parsed['weather'][key]
+            if parsed['format']!='wx': # Objects/positions with weather
+                doc['wx'] = self.row_from_parsed(parsed, 'wx', ('pid', 'subpacket_id'))
+        ids = ['pid', 'subpacket_id']
+        if 'latitude' in parsed.keys() and 'longitude' in parsed.keys():
+            parsed['linestring'] = aprsgeom.point_ewkb(parsed['longitude'], parsed['latitude'])
+            doc['location'] = self.row_from_parsed(parsed, 'location')
+            doc['map_entry'] = self.row_from_parsed(parsed, 'map_entry', ('pid', 'lid'))
+            ids.append('lid')
+        if parsed['format'] in my_schema:
+            doc['format_table'] = parsed['format']
+            doc['format_row'] = self.row_from_parsed(parsed, parsed['format'], ids)
+        if is_subpacket==False: # Only RF paths
+            path = aprslib.util.remove_WIDEn_N(parsed['path'])
+            if 'NULL' in path:
+                path.remove('NULL')
+            doc.update({'path':path, 'rxcall':self.rxinfo['call']})
+            if 'rxtime' in my_schema['paths']: # Partitioned tables carry rxtime
+                doc['path_extra'] = {'rxtime':rxtime}
+        return doc
+
+    def process_server(self, parsed, rxtime, is_subpacket=False):
+        """
+        Load a parsed APRS packet into the database with one call to insert_packet() (server_insert mode)
+        parsed: parsed aprs packet dictionary from aprslib
+        rxtime: time packet was received, as seconds since epoch (1/1/1970)
+        is_subpacket: boolean flag for whether this is a sub-packet
+        returns packet_id (positive bigint) if successful, negative integer if not
+        """
+        conn = self.conn
+        doc = psycopg2.extras.Json(self.packet_document(parsed, rxtime, is_subpacket), dumps=lambda x: json.dumps(x, default=str))
+        conn.commit() # Nothing may be left open when switching to autocommit
+        conn.autocommit = True # The call is its own transaction, so there is no BEGIN or COMMIT to wait for
+        try:
+            self.cur.execute("SELECT insert_packet(%s);", (doc,))
+            return self.cur.fetchone()[0]
+        finally:
+            conn.autocommit = False
+
+    def process_parsed(self, parsed, rxtime=None, is_subpacket=False):
+        """
+        Load a parsed APRS packet into the database
+        parsed: parsed aprs packet dictionary from aprslib
+        rxtime: time packet was received, as seconds since epoch (1/1/1970); if omitted, uses system clock (plus the session offset)
+        is_subpacket: boolean flag for whether this is a sub-packet
+        returns packet_id (positive bigint) if successful, negative integer if not
+        """
+        self.connect()
+        (conn, cur, batch, my_schema) = (self.conn, self.cur, self.batch, self.my_schema)
+        if rxtime is None:
+            rxtime = self.decoder.now()
+        parsed = self.prepare_parsed(parsed, rxtime, is_subpacket)
+
+        # Insert data into common table
+        # Start by finding the fields we have that go in common
+        in_common = {x: parsed[x] for x in my_schema['common'] if x in parsed}
+        if batch is not None: # Batched: reserve the pid now, insert with the batch
+            mypacketid = batch.next_pid()
+            parsed['pid'] = mypacketid
+            in_common['pid'] = mypacketid
+            batch.add('common', in_common)
+        else:
+            try:
+                # Put them in, and get the pid back for future reference
+                mypacketid = self.insert_common(cur, in_common)
+                parsed['pid']=mypacketid
+                conn.commit()
+            except psycopg2.DataError as de:
+                conn.rollback()
+                print(de.pgerror)
+                parsed['msg']=de.pgerror
+                try:
+                    in_errs = {x:parsed[x] for x in my_schema['aprsdb_errs'] if x in parsed}
+                    self.execute_insert(cur, 'aprsdb_errs', in_errs)
+                    conn.commit()
+                    return -7
+                except:
+                    conn.rollback()
+                    raise
+                    return -8
+            except:
+                # Take it all back if something fails
+                conn.rollback()
+                raise
+                return -2 # Unable to insert common table data
+
+        # Check for digis
+        if 'symbol' in parsed.keys():
+            # Digis and igates are # and &
+            if parsed['symbol'] in ['#','&']:
+                self.process_digi(parsed, cur)
+            # Watch out for digis not using standard symbols
+            if self.digi_cache.get(parsed['src']) != None: # Call is a known digi
+                if parsed['format'] not in ('object','item'): # Don't use digipeater data from objects or items
+                    self.process_digi(parsed, cur)
+
+        # Handle third-party packets
+        if parsed['format']=='thirdparty':
+            # Source is a digi; check that it is known
+            self.known_digi(cur, parsed['src'])
+
+            # Get the subpacket type
+            parsed['subpacket_type'] = parsed['subpacket']['format']
+            # Process the subpacket, getting its pid for back reference
+            parsed['subpacket_id'] = self.process_parsed(parsed['subpacket'], rxtime, True)
+            if parsed['subpacket_id'] <0: # Error encountered
+                self.rollback()
+                return -4 # Unable to handle third-party packet
+
+        # Handle weather packets
+        if 'weather' in parsed.keys():
+            parsed['has_wx']=True
+            for key in parsed['weather'].keys():
+                parsed[key]=parsed['weather'][key]
+            if parsed['format']!='wx': # Watch out for objects/positions with weather
+                # Find wx fields in the packet and their values
+                in_schema = {x: parsed[x] for x in my_schema['wx'] if x in parsed}
+                for x in in_schema:
+                    if type(in_schema[x]) is dict:
+                        # Stringify dictionaries
+                        in_schema[x] = str(in_schema[x])
+                # wx format packets will be entered later, but objects need their wx data entered now
+                self.insert_row(cur, 'wx', in_schema)
+                self.commit()
+
+        # Handle linestring creation and location entries
+        if 'latitude' in parsed.keys() and 'longitude' in parsed.keys():
+            try:
+                # Get the linestring (EWKB representation of geospatial data)
+                parsed['linestring'] = aprsgeom.point_ewkb(parsed['longitude'], parsed['latitude'])
+
+                # Check if we know this location
+                myresult = self.lookup_location(cur, parsed['latitude'], parsed['longitude'])
+                if myresult == None: # No results found
+                    # Enter location data into a table
+                    in_schema = {x: parsed[x] for x in my_schema['location'] if x in parsed}
+                    for x in in_schema:
+                        # Stringify dictionaries
+                        if type(in_schema[x]) is dict:
+                            in_schema[x] = str(in_schema[x])
+                    self.execute_insert(cur, 'location', in_schema, 'RETURNING lid')
+                    parsed['lid']=cur.fetchone()[0]
+                    self.location_cache.put((parsed['latitude'], parsed['longitude']), parsed['lid'])
+                    self.commit()
+                else: # Location known, we just need its id
+                    parsed['lid']=myresult
+
+                # Enter symbol/table, course/speed, and PHG into map_entry table
+                in_schema = {x: parsed[x] for x in my_schema['map_entry'] if x in parsed}
+                for x in in_schema:
+                    if type(in_schema[x]) is dict:
+                        in_schema[x] = str(in_schema[x])
+                self.insert_row(cur, 'map_entry', in_schema)
+
+                self.commit()
+            except:
+                self.rollback()
+                raise
+
+
+        # Insert format-specific data into proper table
+        try:
+            in_schema = {x: parsed[x] for x in my_schema[parsed['format']] if x in parsed}
+        except KeyError:
+            # Format missing; salvage path info
+            self.commit()
+            # Process path, but only if the path is RF
+            if is_subpacket==False:
+                self.process_path(parsed['path'], mypacketid, parsed['src'], rxtime)
+            return mypacketid
+
+        # Get the main packet data ready for insertion
+        for x in in_schema:
+            if type(in_schema[x]) is dict: # Stringify dictionaries
+                in_schema[x] = str(in_schema[x])
+        try:
+            # Insert the packet's data into the format table
+            self.insert_row(cur, parsed['format'], in_schema)
+            self.commit()
+        except:
+            self.rollback()
+            raise
+            #return -3
+
+        # Process path, only for RF paths
+        if is_subpacket==False:
+            self.process_path(parsed['path'], mypacketid, parsed['src'], rxtime)
+
+        return mypacketid
+
+    def bulk_load(self, files, chunk_size=10000, drop_indexes=True):
+        """
+        Load Direwolf/kissutil capture files into the database using COPY
+        Secondary indexes are dropped for the load and rebuilt once at the end (or, if the
+        load is killed first, by the next --bulk or --maintain; see bulk_dropped_indexes).
+        files: list of capture file names
+        chunk_size: number of packets per COPY transaction
+        drop_indexes: drop secondary indexes during the load (off keeps them for concurrent readers)
+        returns: number of packets loaded
+        """
+        self.connect()
+        (conn, decoder) = (self.conn, self.decoder)
+        loader = aprsbulk.BulkLoader(conn, self.my_schema, self.rxinfo['call'], chunk_size)
+        if drop_indexes:
+            loader.drop_indexes()
+        count = 0
+        start = time.time()
+        try:
+            for filename in files:
+                with open(filename, errors='replace') as capture:
+                    for lines in iter(lambda: capture.readlines(1<<20), []):
+                        # Decode a block of direwolf output at once (channels, timestamps, packets)
+                        (channels, rxtimes, packets) = decoder.decode_block(lines)
+                        for (rxtime, packet) in zip(rxtimes, packets):
+                            if packet == '':
+                                continue
+                            if rxtime is None:
+                                rxtime=decoder.now()
+                            parsed = self.parse(packet)
+                            if parsed == -6: # Couldn't salvage anything
+                                print("Unable to partially parse packet: '" + packet + "' at time "+ str(rxtime)) # DEBUG
+                            elif parsed == -5:
+                                loader.add_error(packet, rxtime, self.session_id, "Unable to parse packet")
+                            elif loader.add(packet, parsed, rxtime, self.session_id, self.rxinfo['rx_loc_id']) > 0:
+                                count += 1
+                                if count % chunk_size == 0:
+                                    print(str(count) + " packets, " + str(int(count/(time.time()-start))) + " packets/s")
+            loader.flush()
+        finally:
+            conn.rollback() # Clear any failed transaction so the indexes can be rebuilt
+            loader.restore_indexes()
+            self.aggregates.refresh()
+        print("Loaded " + str(count) + " packets in " + str(round(time.time()-start, 1)) + " s")
+        if self.parse_cache is not None:
+            print(self.parse_cache.stats())
+        return count
+
+    def replay(self, files, jobs=None, chunk_bytes=1<<22, report_s=60):
+        """
+        Replay capture files, parsing on several cores and storing the packets here, in file order
+        files: list of capture file names
+        jobs: worker processes (default: one per core)
+        chunk_bytes: approximate size of the file pieces handed to each worker
+        report_s: seconds between throughput reports (0 for none)
+        returns: aprsparallel.ReplayStats
+        """
+        self.connect()
+        stats = aprsparallel.replay(files, lambda parsed, packet, rxtime: self.store_packet(parsed, packet, rxtime), jobs, chunk_bytes, report_s, self.decoder)
+        self.flush()
+        self.aggregates.refresh()
+        return stats
+
+    def read_direwolf_line(self):
+        """
+        Read and unescape the next Direwolf line from stdin (pipeline stage one)
+        returns: (rxtime, packet), or None at end of input or on the quit command
+        """
         is_valid=False
         while is_valid==False: # Keep trying to parse lines until one is valid
             (is_valid, lastline) = get_valid_line()
-        if lastline.strip()=='q' or lastline.strip()=='2legit': # to quit
-            exit(0)
-        lastline = direwolf_escape(lastline) # Catch non-printing ASCII
+        if lastline=='' or lastline.strip()=='q' or lastline.strip()=='2legit': # End of input, or quit
+            return None
+        lastline = self.direwolf_escape(lastline) # Catch non-printing ASCII
         print(lastline) # DEBUG
 
         # Parse the direwolf output (channel, timestamp, packet)
-        (channel, mytime, mypacket) = process_direwolf(lastline)
-        # Process that output
-        process_packet(mypacket, conn, rxtime=mytime)
+        (channel, mytime, mypacket) = self.process_direwolf(lastline)
+        if (type(mytime) is not float and type(mytime) is not int):
+            mytime = self.decoder.now() # Stamp it on arrival, not when it reaches the database
+        return (mytime, mypacket)
+
+    def parse_line(self, item):
+        """
+        Parse a packet from read_direwolf_line (pipeline stage two)
+        item: (rxtime, packet)
+        returns: (rxtime, packet, parsed), where parsed is from aprsparse.parse_packet
+        """
+        (rxtime, packet) = item
+        return (rxtime, packet, self.parse(packet))
+
+    def read_stdin_lines(self, lines):
+        """
+        Read stdin lines onto a queue until end of input (run_stdin's reader thread, when batching)
+        lines: queue.Queue of (is_valid, text), as from get_valid_line
+        """
+        text = 'a'
+        while text != '':
+            (is_valid, text) = get_valid_line()
+            lines.put((is_valid, text))
+
+    def run_stdin(self, queue_size=1000):
+        """
+        Ingest Direwolf lines from stdin, one at a time, until end of input or the quit command
+        When batching, lines are read on their own thread and waited for with the batch's
+        timeout, so a quiet channel can't hold batched packets past their deadline.  (Waiting
+        on the file descriptor instead would miss lines already in Python's stdin buffer.)
+        queue_size: most lines read ahead while batching
+        """
+        self.connect()
+        lines = None
+        if self.batch is not None:
+            lines = queue.Queue(queue_size)
+            threading.Thread(target=self.read_stdin_lines, args=(lines,), name='aprsdb-stdin', daemon=True).start()
+        lastline = 'a'
+        while lastline != '': # Keep parsing packets from stdin
+            is_valid=False
+            while is_valid==False: # Keep trying to parse lines until one is valid
+                if lines is None:
+                    (is_valid, lastline) = get_valid_line()
+                    continue
+                try: # Wait for a line, but not past the batch's deadline
+                    (is_valid, lastline) = lines.get(timeout=self.batch.timeout())
+                except queue.Empty:
+                    self.batch.flush()
+            if lastline.strip()=='q' or lastline.strip()=='2legit': # to quit
+                break
+            lastline = self.direwolf_escape(lastline) # Catch non-printing ASCII
+            print(lastline) # DEBUG
+
+            # Parse the direwolf output (channel, timestamp, packet)
+            (channel, mytime, mypacket) = self.process_direwolf(lastline)
+            # Process that output
+            self.process_packet(mypacket, rxtime=mytime)
+
+    def run_pipeline(self, queue_size=1000, report_s=60):
+        """
+        Ingest stdin with reading and parsing on their own threads, writing to the database here (stage three)
+        Runs until end of input or the quit command, then writes everything already read.
+        queue_size: maximum number of packets waiting between stages
+        report_s: seconds between queue/backpressure reports (0 for none)
+        """
+        self.connect()
+        batch = self.batch
+        pipe = aprspipeline.Pipeline(self.read_direwolf_line, self.parse_line, queue_size)
+        pipe.start()
+        last_report = time.time()
+        while True:
+            try: # Wait for a packet, but not past a batch's deadline
+                item = pipe.get(batch.timeout() if batch is not None else None)
+            except queue.Empty:
+                batch.flush()
+                continue
+            if item is aprspipeline.STOP: # Drained
+                break
+            (rxtime, packet, parsed) = item
+            self.store_packet(parsed, packet, rxtime)
+            if report_s > 0 and time.time() - last_report > report_s:
+                print(pipe.stats())
+                last_report = time.time()
+        self.flush()
+        print(pipe.stats())
+
+    def reconnect(self):
+        """Replace a lost database connection (spool drainer), forgetting whatever the old one hadn't committed"""
+        try:
+            self.conn.close()
+        except psycopg2.Error:
+            pass
+        self.conn = connect_db(self.config, self.metrics and self.metrics.connect)
+        self.cur = self.conn.cursor()
+        if self.lookup_cur is not None:
+            try:
+                self.lookup_cur.connection.close()
+            except psycopg2.Error:
+                pass
+            self.lookup_cur = self.connect_lookups()
+        for cache in self.caches: # Entries added since the last commit may name rows that are gone
+            cache.rollback()
+        if self.batch is not None:
+            self.batch.reset(self.conn)
+        self.aggregates.conn = self.conn
+        self.aggregates.cur = self.conn.cursor()
+
+    def store_spooled(self, rxtime, rxsession, packet):
+        """
+        Store a packet from the spool (on the drainer's thread, the only one writing to the connection)
+        rxtime: time packet was received, as seconds since epoch
+        rxsession: session_id the packet was received in
+        packet: APRS packet string
+        returns: True if the packet and everything before it are committed
+        """
+        try:
+            self.store_packet(self.parse(packet), packet, rxtime, rxsession=rxsession)
+        except aprsspool.UNAVAILABLE:
+            raise # Leave it in the spool until the database is back
+        except Exception as e: # Anything else would stop the drain at this packet, on every restart
+            print("Unable to store spooled packet: " + str(e).strip()) # DEBUG
+            if self.batch is None:
+                self.rollback()
+            self.record_error(packet, rxtime, str(e).strip()[:512], rxsession)
+        return self.batch is None or self.batch.idle()
+
+    def run_spool(self, path, chunk=500, retry_max_s=60, synchronous='NORMAL'):
+        """
+        Ingest stdin through a durable spool: this thread only reads lines and appends
+        them to the spool, and a background drainer stores them, waiting out database outages
+        Runs until end of input or the quit command, then stores everything already spooled.
+        path: spool file
+        chunk: most packets the drainer reads from the spool at a time
+        retry_max_s: longest wait between reconnection attempts, in seconds
+        synchronous: SQLite synchronous setting for the spool
+        """
+        self.connect()
+        spool = aprsspool.Spool(path, synchronous)
+        if spool.depth() > 0:
+            print(str(spool.depth()) + " packets left in the spool from an earlier run")
+        drainer = aprsspool.Drainer(spool, self.store_spooled, self.flush, lambda: self.batch.timeout() if self.batch is not None else None,
+                self.reconnect, chunk, retry_max_s)
+        if self.metrics is not None:
+            self.metrics.gauge('spool_depth', 'Packets spooled but not yet stored', spool.depth)
+        drainer.start()
+        while drainer.error is None:
+            item = self.read_direwolf_line()
+            if item is None:
+                break
+            (rxtime, packet) = item
+            spool.append(rxtime, self.session_id, packet)
+        drainer.stop()
+        print(drainer.stats())
+
+    def finish(self):
+        """Write whatever is still batched, catch up the summary tables, and print statistics, e.g. at exit"""
+        self.flush()
+        self.aggregates.refresh()
+        self.print_stats()
+
+    def print_stats(self):
+        """Print the cache, summary table, and (if enabled) metrics statistics, e.g. at exit"""
+        for cache in self.caches:
+            print(cache.stats())
+        print(self.aggregates.stats())
+        if self.parse_cache is not None:
+            print(self.parse_cache.stats())
+        if self.statements is not None:
+            print(self.statements.stats())
+        if self.gps is not None:
+            print(self.gps.stats())
+        if self.live is not None:
+            print(self.live.stats())
+        if self.metrics is not None:
+            print(self.metrics.report())
+            self.metrics.write()
+
+def make_parser():
+    """returns: argparse.ArgumentParser for the aprsdb.py command line"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', help='APRSDB config file')
+    parser.add_argument('-b', '--batch-size', type=int, help='Packets per database transaction (batched ingest)')
+    parser.add_argument('--batch-ms', type=int, help='Maximum time a packet waits in a batch, in milliseconds')
+    parser.add_argument('--bulk', nargs='+', metavar='FILE', help='Bulk-load Direwolf/kissutil capture files with COPY, then exit')
+    parser.add_argument('-p', '--pipeline', action='store_true', help='Read, parse, and write packets on separate threads')
+    parser.add_argument('--replay', nargs='+', metavar='FILE', help='Replay capture files, parsing on several cores, then exit')
+    parser.add_argument('-j', '--jobs', type=int, help='Worker processes for --replay (default: one per core)')
+    parser.add_argument('--migrate', action='store_true', help='Apply pending database schema migrations, then exit')
+    parser.add_argument('--partition', action='store_true', help='Convert the packet tables to time-partitioned tables, then exit')
+    parser.add_argument('--maintain', action='store_true', help='Create upcoming partitions and expire old ones, then exit')
+    parser.add_argument('--refresh', action='store_true', help='Update the summary tables behind the statistics views, then exit')
+    parser.add_argument('--rebuild', action='store_true', help='With --refresh, recount every stored packet instead')
+    parser.add_argument('--server-insert', action='store_true', help='Store each packet with one call to a database function (for remote databases)')
+    parser.add_argument('--metrics', action='store_true', help='Collect per-stage latency and SQL round-trip metrics')
+    parser.add_argument('--clock-offset', type=float, metavar='SECONDS', help='Correction added to receive times, when this station\'s clock is known to be off')
+    parser.add_argument('--retime', nargs='*', type=int, metavar='SESSION', help='Apply sessions\' offsets to their stored receive times (default: all pending), then exit')
+    parser.add_argument('--spool', metavar='FILE', help='Spool received packets to FILE, storing them from a background thread that waits out database outages')
+    parser.add_argument('--export', metavar='DIR', help='Export packets and hops added since the last export to day-partitioned Parquet/Arrow files in DIR, then exit')
+    parser.add_argument('--export-since', type=int, metavar='PID', help='With --export, export the packets after PID instead (e.g. 0 for everything, into a new directory)')
+    parser.add_argument('--kiss', nargs='*', metavar='RECEIVER', help='Collect from the KISS TCP receivers in the config (default: all) instead of stdin')
+    return parser
+
+def maintain(args, config):
+    """
+    Run a one-off database command (--migrate, --partition, --maintain, --retime, --export, or --refresh), if one was given
+    args: parsed command line
+    config: configparser.ConfigParser
+    returns: True if a command ran
+    """
+    if not (args.migrate or args.partition or args.maintain or args.retime is not None or args.export or args.refresh):
+        return False
+    if args.export and not use_export:
+        print("Exporting needs pyarrow (pip install pyarrow)")
+        exit(1)
+    try: # Establish database connection
+        conn = connect_db(config)
+    except:
+        print("Unable to connect to the database")
+        raise
+    if args.migrate: # Bring the schema up to date, and do nothing else
+        print("Database schema is at version {}".format(aprsmigrate.migrate(conn)))
+        return True
+    try: # Refuse to write to a schema we don't match
+        aprsmigrate.check_version(conn)
+    except RuntimeError as e:
+        print(e)
+        exit(1)
+    # Partition settings (only used once the tables are partitioned)
+    partition_interval = config.get('partitions', 'interval', fallback='month')
+    partition_premake = config.getint('partitions', 'premake', fallback=3)
+    if args.partition: # One-time conversion to partitioned tables
+        if not aprspartition.convert(conn, partition_interval, partition_premake):
+            print("Tables are already partitioned")
+    elif args.maintain: # Routine partition upkeep (e.g. from cron)
+        aprsbulk.restore_dropped_indexes(conn) # Left behind by a bulk load that didn't finish
+        aprspartition.create_partitions(conn, partition_interval, partition_premake)
+        if aprspartition.expire_partitions(conn, config.getint('partitions', 'retention', fallback=0), partition_interval,
+                config.get('partitions', 'retention_action', fallback='drop')) != []:
+            aprsaggregate.AggregateRefresher(conn, 0, config.getfloat('ingest', 'live_window_s', fallback=3600)).refresh(rebuild=True) # Stop counting the expired packets
+    elif args.retime is not None: # Correct the receive times of sessions whose clocks were off
+        aprsretime.retime(conn, args.retime or None, config.getint('ingest', 'retime_chunk', fallback=10000))
+    elif args.export: # Columnar files for offline analysis, picking up where the last export stopped
+        try:
+            (first, last, packets, hops) = aprsexport.export(conn, args.export, config.get('export', 'format', fallback='parquet'),
+                    config.get('export', 'compression', fallback='zstd'), config.getint('export', 'chunk', fallback=50000), args.export_since,
+                    config.getfloat('export', 'settle_s', fallback=60))
+        except ValueError as e: # Unknown format, not the directory's, or already exported
+            print(e)
+            exit(1)
+        if last < first and packets == 0:
+            print("Nothing new to export")
+        elif last < first: # Only packets committed after an earlier export passed them
+            print("Nothing new to export; exported {} packets, {} hops missed before".format(packets, hops))
+        else:
+            print("Exported pids {} to {}: {} packets, {} hops".format(first, last, packets, hops))
+    else: # Catch up the summary tables (e.g. from cron, if the collector doesn't)
+        print(str(aprsaggregate.AggregateRefresher(conn, 0, config.getfloat('ingest', 'live_window_s', fallback=3600)).refresh(args.rebuild)) + " packets counted")
+    conn.close()
+    return True
+
+def serve_live(config):
+    """
+    Start serving the live station table, if a [live] port is set
+    config: configparser.ConfigParser
+    returns: aprslive.LiveTable for the collector to update, or None
+    """
+    if config.getint('live', 'port', fallback=0) <= 0:
+        return None
+    live = aprslive.LiveTable(config.getfloat('live', 'ttl_s', fallback=3600))
+    live.serve(config.getint('live', 'port'), config.get('live', 'address', fallback='127.0.0.1'))
+    return live
+
+def main(argv):
+    """
+    Run aprsdb.py: a maintenance command, an off-line load, or the collector reading Direwolf output from stdin
+    argv: command-line arguments, without the program name
+    """
+    args = make_parser().parse_args(argv)
+    config = read_config(args.config)
+    if maintain(args, config):
+        exit(0)
+
+    if args.kiss is not None: # Several receivers, each with its own station and session, sharing a pool of writers
+        try:
+            collector = aprskiss.from_config(config, args.kiss or None, lambda rxinfo, receiver, clock_offset: Ingester(config, args.batch_size, args.batch_ms,
+                    args.server_insert, args.metrics, args.clock_offset if args.clock_offset is not None else clock_offset, rxinfo, receiver))
+        except KeyError as e: # Receiver not in the config
+            print("No [receiver {}] section in the config".format(e.args[0]))
+            exit(1)
+        except RuntimeError as e: # Schema needs migrating
+            print(e)
+            exit(1)
+        collector.start()
+        print("Connection OK")
+        metrics = collector.writers[0].metrics
+        if metrics is not None and config.getint('metrics', 'port', fallback=0) > 0:
+            metrics.serve(config.getint('metrics', 'port'), config.get('metrics', 'address', fallback='127.0.0.1'))
+        live = serve_live(config)
+        for writer in collector.writers: # One table for every receiver
+            writer.live = live
+        collector.run()
+        collector.writers[0].print_stats()
+        exit(0)
+
+    ingester = Ingester(config, args.batch_size, args.batch_ms, args.server_insert, args.metrics, args.clock_offset)
+    try:
+        ingester.connect()
+    except RuntimeError as e: # Schema needs migrating
+        print(e)
+        exit(1)
+    print("Connection OK")
+    metrics = ingester.metrics
+    if metrics is not None and config.getint('metrics', 'port', fallback=0) > 0:
+        metrics.serve(config.getint('metrics', 'port'), config.get('metrics', 'address', fallback='127.0.0.1'))
+
+    if args.bulk is not None: # Off-line bulk load instead of reading stdin
+        ingester.bulk_load(args.bulk, config.getint('ingest', 'bulk_chunk', fallback=10000), config.getboolean('ingest', 'bulk_drop_indexes', fallback=True))
+        exit(0)
+    if args.replay is not None: # Off-line replay, parsing on several cores
+        jobs = args.jobs or config.getint('ingest', 'replay_jobs', fallback=0) or None
+        stats = ingester.replay(args.replay, jobs, config.getint('ingest', 'replay_chunk_kb', fallback=4096)*1024, config.getint('ingest', 'pipeline_report_s', fallback=60))
+        print(stats.report())
+        if metrics is not None:
+            print(metrics.report())
+            metrics.write()
+        exit(0)
+    ingester.live = serve_live(config)
+    ingester.start_gps()
+    spool_path = args.spool or config.get('spool', 'path', fallback='')
+    if spool_path != '':
+        ingester.run_spool(spool_path, config.getint('spool', 'chunk', fallback=500), config.getfloat('spool', 'retry_max_s', fallback=60),
+                config.get('spool', 'synchronous', fallback='NORMAL'))
+    elif args.pipeline or config.getboolean('ingest', 'pipeline', fallback=False):
+        ingester.run_pipeline(config.getint('ingest', 'queue_size', fallback=1000), config.getint('ingest', 'pipeline_report_s', fallback=60))
+    else:
+        ingester.run_stdin(config.getint('ingest', 'queue_size', fallback=1000))
+    ingester.finish()
+
+if __name__ == "__main__": # Program is running directly
+    main(sys.argv[1:])
@@ -0,0 +1,206 @@
+# aprsdirewolf.py
+# Decoding of Direwolf/kissutil output lines for aprsdb (no database access)
+
+import calendar, datetime, time, re # Time and regex
+
+DEFAULT_FORMAT = '%Y%m%d_%H%M%S' # kissutil -T format matching the [0 YYYYMMDD_hhmmss] headers
+
+# Direwolf header: [channel timestamp] packet (the timestamp is optional)
+header_re = re.compile(r"^\[([0-9]*) *([^\]\n]*)\] (.*)")
+hex_re = re.compile(r"<0x([0-9A-Fa-f]{2})>")
+hex_chars = {"{:02x}".format(i): (chr(i) if i != 0 else "") for i in range(256)} # Lower-case hex code: character
+
+# strftime directives the timestamp decoder reads with a regex: (group name, pattern)
+directives = {'Y':('Y', r'\d{4}'), 'y':('y', r'\d{2}'), 'm':('m', r'\d{1,2}'), 'd':('d', r'\d{1,2}'), 'j':('j', r'\d{1,3}'),
+        'H':('H', r'\d{1,2}'), 'M':('M', r'\d{1,2}'), 'S':('S', r'\d{1,2}'), 'f':('f', r'\d{1,6}'),
+        'z':('z', r'Z|[+-]\d{2}:?\d{2}'), 'Z':('Z', r'[A-Za-z]+'), 's':('s', r'\d+(?:\.\d*)?')}
+
+class LineDecoder:
+    """Decode Direwolf/kissutil output lines into (channel, epoch, packet).
+    Timestamps are read with the strftime format given to kissutil -T (the [direwolf]
+    timestamp_format config key).  They are local time, as kissutil prints them, unless
+    the format has %z, %Z reading UTC/GMT, or %s (seconds since 1970).  Formats without
+    a date take today's.  The format is compiled into one regex, so common formats never
+    go through strptime, and local UTC offsets are cached by the hour.  offset (seconds,
+    as in sessions.session_offset) is added to every timestamp, to correct a receiver
+    clock known to be wrong.
+    """
+
+    def __init__(self, timestamp_format=DEFAULT_FORMAT, offset=0.0):
+        """
+        timestamp_format: strftime format of the timestamps
+        offset: seconds added to each timestamp
+        """
+        self.timestamp_format = timestamp_format
+        self.offset = offset
+        self.fields = set()
+        pattern = ''
+        for (i, piece) in enumerate(re.split(r'(%.)', timestamp_format)):
+            if i % 2 == 0: # Literal text
+                pattern += re.escape(piece)
+            elif piece == '%%':
+                pattern += '%'
+            elif piece[1] in directives and directives[piece[1]][0] not in self.fields:
+                (name, regex) = directives[piece[1]]
+                pattern += '(?P<{}>{})'.format(name, regex)
+                self.fields.add(name)
+            else: # Something only strptime can read
+                self.fields = None
+                break
+        self.timestamp_re = re.compile('^' + pattern + '$') if self.fields is not None else None
+        self.utc_offsets = {} # Hour of a local time (as seconds since 1970, read as UTC) // 3600: UTC offset
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['utc_offsets'] = {} # Each process works its own out
+        return state
+
+    def local_offset(self, naive):
+        """
+        naive: local time as seconds since 1970, as if it were UTC
+        returns: that local time's UTC offset, in seconds
+        """
+        hour = int(naive // 3600)
+        utc_offset = self.utc_offsets.get(hour)
+        if utc_offset is None:
+            t = hour*3600
+            utc_offset = t - time.mktime(time.gmtime(t)[:8] + (-1,))
+            self.utc_offsets[hour] = utc_offset
+        return utc_offset
+
+    def timestamp(self, text):
+        """
+        Read a timestamp
+        text: timestamp text from a Direwolf header
+        returns: seconds since 1970 (offset applied), or None if it doesn't match the format
+        """
+        if self.timestamp_re is None:
+            return self._strptime(text)
+        m = self.timestamp_re.match(text)
+        if m is None:
+            return None
+        v = m.groupdict()
+        if 's' in v:
+            return float(v['s']) + self.offset if '.' in v['s'] else int(v['s']) + self.offset
+        if 'Y' in v:
+            year = int(v['Y'])
+        elif 'y' in v:
+            year = 2000 + int(v['y']) if int(v['y']) < 69 else 1900 + int(v['y'])
+        else:
+            year = None
+        if year is None or ('m' not in v and 'j' not in v):
+            today = time.localtime()
+            (year, month, day) = (year or today.tm_year, today.tm_mon, today.tm_mday)
+        elif 'j' in v:
+            (year, month, day) = (year, 1, int(v['j']))
+        else:
+            (month, day) = (int(v['m']), int(v.get('d', 1)))
+        try:
+            seconds = calendar.timegm((year, month, day, int(v.get('H', 0)), int(v.get('M', 0)), int(v.get('S', 0)), 0, 0, 0))
+        except (ValueError, OverflowError):
+            return None
+        if 'f' in v:
+            seconds += int(v['f'].ljust(6, '0'))/1e6
+        if 'z' in v:
+            if v['z'] != 'Z':
+                zone = v['z'].replace(':', '')
+                seconds -= (1 if zone[0] == '+' else -1)*(int(zone[1:3])*3600 + int(zone[3:5])*60)
+        elif v.get('Z', '').upper() not in ('UTC', 'GMT', 'Z'):
+            seconds -= self.local_offset(seconds)
+        return seconds + self.offset
+
+    def _strptime(self, text):
+        """Read a timestamp in a format the regex can't handle (see timestamp)"""
+        try:
+            when = datetime.datetime.strptime(text, self.timestamp_format)
+        except ValueError:
+            return None
+        if when.year == 1900 and '%Y' not in self.timestamp_format and '%y' not in self.timestamp_format:
+            when = datetime.datetime.combine(datetime.date.today(), when.time(), when.tzinfo)
+        return when.timestamp() + self.offset # Naive times are read as local time
+
+    def now(self):
+        """returns: receive time for a line without a timestamp (the current time, offset applied)"""
+        return time.time() + self.offset
+
+    def decode(self, line):
+        """Parse direwolf output, returning the packet and epoch timestamp (or None).
+        line: single line of Direwolf output, already unescaped (see direwolf_escape)
+        returns: (channel=None, epoch=None, packet)
+        """
+        m = header_re.match(line)
+        if m is None:
+            return(None, None, line.strip()) # Return the whole line
+        (channel, stamp, packet) = m.groups()
+        if channel == '': # No channel, so no header to speak of
+            return(None, None, packet.strip())
+        stamp = stamp.strip()
+        return(int(channel), self.timestamp(stamp) if stamp != '' else None, packet.strip())
+
+    def decode_block(self, lines):
+        """
+        Unescape and decode a block of raw lines in one pass (e.g. for bulk replays)
+        lines: list of lines of Direwolf output
+        returns: (channels, epochs, packets), lists with an entry per line (None where
+            the line has no channel or timestamp)
+        """
+        channels = []
+        epochs = []
+        packets = []
+        match = header_re.match
+        timestamp = self.timestamp
+        last = (None, None) # Consecutive lines often share a timestamp
+        for line in lines:
+            if '<0x' in line:
+                line = direwolf_escape(line)
+            m = match(line)
+            if m is None:
+                (channel, epoch, packet) = (None, None, line)
+            else:
+                (channel, epoch, packet) = m.groups()
+                if channel == '':
+                    (channel, epoch) = (None, None)
+                else:
+                    channel = int(channel)
+                    if epoch == '':
+                        epoch = None
+                    elif epoch == last[0]:
+                        epoch = last[1]
+                    else:
+                        last = (epoch, timestamp(epoch.strip()))
+                        epoch = last[1]
+            channels.append(channel)
+            epochs.append(epoch)
+            packets.append(packet.strip())
+        return(channels, epochs, packets)
+
+default_decoder = LineDecoder()
+
+def get_direwolf_timestamp(packet):
+    """
+    Parse the timestamp from a direwolf packet header (in the default format)
+    packet: the direwolf output line to decode
+    returns: seconds since 1970 (possibly fractional) or None
+    """
+    return(default_decoder.decode(packet)[1])
+
+def process_direwolf(line):
+    """Parse direwolf output (timestamps in the default format), returning the packet and epoch timestamp (or None).
+    line: single line of raw Direwolf output
+    returns: (channel=None, epoch=None, packet)
+    """
+    return(default_decoder.decode(line))
+
+def hex_replace(matchobj):
+    """Replacement formula for doing regex of non-printing ASCII characters
+    matchobj: an re.match object, which should be a two-digit hex code
+    returns: the character corresponding to the two-digit hex code, or null string
+    """
+    return(hex_chars[matchobj.group(1).lower()])
+
+def direwolf_escape(text):
+    """Escapes direwolf non-printable characters"""
+    if '<0x' not in text: # Nearly every line
+        return(text)
+    # Use the hex_replace function to determine how to substitute the matched text (i.e. non-printing ASCII)
+    return(hex_re.sub(hex_replace, text))
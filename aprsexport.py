@@ -0,0 +1,227 @@
+# aprsexport.py
+# Columnar (Parquet or Arrow IPC) export of packet history for offline analysis, partitioned by day
+
+import argparse, datetime, json, os, sys, time
+import pyarrow # Columnar arrays and files
+import pyarrow.compute
+import pyarrow.dataset
+import pyarrow.ipc
+import pyarrow.parquet
+import aprssettle # Which pids are complete
+
+STATE_FILE = 'export_state.json' # Last exported pid, and a log of the exports, in the export directory
+NULL_DAY = '__HIVE_DEFAULT_PARTITION__' # Directory for rows without an rxtime (what pyarrow reads back as a null day)
+
+# One row per packet: common, with the receive location and (for position packets) the map entry and location
+PACKETS_SQL = """SELECT c.pid, c.rxtime, c.rxsession, c.src, c.dest, c.path, c.via, c.format, c.is_subpacket, c.raw,
+        c.rx_loc_id, rl.latitude, rl.longitude, m.lid, l.latitude, l.longitude, l.altitude, m.symbol, m.symbol_table, m.course, m.speed
+    FROM unnest(%s::bigint[], %s::bigint[]) AS g(after, upto)
+        INNER JOIN common AS c ON c.pid > g.after AND c.pid <= g.upto
+        LEFT JOIN location AS rl ON rl.lid=c.rx_loc_id
+        LEFT JOIN map_entry AS m ON m.pid=c.pid
+        LEFT JOIN location AS l ON l.lid=m.lid
+    ORDER BY c.pid;"""
+PACKETS_SCHEMA = pyarrow.schema([('pid', pyarrow.int64()), ('rxtime', pyarrow.float64()), ('rxsession', pyarrow.int64()),
+        ('src', pyarrow.string()), ('dest', pyarrow.string()), ('path', pyarrow.string()), ('via', pyarrow.string()),
+        ('format', pyarrow.string()), ('is_subpacket', pyarrow.bool_()), ('raw', pyarrow.string()),
+        ('rx_loc_id', pyarrow.int64()), ('rx_latitude', pyarrow.float64()), ('rx_longitude', pyarrow.float64()),
+        ('lid', pyarrow.int64()), ('latitude', pyarrow.float64()), ('longitude', pyarrow.float64()), ('altitude', pyarrow.float64()),
+        ('symbol', pyarrow.string()), ('symbol_table', pyarrow.string()), ('course', pyarrow.float64()), ('speed', pyarrow.float64())])
+
+# One row per hop: paths, with the route's calls and the digipeaters' locations (null for calls that aren't digis)
+HOPS_SQL = """SELECT p.pid, c.rxtime, p.hop, p.route_id, r.src, r.dest, ST_Y(ds.loc), ST_X(ds.loc), ST_Y(dd.loc), ST_X(dd.loc)
+    FROM unnest(%s::bigint[], %s::bigint[]) AS g(after, upto)
+        INNER JOIN paths AS p ON p.pid > g.after AND p.pid <= g.upto
+        INNER JOIN common AS c ON c.pid=p.pid
+        INNER JOIN routes AS r ON r.route_id=p.route_id
+        LEFT JOIN digis AS ds ON ds.call=r.src
+        LEFT JOIN digis AS dd ON dd.call=r.dest
+    ORDER BY p.pid, p.hop;"""
+HOPS_SCHEMA = pyarrow.schema([('pid', pyarrow.int64()), ('rxtime', pyarrow.float64()), ('hop', pyarrow.int32()), ('route_id', pyarrow.int32()),
+        ('src', pyarrow.string()), ('dest', pyarrow.string()), ('src_latitude', pyarrow.float64()), ('src_longitude', pyarrow.float64()),
+        ('dest_latitude', pyarrow.float64()), ('dest_longitude', pyarrow.float64())])
+
+DATASETS = [('packets', PACKETS_SQL, PACKETS_SCHEMA), ('hops', HOPS_SQL, HOPS_SCHEMA)]
+FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+def read_state(directory):
+    """
+    directory: export directory
+    returns: its export state, {'last_pid', 'format', 'exports', 'gaps'} (last_pid 0 before the first export;
+        gaps are the [after, upto, first missed utc_s] pid runs that were missing, to look in again)
+    """
+    try:
+        with open(os.path.join(directory, STATE_FILE)) as f:
+            return(json.load(f))
+    except FileNotFoundError:
+        return({'last_pid': 0, 'format': None, 'exports': [], 'gaps': []})
+
+def write_state(directory, state):
+    """Replace the export state, all at once"""
+    path = os.path.join(directory, STATE_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+def day_name(day):
+    """
+    day: days since 1970 (UTC), or None
+    returns: partition directory name, e.g. day=2024-05-01
+    """
+    if day is None:
+        return('day=' + NULL_DAY)
+    return('day=' + (datetime.date(1970, 1, 1) + datetime.timedelta(days=day)).isoformat())
+
+class DayWriter:
+    """Write one dataset's rows to a file per day (each a new part of that day's partition).
+    Files are written under a hidden temporary name and only renamed into place by close(),
+    so an interrupted export leaves nothing a reader would pick up.
+    """
+
+    def __init__(self, directory, dataset, schema, part, file_format='parquet', compression='zstd'):
+        """
+        directory: export directory
+        dataset: dataset name (its subdirectory)
+        schema: pyarrow.Schema of the rows
+        part: name of this export's file in each day's directory (e.g. from its first pid)
+        file_format: parquet or arrow (Arrow IPC file)
+        compression: codec (e.g. zstd, lz4, snappy for Parquet, or none)
+        """
+        self.path = os.path.join(directory, dataset)
+        self.schema = schema
+        self.part = part + FORMATS[file_format]
+        self.file_format = file_format
+        self.compression = None if compression in ('', 'none') else compression
+        self.writers = {} # day: (writer, temporary path, final path)
+        self.rows = 0
+
+    def _open(self, day):
+        """Start the file for a day"""
+        path = os.path.join(self.path, day_name(day))
+        os.makedirs(path, exist_ok=True)
+        (final, temporary) = (os.path.join(path, self.part), os.path.join(path, '.' + self.part + '.tmp'))
+        if self.file_format == 'parquet':
+            writer = pyarrow.parquet.ParquetWriter(temporary, self.schema, compression=self.compression or 'none')
+        else:
+            writer = pyarrow.ipc.new_file(temporary, self.schema, options=pyarrow.ipc.IpcWriteOptions(compression=self.compression))
+        self.writers[day] = (writer, temporary, final)
+        return writer
+
+    def write(self, rows):
+        """
+        Add a chunk of rows, split by day
+        rows: list of tuples in schema order (rxtime second)
+        """
+        if rows == []:
+            return
+        table = pyarrow.Table.from_arrays([pyarrow.array(column, type=field.type) for (column, field) in zip(zip(*rows), self.schema)], schema=self.schema)
+        days = pyarrow.compute.cast(pyarrow.compute.floor(pyarrow.compute.divide(table.column('rxtime'), 86400.0)), pyarrow.int32())
+        found = pyarrow.compute.unique(days).to_pylist()
+        for day in found:
+            if len(found) == 1: # Whole chunk on one day (the usual case)
+                part = table
+            elif day is None:
+                part = table.filter(pyarrow.compute.is_null(days))
+            else:
+                part = table.filter(pyarrow.compute.equal(days, day))
+            writer = self.writers[day][0] if day in self.writers else self._open(day)
+            writer.write_table(part)
+        self.rows += len(rows)
+
+    def close(self):
+        """Finish every file and move them into place
+        returns: number of days written"""
+        for (writer, temporary, final) in self.writers.values():
+            writer.close()
+            os.replace(temporary, final)
+        return len(self.writers)
+
+def export(conn, directory, file_format='parquet', compression='zstd', chunk=50000, since_pid=None, settle_s=aprssettle.SETTLE_S):
+    """
+    Export packets (and their hops) added since the last export to day-partitioned columnar files
+    Rows are streamed from server-side cursors, chunk rows at a time, in one read-only
+    snapshot, so packets and hops agree.  Each export adds one file per dataset and day,
+    e.g. packets/day=2024-05-01/<first pid>-<export number>.parquet, readable as a hive-partitioned dataset.
+    It stops before the first packet received within settle_s (which may not have its position and
+    hops yet), and pids missing below that (e.g. a --kiss writer's or a --bulk load's, not yet
+    committed) are looked for again by later exports, so each packet is exported once, complete.
+    conn: psycopg2 database connection (only read from)
+    directory: export directory (created if needed)
+    file_format: parquet or arrow
+    compression: codec for the files
+    chunk: rows fetched (and written as a row group or record batch) at a time
+    since_pid: export packets after this pid instead of after the last export's (not below it, for a directory already exported to)
+    settle_s: seconds since a packet was received before it is exported
+    returns: (first pid, last pid, packets, hops) exported, the packets and hops including any that were missing before
+    raises: ValueError for an unknown format or one the directory wasn't exported in, or a since_pid already exported
+    """
+    if file_format not in FORMATS:
+        raise ValueError("Unknown export format {} (parquet or arrow)".format(file_format))
+    os.makedirs(directory, exist_ok=True)
+    state = read_state(directory)
+    if state['format'] not in (None, file_format):
+        raise ValueError("{} holds a {} export; export {} files elsewhere".format(directory, state['format'], file_format))
+    if since_pid is not None and since_pid < state['last_pid']: # Its rows would be exported again, next to the earlier files
+        raise ValueError("{} is already exported through pid {}; export from pid {} to an empty directory".format(directory, state['last_pid'], since_pid))
+    from_pid = state['last_pid'] if since_pid is None else since_pid
+    gaps = state.get('gaps', [])
+    start = time.time()
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    try:
+        cur = conn.cursor()
+        to_pid = aprssettle.settled_pid(cur, from_pid, settle_s)
+        ranges = aprssettle.pid_ranges(gaps, from_pid, to_pid)
+        counts = []
+        for (dataset, query, schema) in DATASETS:
+            writer = DayWriter(directory, dataset, schema, '{:012d}-{:06d}'.format(from_pid + 1, len(state['exports']) + 1), file_format, compression)
+            named = conn.cursor(name='aprsdb_export_' + dataset) # Server-side: rows arrive a chunk at a time
+            named.itersize = chunk
+            named.execute(query, ranges)
+            while True:
+                rows = named.fetchmany(chunk)
+                if rows == []:
+                    break
+                writer.write(rows)
+            named.close()
+            writer.close()
+            counts.append(writer.rows)
+        state['gaps'] = aprssettle.find_gaps(cur, gaps, from_pid, to_pid)
+        conn.rollback() # End the snapshot
+    finally:
+        conn.set_session(isolation_level='DEFAULT', readonly=False)
+    if to_pid > from_pid or counts[0] > 0 or state['gaps'] != gaps:
+        state['last_pid'] = max(to_pid, state['last_pid'])
+        state['format'] = file_format
+        if to_pid > from_pid or counts[0] > 0:
+            state['exports'].append({'from_pid': from_pid, 'to_pid': to_pid, 'packets': counts[0], 'hops': counts[1],
+                'exported_utc_s': start, 'elapsed_s': round(time.time() - start, 3)})
+        write_state(directory, state)
+    return(from_pid + 1, to_pid, counts[0], counts[1])
+
+def summary(directory):
+    """
+    Read an export back, as an analyst would (e.g. pyarrow.dataset, or pandas.read_parquet)
+    directory: export directory
+    returns: {dataset: {day: rows}}
+    """
+    state = read_state(directory)
+    found = {}
+    for (dataset, query, schema) in DATASETS:
+        path = os.path.join(directory, dataset)
+        if not os.path.isdir(path):
+            continue
+        data = pyarrow.dataset.dataset(path, format='ipc' if state['format'] == 'arrow' else 'parquet', partitioning='hive')
+        days = data.to_table(columns=['day']).column('day')
+        found[dataset] = {x['values']: x['counts'] for x in pyarrow.compute.value_counts(days).to_pylist()}
+    return(found)
+
+if __name__ == "__main__": # Summarize an export directory
+    parser = argparse.ArgumentParser(description='Summarize an aprsdb export directory (rows per dataset and day)')
+    parser.add_argument('directory', help='Export directory (see aprsdb.py --export)')
+    args = parser.parse_args(sys.argv[1:])
+    state = read_state(args.directory)
+    print("Exported through pid {} ({} exports, {} files; {} runs of missing pids to look in again)".format(state['last_pid'], len(state['exports']),
+        state['format'], len(state.get('gaps', []))))
+    for (dataset, days) in summary(args.directory).items():
+        for day in sorted(days, key=str):
+            print("{} {}: {} rows".format(dataset, day, days[day]))
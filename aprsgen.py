@@ -0,0 +1,239 @@
+#! /usr/bin/python
+
+# aprsgen.py
+# Synthetic APRS traffic in Direwolf/kissutil output framing, for benchmarks and replays
+
+import argparse, datetime, math, random, sys
+
+FORMATS = ['uncompressed', 'compressed', 'mic_e', 'object', 'wx', 'status', 'message', 'telemetry', 'thirdparty']
+DEFAULT_MIX = {'uncompressed':30, 'compressed':10, 'mic_e':20, 'object':5, 'wx':10, 'status':8, 'message':7, 'telemetry':5, 'thirdparty':5}
+TIMESTAMP_FORMAT = '%Y%m%d_%H%M%S' # Matches the [0 YYYYMMDD_hhmmss] header aprsdb reads
+
+def base91(value, width):
+    """
+    Encode a non-negative integer in APRS base-91
+    value: integer to encode
+    width: number of characters
+    returns: encoded string
+    """
+    chars = []
+    for i in range(width):
+        chars.append(chr(value % 91 + 33))
+        value //= 91
+    return(''.join(reversed(chars)))
+
+def latitude_text(latitude):
+    """returns: latitude as DDMM.mmN/S"""
+    hemisphere = 'N' if latitude >= 0 else 'S'
+    minutes = round(abs(latitude)*60, 2)
+    return("{:02d}{:05.2f}{}".format(int(minutes//60), minutes % 60, hemisphere))
+
+def longitude_text(longitude):
+    """returns: longitude as DDDMM.mmE/W"""
+    hemisphere = 'E' if longitude >= 0 else 'W'
+    minutes = round(abs(longitude)*60, 2)
+    return("{:03d}{:05.2f}{}".format(int(minutes//60), minutes % 60, hemisphere))
+
+class Station:
+    """A synthetic station: callsign, symbol, and a position that wanders a little"""
+
+    def __init__(self, call, symbol, symbol_table, latitude, longitude):
+        self.call = call
+        self.symbol = symbol
+        self.symbol_table = symbol_table
+        self.latitude = latitude
+        self.longitude = longitude
+
+    def position(self):
+        """returns: uncompressed position, table, and symbol (e.g. 4500.00N/09300.00W>)"""
+        return(latitude_text(self.latitude) + self.symbol_table + longitude_text(self.longitude) + self.symbol)
+
+    def compressed(self, course, speed):
+        """returns: compressed position with course and speed"""
+        y = int(round(380926*(90 - self.latitude)))
+        x = int(round(190463*(180 + self.longitude)))
+        cs = chr(course//4 + 33) + chr(int(round(math.log(speed + 1)/math.log(1.08))) + 33)
+        return(self.symbol_table + base91(y, 4) + base91(x, 4) + self.symbol + cs + 'G')
+
+    def mic_e(self, course, speed):
+        """
+        Encode the position as Mic-E (northern/western hemispheres, 10-99 degrees west)
+        returns: (destination, information field)
+        """
+        minutes = int(round(abs(self.latitude)*6000)) # Hundredths of minutes
+        digits = "{:02d}{:02d}{:02d}".format(minutes//6000, (minutes//100) % 60, minutes % 100)
+        flags = [True, True, True, self.latitude >= 0, False, self.longitude < 0] # Message bits 111 (En route), N, +0, W
+        dest = ''.join(chr(ord(d) - ord('0') + ord('P')) if flag else d for (d, flag) in zip(digits, flags))
+        minutes = int(round(abs(self.longitude)*6000))
+        (deg, mins, hundredths) = (minutes//6000, (minutes//100) % 60, minutes % 100)
+        info = '`' + chr(deg + 28) + chr((mins if mins >= 10 else mins + 60) + 28) + chr(hundredths + 28)
+        info += chr(speed//10 + 28) + chr((speed % 10)*10 + course//100 + 28) + chr(course % 100 + 28)
+        return(dest, info + self.symbol + self.symbol_table)
+
+    def wander(self, rng):
+        """Move the station a short distance"""
+        self.latitude = min(max(self.latitude + rng.uniform(-0.01, 0.01), 10.5), 89.5)
+        self.longitude = min(max(self.longitude + rng.uniform(-0.01, 0.01), -99.5), -10.5)
+
+class Generator:
+    """Deterministic stream of synthetic APRS packets heard through a set of digipeaters"""
+
+    def __init__(self, seed=1, stations=200, digis=20, path_depth=3, mix=None, dup_rate=0.1,
+            start=None, rate=5.0, timestamp_format=TIMESTAMP_FORMAT, channel=0, latitude=45.0, longitude=-93.0):
+        """
+        seed: random seed (same seed, same traffic)
+        stations: number of distinct non-digi stations
+        digis: number of digipeaters (and igates)
+        path_depth: most digis a packet has been through
+        mix: dictionary of format:weight (default DEFAULT_MIX)
+        dup_rate: fraction of packets that are heard again through another digi
+        start: datetime of the first packet (default 2024-05-01 12:00 UTC)
+        rate: packets per second of simulated time
+        timestamp_format: strftime format for the Direwolf header, or None for no timestamps
+        channel: radio channel in the Direwolf header
+        latitude, longitude: center of the simulated area (northern/western hemispheres)
+        """
+        self.rng = random.Random(seed)
+        self.path_depth = path_depth
+        self.mix = dict(mix or DEFAULT_MIX)
+        for name in self.mix:
+            if name not in FORMATS:
+                raise ValueError("Unknown packet format " + name)
+        self.dup_rate = dup_rate
+        self.time = start or datetime.datetime(2024, 5, 1, 12, 0, 0, tzinfo=datetime.timezone.utc)
+        self.step = datetime.timedelta(seconds=1.0/rate)
+        self.timestamp_format = timestamp_format
+        self.channel = channel
+        self.count = 0
+        place = lambda: (latitude + self.rng.uniform(-1, 1), longitude + self.rng.uniform(-1, 1))
+        self.digis = [Station(self._call(), self.rng.choice('#&'), '/', *place()) for i in range(digis)]
+        self.stations = [Station(self._call(), self.rng.choice('>-kv[<_'), '/', *place()) for i in range(stations)]
+        self.last = None # (format, packet) of the previous packet, for duplicates
+
+    def _call(self):
+        """returns: a random callsign, sometimes with an SSID"""
+        call = self.rng.choice('KNW') + self.rng.choice('0123456789') + ''.join(self.rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for i in range(3))
+        if self.rng.random() < 0.4:
+            call += '-' + str(self.rng.randint(1, 15))
+        return(call)
+
+    def _path(self, heard_via=None):
+        """
+        Build a digipeater path: digis used (last one flagged *), then unused WIDEn-N
+        heard_via: digi to make the last hop, or None to pick one
+        returns: path string, without the leading comma
+        """
+        depth = self.rng.randint(0, self.path_depth)
+        used = self.rng.sample(self.digis, min(depth, len(self.digis)))
+        if heard_via is not None:
+            used = [d for d in used if d is not heard_via][:max(depth - 1, 0)] + [heard_via]
+        path = [d.call for d in used]
+        if path != []:
+            path[-1] += '*'
+        remaining = max(self.path_depth - len(used), 0)
+        if remaining > 0 and self.rng.random() < 0.7:
+            path.append('WIDE{}-{}'.format(remaining, remaining))
+        return(','.join(path))
+
+    def _body(self, kind, station):
+        """
+        Build the destination and information field for one packet
+        kind: packet format (see FORMATS)
+        station: sending Station
+        returns: (destination, information field)
+        """
+        rng = self.rng
+        course = rng.randint(1, 360)
+        speed = rng.randint(0, 60)
+        ddhhmm = self.time.strftime('%d%H%M') + 'z'
+        if kind == 'uncompressed':
+            return('APRS', rng.choice('!=') + station.position() + '{:03d}/{:03d}'.format(course, speed) + ' mobile ' + str(rng.randint(1, 999)))
+        if kind == 'compressed':
+            return('APRS', '=' + station.compressed(course, speed) + 'compressed')
+        if kind == 'mic_e':
+            (dest, info) = station.mic_e(course, speed)
+            return(dest, info + rng.choice(['', ' mic-e comment', '>', ']=']))
+        if kind == 'object':
+            name = 'OBJ' + str(rng.randint(0, 99)).ljust(6)
+            return('APRS', ';' + name + rng.choice('*_') + ddhhmm + station.position() + 'object ' + str(rng.randint(1, 99)))
+        if kind == 'wx':
+            return('APRS', '@' + ddhhmm + latitude_text(station.latitude) + '/' + longitude_text(station.longitude) +
+                    '_{:03d}/{:03d}g{:03d}t{:03d}r{:03d}p{:03d}P{:03d}h{:02d}b{:05d}'.format(
+                    course, speed % 30, speed % 30 + 5, rng.randint(-10, 100), 0, rng.randint(0, 20), rng.randint(0, 20), rng.randint(10, 99), rng.randint(9800, 10300)))
+        if kind == 'status':
+            return('APRS', '>' + rng.choice(['On the air', 'Net tonight 8pm', 'Monitoring 146.52', 'QRV']))
+        if kind == 'message':
+            to = rng.choice(self.stations).call
+            return('APRS', ':' + to.ljust(9) + ':' + rng.choice(['hello', 'ack', 'QSL?', 'see you at the net']) + '{' + str(rng.randint(1, 99)))
+        if kind == 'telemetry':
+            label = rng.choice(['PARM.Volts,Temp,Light', 'UNIT.V,degF,lux', 'EQNS.0,0.1,0,0,1,-50,0,1,0', 'BITS.11111111,Weather station'])
+            return('APRS', ':' + station.call.ljust(9) + ':' + label)
+        if kind == 'thirdparty':
+            inner = rng.choice(['uncompressed', 'status', 'message', 'object'])
+            (dest, info) = self._body(inner, rng.choice(self.stations))
+            igate = rng.choice(self.digis)
+            return('APRS', '}' + rng.choice(self.stations).call + '>' + dest + ',TCPIP,' + igate.call + '*:' + info)
+
+    def _header(self):
+        """returns: Direwolf header, e.g. [0 20240501_120000]"""
+        if self.timestamp_format is None:
+            return('[{}]'.format(self.channel))
+        return('[{} {}]'.format(self.channel, self.time.strftime(self.timestamp_format)))
+
+    def packet(self):
+        """
+        Generate the next packet
+        returns: (format, Direwolf output line)
+        """
+        self.time += self.step
+        self.count += 1
+        if self.last is not None and self.rng.random() < self.dup_rate:
+            # The same frame again, heard through another digi
+            (kind, src, dest, info) = self.last
+            self.last = None
+            return(kind, self._header() + ' ' + src + '>' + dest + ',' + self._path(self.rng.choice(self.digis)) + ':' + info)
+        kind = self.rng.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        station = self.rng.choice(self.digis if kind == 'thirdparty' or self.rng.random() < 0.1 else self.stations)
+        station.wander(self.rng)
+        (dest, info) = self._body(kind, station)
+        self.last = (kind, station.call, dest, info)
+        path = self._path()
+        return(kind, self._header() + ' ' + station.call + '>' + dest + (',' + path if path != '' else '') + ':' + info)
+
+    def packets(self, count):
+        """Generate count packets, as (format, line) pairs"""
+        for i in range(count):
+            yield self.packet()
+
+def parse_mix(text):
+    """
+    Parse a format mix from the command line
+    text: e.g. uncompressed=30,mic_e=20
+    returns: dictionary of format:weight
+    """
+    mix = {}
+    for item in text.split(','):
+        (name, weight) = item.split('=')
+        mix[name.strip()] = float(weight)
+    return(mix)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Write synthetic APRS traffic in Direwolf/kissutil output format')
+    parser.add_argument('-n', '--count', type=int, default=1000, help='Number of packets')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    parser.add_argument('--stations', type=int, default=200, help='Number of distinct stations')
+    parser.add_argument('--digis', type=int, default=20, help='Number of digipeaters')
+    parser.add_argument('--path-depth', type=int, default=3, help='Most digipeaters in a path')
+    parser.add_argument('--mix', type=parse_mix, help='Format weights, e.g. uncompressed=30,mic_e=20 (formats: ' + ', '.join(FORMATS) + ')')
+    parser.add_argument('--dup-rate', type=float, default=0.1, help='Fraction of packets heard again through another digi')
+    parser.add_argument('--rate', type=float, default=5.0, help='Packets per second of simulated time')
+    parser.add_argument('--timestamp-format', default=TIMESTAMP_FORMAT, help='strftime format for the Direwolf timestamp')
+    parser.add_argument('--no-timestamps', action='store_true', help='Leave the timestamp out of the Direwolf header')
+    args = parser.parse_args(argv)
+    generator = Generator(args.seed, args.stations, args.digis, args.path_depth, args.mix, args.dup_rate,
+            rate=args.rate, timestamp_format=None if args.no_timestamps else args.timestamp_format)
+    for (kind, line) in generator.packets(args.count):
+        print(line)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,18 @@
+# aprsgeom.py
+# Client-side PostGIS geometry encoding for aprsdb
+
+import struct
+
+WGS84 = 4326 # SRID for latitude/longitude
+EWKB_POINT = 0x20000001 # WKB point type with the EWKB "has SRID" flag
+
+def point_ewkb(longitude, latitude, srid=WGS84):
+    """
+    Encode a point as hex EWKB, the form PostGIS prints geometries in and accepts as input
+    Gives the same value as SELECT ST_SetSRID(ST_MakePoint(longitude, latitude), srid)
+    longitude: decimal degrees (anything float() accepts)
+    latitude: decimal degrees (anything float() accepts)
+    srid: spatial reference id, WGS84 by default
+    returns: hex string, e.g. 0101000020E6100000...
+    """
+    return(struct.pack('<BIIdd', 1, EWKB_POINT, srid, float(longitude), float(latitude)).hex().upper())
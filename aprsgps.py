@@ -3,10 +3,186 @@
 
 import gpsd
 import decimal
+import argparse, collections, json, math, socketserver, sys, threading, time
+
+Fix = collections.namedtuple('Fix', ['latitude', 'longitude', 'rx_loc_id', 'utc_s']) # A published position
+
+def truncate(value):
+    """returns: value as a float truncated to DD.DDDD (about 10 m)"""
+    return(float(round(decimal.Decimal(value),4)))
 
 def getLoc2D():
     """Get 2D location (lat/long) from GPS
     returns: (latitude, longitude), DD.DDDD format (truncated) """
     gpsd.connect()
     myloc = gpsd.get_current()
-    return((float(round(decimal.Decimal(myloc.lat),4)),float(round(decimal.Decimal(myloc.lon),4))))
+    return((truncate(myloc.lat), truncate(myloc.lon)))
+
+def distance_m(lat1, lon1, lat2, lon2):
+    """returns: great-circle distance between two points, in meters"""
+    (p1, p2) = (math.radians(lat1), math.radians(lat2))
+    a = math.sin((p2 - p1)/2)**2 + math.cos(p1)*math.cos(p2)*math.sin(math.radians(lon2 - lon1)/2)**2
+    return(2*6371008.8*math.asin(math.sqrt(min(a, 1.0))))
+
+class PositionProvider:
+    """Keep a roving receive station's position current from gpsd, on a background thread.
+    The thread holds one gpsd connection (reconnecting if it drops), polls it every
+    interval_s seconds, and when the station has moved at least min_move_m meters,
+    records the new position with update() and publishes it as a new Fix.  The packet
+    path only reads the fix attribute, which is replaced whole and never modified, so
+    it needs no lock and never waits on the GPS or the database.
+    """
+
+    def __init__(self, update, interval_s=30, min_move_m=50, host='127.0.0.1', port=2947, retry_s=10):
+        """
+        update: function(latitude, longitude) storing a new position and returning its rx_loc_id;
+            called on the provider's thread, so it needs its own database connection
+        interval_s: seconds between gpsd polls
+        min_move_m: distance the station must move before a new position is stored
+        host, port: gpsd address
+        retry_s: seconds to wait before reconnecting after an error
+        """
+        self.update = update
+        self.interval_s = interval_s
+        self.min_move_m = min_move_m
+        self.host = host
+        self.port = port
+        self.retry_s = retry_s
+        self.fix = None # Latest Fix, or None before the first one
+        self.polls = 0
+        self.updates = 0
+        self.errors = 0
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='aprsdb-gps', daemon=True)
+
+    def start(self):
+        """Start polling on the background thread"""
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """Stop polling, waiting up to timeout seconds for the thread to finish"""
+        self.stopping.set()
+        self.thread.join(timeout)
+
+    def _run(self):
+        """Poll gpsd until stopped, reconnecting after errors"""
+        connected = False
+        while not self.stopping.is_set():
+            try:
+                if not connected:
+                    gpsd.connect(self.host, self.port)
+                    connected = True
+                self.poll()
+                wait = self.interval_s
+            except Exception as e: # Keep the collector running without GPS
+                print("GPS error: " + str(e)) # DEBUG
+                self.errors += 1
+                connected = False
+                wait = self.retry_s
+            self.stopping.wait(wait)
+
+    def poll(self):
+        """
+        Read the current position from gpsd (already connected), publishing it if the station moved
+        returns: True if a new fix was published
+        """
+        self.polls += 1
+        response = gpsd.get_current()
+        if response.mode < 2: # No fix yet
+            return False
+        (mylat, mylon) = (truncate(response.lat), truncate(response.lon))
+        fix = self.fix
+        if fix is not None and distance_m(fix.latitude, fix.longitude, mylat, mylon) < self.min_move_m:
+            return False
+        self.fix = Fix(mylat, mylon, self.update(mylat, mylon), time.time())
+        self.updates += 1
+        return True
+
+    def stats(self):
+        """returns: one-line summary of polls and position updates"""
+        return("gps: {} polls, {} position updates, {} errors, last fix {}".format(self.polls, self.updates, self.errors,
+            "none" if self.fix is None else "{:.4f}, {:.4f}".format(self.fix.latitude, self.fix.longitude)))
+
+class FakeGpsd(socketserver.ThreadingTCPServer):
+    """Local stand-in for gpsd, answering ?WATCH and ?POLL with a position that can be
+    moved (for trying the provider without a GPS).  Listens on a free port by default.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latitude=45.0, longitude=-93.0, mode=3, port=0):
+        """
+        latitude, longitude: initial position
+        mode: gpsd fix mode (0-1 no fix, 2 2D, 3 3D)
+        port: TCP port (0 for any free port, see .port)
+        """
+        self.latitude = latitude
+        self.longitude = longitude
+        self.mode = mode
+        self.connections = 0
+        self.polls = 0
+        super().__init__(('127.0.0.1', port), FakeGpsdHandler)
+        self.port = self.server_address[1]
+
+    def move(self, latitude, longitude, mode=None):
+        """Change the reported position (and fix mode, if given)"""
+        (self.latitude, self.longitude) = (latitude, longitude)
+        if mode is not None:
+            self.mode = mode
+
+    def start(self):
+        """Serve from a background thread"""
+        threading.Thread(target=self.serve_forever, name='fake-gpsd', daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class FakeGpsdHandler(socketserver.StreamRequestHandler):
+    """One client of FakeGpsd"""
+
+    def send(self, message):
+        self.wfile.write((json.dumps(message) + '\n').encode())
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        self.send({'class':'VERSION', 'release':'3.22', 'rev':'fake', 'proto_major':3, 'proto_minor':14})
+        for line in self.rfile:
+            command = line.decode().strip()
+            if command.startswith('?WATCH'):
+                self.send({'class':'DEVICES', 'devices':[{'class':'DEVICE', 'path':'/dev/fake', 'driver':'fake', 'bps':4800}]})
+                self.send({'class':'WATCH', 'enable':True, 'json':False})
+            elif command.startswith('?POLL'):
+                server.polls += 1
+                tpv = {'class':'TPV', 'mode':server.mode, 'time':time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())}
+                if server.mode >= 2:
+                    tpv.update({'lat':server.latitude, 'lon':server.longitude, 'track':0, 'speed':0})
+                self.send({'class':'POLL', 'time':tpv['time'], 'active':1, 'tpv':[tpv], 'sky':[{'class':'SKY', 'satellites':[]}]})
+
+if __name__ == "__main__": # Watch a gpsd (or a fake one, walking north) and print what the provider publishes
+    parser = argparse.ArgumentParser(description='Print the positions a PositionProvider publishes')
+    parser.add_argument('--host', default='127.0.0.1', help='gpsd host')
+    parser.add_argument('--port', type=int, default=2947, help='gpsd port')
+    parser.add_argument('--fake', action='store_true', help='Start a fake gpsd that moves 0.0005 degrees north per second')
+    parser.add_argument('--interval', type=float, default=1, help='Seconds between polls')
+    parser.add_argument('--min-move', type=float, default=50, help='Meters moved before publishing')
+    parser.add_argument('--seconds', type=float, default=10, help='How long to run')
+    args = parser.parse_args(sys.argv[1:])
+    fake = None
+    if args.fake:
+        fake = FakeGpsd()
+        fake.start()
+        args.port = fake.port
+    provider = PositionProvider(lambda lat, lon: print("update {:.4f}, {:.4f}".format(lat, lon)), args.interval, args.min_move, args.host, args.port)
+    provider.start()
+    start = time.time()
+    while time.time() - start < args.seconds:
+        time.sleep(1)
+        if fake is not None:
+            fake.move(fake.latitude + 0.0005, fake.longitude)
+    provider.stop()
+    print(provider.stats())
+    if fake is not None:
+        print("fake gpsd: {} connections, {} polls".format(fake.connections, fake.polls))
+        fake.stop()
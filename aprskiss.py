@@ -0,0 +1,558 @@
+# aprskiss.py
+# KISS-over-TCP collector: reads AX.25 frames from several receivers (e.g. Direwolf's KISS port),
+# keeping a receive station and session per receiver, and stores them with a shared pool of writers
+
+import argparse, codecs, copy, queue, socket, socketserver, sys, threading, time
+import aprspipeline # Metered queue between the readers and the writers
+import aprsspool # Lost-connection errors
+import psycopg2
+
+# KISS framing (see the KISS protocol spec): frame end, frame escape, and their transposed forms
+FEND = 0xC0
+FESC = 0xDB
+TFEND = 0xDC
+TFESC = 0xDD
+
+DEADLOCK_RETRIES = 3 # Times a batched packet is retried after losing a lock wait to another writer
+
+def byte_chars(error):
+    """Codec error handler: bytes that aren't valid UTF-8 become the characters of the same value,
+    as Direwolf's <0xNN> escapes for them do after aprsdirewolf.direwolf_escape"""
+    return(error.object[error.start:error.end].decode('latin-1'), error.end)
+
+codecs.register_error('aprskiss_byte_chars', byte_chars)
+
+def kiss_frame(data, port=0):
+    """
+    Wrap an AX.25 frame for sending over KISS
+    data: AX.25 frame (without FCS)
+    port: KISS port (the radio channel on a Direwolf KISS TCP port)
+    returns: KISS data frame, bytes
+    """
+    escaped = bytes(data).replace(bytes([FESC]), bytes([FESC, TFESC])).replace(bytes([FEND]), bytes([FESC, TFEND]))
+    return bytes([FEND, (port & 0x0F) << 4]) + escaped + bytes([FEND])
+
+class KissDecoder:
+    """Split a KISS byte stream into frames, however it arrives in pieces"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """
+        data: bytes received
+        returns: list of (port, command, frame) for each frame completed, with escapes undone
+        """
+        self.buffer += data
+        frames = []
+        while True:
+            end = self.buffer.find(FEND)
+            if end < 0:
+                break
+            raw = bytes(self.buffer[:end])
+            del self.buffer[:end+1]
+            if raw == b'': # Opening FEND, or back-to-back FENDs
+                continue
+            frame = raw[1:].replace(bytes([FESC, TFEND]), bytes([FEND])).replace(bytes([FESC, TFESC]), bytes([FESC]))
+            frames.append((raw[0] >> 4, raw[0] & 0x0F, frame))
+        return frames
+
+def decode_address(field):
+    """
+    Decode one 7-byte AX.25 address
+    field: bytes of the address
+    returns: (call with -SSID if non-zero, H/C bit, extension bit (last address))
+    """
+    call = ''.join(chr(b >> 1) for b in field[:6]).rstrip()
+    ssid = (field[6] >> 1) & 0x0F
+    if ssid != 0:
+        call += '-' + str(ssid)
+    return(call, bool(field[6] & 0x80), bool(field[6] & 0x01))
+
+def encode_address(call, last=False, h_bit=False):
+    """
+    Encode one AX.25 address
+    call: callsign, with -SSID if any
+    last: set the extension bit (last address of the header)
+    h_bit: set the has-been-repeated (or command) bit
+    returns: 7 bytes
+    """
+    (base, dash, ssid) = call.partition('-')
+    field = bytes((ord(c) << 1) & 0xFE for c in base.upper().ljust(6)[:6])
+    return field + bytes([0x60 | ((int(ssid or 0) & 0x0F) << 1) | (0x80 if h_bit else 0) | (0x01 if last else 0)])
+
+def ax25_to_tnc2(frame):
+    """
+    Decode an AX.25 UI frame into the TNC2 text Direwolf prints (SRC>DEST,DIGI1*,DIGI2:info),
+    with the last digipeater that has repeated it marked with *
+    frame: AX.25 frame from KISS (no FCS)
+    returns: packet text, or None if the frame isn't a valid UI frame
+    """
+    addresses = []
+    i = 0
+    while True:
+        if i + 7 > len(frame) or len(addresses) == 10:
+            return None
+        (call, h_bit, last) = decode_address(frame[i:i+7])
+        addresses.append((call, h_bit))
+        i += 7
+        if last:
+            break
+    if len(addresses) < 2 or i + 2 > len(frame) or frame[i] & 0xEF != 0x03: # UI, either poll/final
+        return None
+    digis = [call for (call, h_bit) in addresses[2:]]
+    repeated = [n for (n, (call, h_bit)) in enumerate(addresses[2:]) if h_bit]
+    if repeated != []:
+        digis[repeated[-1]] += '*'
+    # UTF-8, as the text Direwolf prints on stdin is; other bytes as the stdin path unescapes them (NULs dropped)
+    info = frame[i+2:].decode('utf-8', errors='aprskiss_byte_chars').replace('\x00', '')
+    return("{}>{}{}:{}".format(addresses[1][0], addresses[0][0], ''.join(',' + digi for digi in digis), info).strip())
+
+def tnc2_to_ax25(packet):
+    """
+    Encode TNC2 packet text (SRC>DEST,DIGI*,...:info) as an AX.25 UI frame, e.g. for FakeKiss
+    (the info as UTF-8, which ax25_to_tnc2 reads back unchanged)
+    packet: packet text
+    returns: AX.25 frame (no FCS)
+    """
+    (header, info) = packet.split(':', 1)
+    (src, route) = header.split('>', 1)
+    route = route.split(',')
+    digis = [call.rstrip('*') for call in route[1:]]
+    starred = [n for (n, call) in enumerate(route[1:]) if call.endswith('*')]
+    calls = [(route[0], False), (src, False)] + [(call, starred != [] and n <= starred[-1]) for (n, call) in enumerate(digis)]
+    frame = b''.join(encode_address(call, n == len(calls) - 1, h_bit) for (n, (call, h_bit)) in enumerate(calls))
+    return frame + bytes([0x03, 0xF0]) + info.encode('utf-8')
+
+class Receiver:
+    """One receive station: a KISS TCP endpoint, and optionally one channel on it.
+    Its Ingester (never used to write) holds the station's rxinfo, rx_loc_id, clock
+    offset, and session, which the writers store its packets under.
+    """
+
+    def __init__(self, name, host, port, channel, ingester):
+        """
+        name: receiver name (the [receiver NAME] config section, stored with its session)
+        host, port: KISS TCP endpoint
+        channel: KISS port (radio channel) to take frames from, or None for every channel
+        ingester: aprsdb.Ingester for the station, already connected once (session and rx_loc_id set),
+            or None to only stamp packets with the local clock (e.g. to watch an endpoint)
+        """
+        self.name = name
+        self.host = host
+        self.port = port
+        self.channel = channel
+        self.ingester = ingester
+        self.packets = 0
+
+    def now(self):
+        """returns: receive time for a frame arriving now (the station's clock offset applied)"""
+        if self.ingester is None:
+            return time.time()
+        return self.ingester.decoder.now()
+
+class KissClient:
+    """Read frames from one KISS TCP endpoint on a background thread, handing
+    (receiver, rxtime, packet) to the writers' queue.  Frames are stamped as they
+    arrive, and routed to the receiver for their channel.  A dropped or refused
+    connection is retried, waiting 1 s at first and doubling up to retry_max_s.
+    """
+
+    def __init__(self, host, port, receivers, out, retry_max_s=60):
+        """
+        host, port: KISS TCP endpoint
+        receivers: Receivers on this endpoint
+        out: queue the packets are put on
+        retry_max_s: longest wait between connection attempts, in seconds
+        """
+        self.host = host
+        self.port = port
+        self.receivers = {receiver.channel: receiver for receiver in receivers} # channel (or None for any): Receiver
+        self.out = out
+        self.retry_max_s = retry_max_s
+        self.frames = 0
+        self.ignored = 0 # Frames on channels no receiver takes
+        self.undecodable = 0 # Frames that aren't APRS-style UI frames
+        self.connects = 0
+        self.errors = 0
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='aprsdb-kiss-{}:{}'.format(host, port), daemon=True)
+
+    def start(self):
+        """Start reading on the background thread"""
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """Stop reading (frames already queued are still stored), waiting up to timeout seconds for the thread"""
+        self.stopping.set()
+        self.thread.join(timeout)
+
+    def _run(self):
+        """Read until stopped, reconnecting after errors"""
+        wait = 1.0
+        while not self.stopping.is_set():
+            try:
+                with socket.create_connection((self.host, self.port), timeout=10) as sock:
+                    sock.settimeout(1.0) # Check for stop() this often
+                    self.connects += 1
+                    wait = 1.0
+                    self.read(sock)
+            except OSError as e:
+                if self.stopping.is_set():
+                    break
+                print("KISS {}:{}: {}; retrying in {:.0f} s".format(self.host, self.port, str(e).strip() or type(e).__name__, wait)) # DEBUG
+                self.errors += 1
+                self.stopping.wait(wait)
+                wait = min(wait*2, self.retry_max_s)
+
+    def read(self, sock):
+        """
+        Queue the packets from a connected endpoint until it closes or stop() is called
+        sock: connected socket
+        raises: ConnectionError when the endpoint closes the connection
+        """
+        decoder = KissDecoder()
+        while not self.stopping.is_set():
+            try:
+                data = sock.recv(4096)
+            except socket.timeout:
+                continue
+            if data == b'':
+                raise ConnectionError("connection closed")
+            for (channel, command, frame) in decoder.feed(data):
+                if command != 0: # Only data frames carry packets
+                    continue
+                self.frames += 1
+                receiver = self.receivers.get(channel) or self.receivers.get(None)
+                if receiver is None:
+                    self.ignored += 1
+                    continue
+                packet = ax25_to_tnc2(frame)
+                if packet is None:
+                    self.undecodable += 1
+                    continue
+                receiver.packets += 1
+                item = (receiver, receiver.now(), packet)
+                while not self.stopping.is_set(): # Don't wait on a full queue forever if the writers have stopped
+                    try:
+                        self.out.put(item, timeout=1.0)
+                        break
+                    except queue.Full:
+                        continue
+
+    def stats(self):
+        """returns: one-line summary of frames read"""
+        return("kiss {}:{}: {} frames, {} ignored, {} undecodable, {} connects, {} errors".format(
+            self.host, self.port, self.frames, self.ignored, self.undecodable, self.connects, self.errors))
+
+class KissCollector:
+    """Store the packets of several receivers with a pool of writers.
+    Each KISS endpoint gets a reader thread (KissClient); the writers are connected
+    aprsdb.Ingesters, each on its own thread and connection, taking packets from one
+    shared queue and storing each under its receiver's station and session.  The
+    summary tables are refreshed here, between packets, with every writer paused and
+    its batch flushed, so no refresh sees a packet half written.  Each writer also drops
+    the rest of its reserved pids then, so packets stored after a refresh get pids above
+    every one committed before it (which readers following max(pid), e.g. --export, rely on).
+    """
+
+    def __init__(self, receivers, writers, queue_size=1000, retry_max_s=60, aggregate_s=10, report_s=60):
+        """
+        receivers: list of Receivers
+        writers: list of aprsdb.Ingesters (copies of a receiver's, so they share the session setup and schema)
+        queue_size: most packets waiting for a writer
+        retry_max_s: longest wait between KISS connection attempts, in seconds
+        aggregate_s: seconds between summary table refreshes (0: only at exit)
+        report_s: seconds between statistics reports (0 for none)
+        """
+        self.receivers = receivers
+        self.writers = writers
+        self.queue = aprspipeline.MeteredQueue('kiss', queue_size)
+        endpoints = {}
+        for receiver in receivers:
+            endpoints.setdefault((receiver.host, receiver.port), []).append(receiver)
+        self.clients = [KissClient(host, port, found, self.queue, retry_max_s) for ((host, port), found) in endpoints.items()]
+        self.aggregate_s = aggregate_s
+        self.report_s = report_s
+        self.locks = [threading.Lock() for writer in writers] # Held by each writer while it stores a packet
+        self.stored = [0 for writer in writers]
+        self.failed = 0
+        self.retried = 0 # Packets stored again after a deadlock with another writer
+        self.error = None # Exception that stopped a writer
+        self.stopping = threading.Event()
+        self.threads = [threading.Thread(target=self._write_loop, args=(n,), name='aprsdb-writer-{}'.format(n), daemon=True) for n in range(len(writers))]
+
+    def start(self):
+        """Connect the writers, and start the writer and reader threads"""
+        for writer in self.writers:
+            writer.metrics = self.writers[0].metrics # One set of metrics for the pool
+            writer.autocommit_lookups = len(self.writers) > 1 # Or the writers wait on each other's new digis and routes
+            writer.connect()
+            writer.aggregates.interval = 0 # Refreshed by the collector, with every writer paused
+        for thread in self.threads:
+            thread.start()
+        for client in self.clients:
+            client.start()
+
+    def _write_loop(self, n):
+        """Writer n: store queued packets until STOP"""
+        (writer, lock) = (self.writers[n], self.locks[n])
+        try:
+            while True:
+                try: # Wait for a packet, but not past a batch's deadline
+                    item = self.queue.get(timeout=writer.batch.timeout() if writer.batch is not None else None)
+                except queue.Empty:
+                    with lock:
+                        writer.flush()
+                    continue
+                if item is aprspipeline.STOP:
+                    break
+                (receiver, rxtime, packet) = item
+                with lock:
+                    self.store(writer, receiver, rxtime, packet)
+                self.stored[n] += 1
+            with lock:
+                writer.flush()
+        except BaseException as e: # Stop, and let run() report why
+            self.error = e
+            self.stopping.set()
+            try: # Release its locks, so the other writers can finish
+                writer.conn.rollback()
+            except psycopg2.Error:
+                pass
+
+    def store(self, writer, receiver, rxtime, packet):
+        """
+        Store one packet as heard by its receiver (on a writer's thread, holding its lock)
+        writer: aprsdb.Ingester
+        receiver: Receiver the packet came from
+        rxtime: time packet was received, as seconds since epoch
+        packet: APRS packet string
+        """
+        station = receiver.ingester
+        writer.switch_station(station.rxinfo, station.session_id)
+        attempts = 0
+        while True:
+            try:
+                writer.store_packet(writer.parse(packet), packet, rxtime)
+                return
+            except psycopg2.extensions.TransactionRollbackError as e: # Two writers adding the same new digi, route, or location
+                # A batched packet is undone back to its savepoint, so it can simply be stored again
+                if writer.batch is None or attempts >= DEADLOCK_RETRIES:
+                    error = e
+                    break
+                attempts += 1
+                self.retried += 1
+            except aprsspool.UNAVAILABLE:
+                raise # Database gone; stop rather than drop every packet
+            except Exception as e: # One bad packet mustn't stop the writer
+                error = e
+                break
+        print("Unable to store packet from {}: {}".format(receiver.name, str(error).strip())) # DEBUG
+        self.failed += 1
+        if writer.batch is None:
+            writer.rollback()
+        writer.record_error(packet, rxtime, str(error).strip()[:512])
+
+    def refresh(self):
+        """Pause every writer, write their batches, and refresh the summary tables"""
+        for lock in self.locks:
+            lock.acquire()
+        try:
+            for writer in self.writers:
+                writer.flush()
+                if writer.batch is not None: # Or it goes on using pids below ones other writers have committed
+                    writer.batch.release_pids()
+            self.writers[0].aggregates.refresh()
+        finally:
+            for lock in self.locks:
+                lock.release()
+
+    def run(self, seconds=None):
+        """
+        Collect (after start()) until stopped (stop(), Ctrl-C, or seconds elapsed), then store everything already received
+        seconds: how long to run (None for until stopped)
+        raises: the exception that stopped a writer, if any
+        """
+        start = last_refresh = last_report = time.monotonic()
+        try:
+            while not self.stopping.wait(1.0):
+                now = time.monotonic()
+                if seconds is not None and now - start >= seconds:
+                    break
+                if self.aggregate_s > 0 and now - last_refresh >= self.aggregate_s:
+                    self.refresh()
+                    last_refresh = now
+                if self.report_s > 0 and now - last_report >= self.report_s:
+                    print(self.stats())
+                    last_report = now
+        except KeyboardInterrupt:
+            print("Stopping; storing packets already received")
+        self.finish()
+
+    def stop(self):
+        """Ask run() to finish (from another thread)"""
+        self.stopping.set()
+
+    def finish(self):
+        """Stop reading, let the writers store what is queued, and refresh the summary tables"""
+        for client in self.clients:
+            client.stop()
+        for thread in self.threads: # One each; every packet before them is stored first
+            while any(t.is_alive() for t in self.threads): # A writer that failed won't take its STOP
+                try:
+                    self.queue.put(aprspipeline.STOP, timeout=1.0)
+                    break
+                except queue.Full:
+                    continue
+        for thread in self.threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+        self.writers[0].aggregates.refresh()
+        print(self.stats())
+
+    def stats(self):
+        """returns: summary of frames read, packets per receiver, and packets per writer"""
+        lines = [client.stats() for client in self.clients]
+        lines += ["receiver {} ({}, session {}): {} packets".format(receiver.name, receiver.ingester.rxinfo['call'],
+            receiver.ingester.session_id, receiver.packets) for receiver in self.receivers]
+        lines.append("writers: {} packets stored ({}), {} failed, {} retried after deadlocks".format(sum(self.stored), ', '.join(str(x) for x in self.stored),
+            self.failed, self.retried))
+        lines.append(self.queue.stats())
+        return('\n'.join(lines))
+
+def receiver_sections(config, names=None):
+    """
+    config: configparser.ConfigParser
+    names: receivers to use (default: all)
+    returns: list of (name, section) for the [receiver NAME] sections
+    raises: KeyError if a named receiver isn't configured
+    """
+    sections = {section.split(None, 1)[1]: section for section in config.sections() if section.startswith('receiver ')}
+    if names is None:
+        return(sorted(sections.items()))
+    return([(name, sections[name]) for name in names])
+
+def from_config(config, names, make_ingester):
+    """
+    Set up a collector from the [kiss] and [receiver NAME] config sections
+    Without any receiver sections, the [aprs] station listens on the [kiss] host and port.
+    Each receiver is connected once, to start its session and record its station.
+    config: configparser.ConfigParser
+    names: receivers to use (default: all)
+    make_ingester: function(rxinfo, receiver name, clock offset) returning an unconnected aprsdb.Ingester
+    returns: KissCollector
+    """
+    host = config.get('kiss', 'host', fallback='127.0.0.1')
+    port = config.getint('kiss', 'port', fallback=8001)
+    sections = receiver_sections(config, names)
+    receivers = []
+    for (name, section) in sections or [(None, 'aprs')]:
+        rxinfo = {'call':config.get(section, 'rxcall', fallback=config.get('aprs', 'rxcall')), 'symbol':config.get(section, 'rxsymbol', fallback=config.get('aprs', 'rxsymbol')),
+                'symbol_table':config.get(section, 'rxtable', fallback=config.get('aprs', 'rxtable')), 'latitude':config.get(section, 'latitude', fallback=config.get('aprs', 'latitude')),
+                'longitude':config.get(section, 'longitude', fallback=config.get('aprs', 'longitude'))}
+        channel = config.get(section, 'channel', fallback='').strip()
+        ingester = make_ingester(rxinfo, name, config.getfloat(section, 'clock_offset_s', fallback=config.getfloat('aprs', 'clock_offset_s', fallback=0)))
+        use_metrics = ingester.use_metrics
+        ingester.use_metrics = False # The writers keep the metrics
+        ingester.connect() # Start the receiver's session and record its station
+        ingester.close()
+        receivers.append(Receiver(name or rxinfo['call'], config.get(section, 'host', fallback=host), config.getint(section, 'port', fallback=port),
+            int(channel) if channel != '' else None, ingester))
+    writers = [copy.copy(receivers[0].ingester) for n in range(max(config.getint('kiss', 'writers', fallback=2), 1))]
+    for writer in writers:
+        writer.use_metrics = use_metrics
+    return KissCollector(receivers, writers, config.getint('kiss', 'queue_size', fallback=1000), config.getfloat('kiss', 'retry_max_s', fallback=60),
+            config.getfloat('ingest', 'aggregate_s', fallback=10), config.getint('kiss', 'report_s', fallback=60))
+
+class FakeKiss(socketserver.ThreadingTCPServer):
+    """Local stand-in for a KISS TCP endpoint (e.g. Direwolf's KISS port), for trying the
+    collector without a radio.  Each client is sent the queued backlog, then any packet
+    given to send().  Listens on a free port by default.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, packets=(), port=0):
+        """
+        packets: backlog of (channel, TNC2 packet text) sent to each client as it connects
+        port: TCP port (0 for any free port, see .port)
+        """
+        self.backlog = [kiss_frame(tnc2_to_ax25(packet), channel) for (channel, packet) in packets]
+        self.clients = [] # FakeKissHandlers of the connected clients
+        self.connections = 0
+        self.lock = threading.Lock()
+        super().__init__(('127.0.0.1', port), FakeKissHandler)
+        self.port = self.server_address[1]
+
+    def send(self, packet, channel=0):
+        """Send a packet to every connected client"""
+        frame = kiss_frame(tnc2_to_ax25(packet), channel)
+        with self.lock:
+            for client in self.clients:
+                client.wfile.write(frame)
+
+    def disconnect(self):
+        """Drop every client (to try reconnection)"""
+        with self.lock:
+            for client in self.clients:
+                client.request.shutdown(socket.SHUT_RDWR)
+
+    def start(self):
+        """Serve from a background thread"""
+        threading.Thread(target=self.serve_forever, name='fake-kiss', daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class FakeKissHandler(socketserver.StreamRequestHandler):
+    """One client of FakeKiss"""
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+            for frame in server.backlog:
+                self.wfile.write(frame)
+            server.clients.append(self)
+        try:
+            while self.rfile.read(1) != b'': # Until the client goes
+                pass
+        except (OSError, ValueError):
+            pass
+        with server.lock:
+            if self in server.clients:
+                server.clients.remove(self)
+
+if __name__ == "__main__": # Print what a KISS endpoint sends (or serve a capture file as a fake one)
+    import aprsdirewolf
+    parser = argparse.ArgumentParser(description='Print the packets a KISS TCP endpoint sends, or serve a capture over KISS')
+    parser.add_argument('--host', default='127.0.0.1', help='KISS host')
+    parser.add_argument('--port', type=int, default=8001, help='KISS port')
+    parser.add_argument('--fake', metavar='FILE', help='Serve the Direwolf/kissutil capture FILE on --port instead (channels kept)')
+    parser.add_argument('--seconds', type=float, default=10, help='How long to run')
+    args = parser.parse_args(sys.argv[1:])
+    if args.fake is not None:
+        with open(args.fake, errors='replace') as capture:
+            (channels, epochs, packets) = aprsdirewolf.default_decoder.decode_block(capture.readlines())
+        fake = FakeKiss([(channel or 0, packet) for (channel, packet) in zip(channels, packets) if '>' in packet and ':' in packet], args.port)
+        print("Serving {} packets on port {}".format(len(fake.backlog), fake.port))
+        fake.start()
+        time.sleep(args.seconds)
+        print("fake KISS: {} connections".format(fake.connections))
+        fake.stop()
+    else:
+        out = queue.Queue()
+        client = KissClient(args.host, args.port, [Receiver(None, args.host, args.port, None, None)], out)
+        client.start()
+        start = time.time()
+        while time.time() - start < args.seconds:
+            try:
+                (receiver, rxtime, packet) = out.get(timeout=1)
+                print(packet)
+            except queue.Empty:
+                pass
+        client.stop()
+        print(client.stats())
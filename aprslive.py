@@ -0,0 +1,180 @@
+# aprslive.py
+# Live station table for the aprsdb collector: the last position of each station, kept in memory
+# and served as GeoJSON, so a live map never has to query the database
+
+import argparse, json, sys, threading
+import http.server
+import urllib.parse
+
+class Station:
+    """Last position heard from one station (or object/item); slots keep each entry small"""
+    __slots__ = ('name', 'src', 'pid', 'heard', 'latitude', 'longitude', 'symbol', 'symbol_table', 'course', 'speed', 'format', 'path')
+
+    def feature(self, now):
+        """
+        now: time to measure the age from (e.g. the latest receive time)
+        returns: GeoJSON Feature dictionary
+        """
+        return {'type': 'Feature', 'id': self.name, 'geometry': {'type': 'Point', 'coordinates': [self.longitude, self.latitude]},
+                'properties': {'name': self.name, 'src': self.src, 'pid': self.pid, 'heard': self.heard, 'age_s': round(now - self.heard, 1),
+                'symbol': self.symbol, 'symbol_table': self.symbol_table, 'course': self.course, 'speed': self.speed,
+                'format': self.format, 'path': list(self.path)}}
+
+class LiveTable:
+    """Last position of every station heard within ttl_s, updated by the collector as it stores packets.
+    Ages are measured from the latest receive time seen, as the *_window() views measure
+    from max(rxtime), so a replay or a receiver with an offset clock ages out the same way.
+    Updates and reads may come from different threads (writers, and the HTTP server).
+    """
+
+    def __init__(self, ttl_s=3600):
+        """
+        ttl_s: seconds since a station was last heard before it is dropped
+        """
+        self.ttl_s = ttl_s
+        self.stations = {} # name: Station
+        self.lock = threading.Lock()
+        self.latest = 0 # Latest receive time seen
+        self.swept = 0 # Receive time of the last sweep for expired stations
+        self.version = 0 # Bumped on every change, so readers can reuse what they encoded
+        self.encoded = {} # (version, window_s): GeoJSON bytes
+        self.updates = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self.stations)
+
+    def update(self, parsed, pid):
+        """
+        Record a position packet (called by the collector once it has a pid)
+        parsed: normalized packet dictionary, with latitude and longitude
+        pid: its packet id
+        """
+        rxtime = parsed['rxtime']
+        name = parsed['src']
+        if parsed['format'] in ('object', 'item'): # Objects and items are placed by name, not by their sender
+            name = (parsed.get('object_name') or name).strip()
+            if parsed.get('alive') is False: # Killed
+                with self.lock:
+                    if self.stations.pop(name, None) is not None:
+                        self.version += 1
+                return
+        with self.lock:
+            station = self.stations.get(name)
+            if station is None:
+                station = Station()
+                station.name = name
+                self.stations[name] = station
+            elif station.heard > rxtime: # Already have a newer position (e.g. from another receiver's writer)
+                return
+            station.src = parsed['src']
+            station.pid = pid
+            station.heard = rxtime
+            station.latitude = float(parsed['latitude'])
+            station.longitude = float(parsed['longitude'])
+            station.symbol = parsed.get('symbol')
+            station.symbol_table = parsed.get('symbol_table')
+            station.course = parsed.get('course')
+            station.speed = parsed.get('speed')
+            station.format = parsed['format']
+            station.path = tuple(parsed.get('path') or ())
+            self.updates += 1
+            self.version += 1
+            if rxtime > self.latest:
+                self.latest = rxtime
+            if self.latest - self.swept > self.ttl_s / 10: # Sweep now and then, not on every packet
+                self.expire()
+
+    def expire(self):
+        """Drop stations not heard within ttl_s of the latest receive time (call with the lock held)"""
+        cutoff = self.latest - self.ttl_s
+        old = [name for (name, station) in self.stations.items() if station.heard < cutoff]
+        for name in old:
+            del self.stations[name]
+        self.expired += len(old)
+        self.swept = self.latest
+        if old != []:
+            self.version += 1
+
+    def geojson(self, window_s=None):
+        """
+        window_s: only stations heard within this many seconds of the latest receive time (default: all, up to ttl_s)
+        returns: GeoJSON FeatureCollection, encoded (reused until the table changes)
+        """
+        with self.lock:
+            key = (self.version, window_s)
+            body = self.encoded.get(key)
+            if body is None:
+                cutoff = self.latest - (self.ttl_s if window_s is None else min(window_s, self.ttl_s))
+                features = [station.feature(self.latest) for station in self.stations.values() if station.heard >= cutoff]
+                body = json.dumps({'type': 'FeatureCollection', 'latest': self.latest, 'features': features}).encode()
+                self.encoded = {k: v for (k, v) in self.encoded.items() if k[0] == self.version} # Older versions are stale
+                self.encoded[key] = body
+            return body
+
+    def station(self, name):
+        """
+        name: station call (with SSID) or object/item name
+        returns: its GeoJSON Feature, encoded, or None if it hasn't been heard within ttl_s
+        """
+        with self.lock:
+            station = self.stations.get(name)
+            if station is None or station.heard < self.latest - self.ttl_s:
+                return None
+            return json.dumps(station.feature(self.latest)).encode()
+
+    def stats(self):
+        """returns: one-line summary of the table"""
+        return "Live stations: {} held, {} updates, {} expired".format(len(self.stations), self.updates, self.expired)
+
+    def serve(self, port, address='127.0.0.1'):
+        """
+        Serve the table over HTTP from a background thread:
+        /stations.geojson (optionally ?window_s=600), /stations/NAME (one station), and /stats
+        port: TCP port
+        address: address to listen on (local only by default)
+        returns: the http.server.ThreadingHTTPServer
+        """
+        live = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                (status, content_type, body) = (200, 'application/geo+json', None)
+                try:
+                    if url.path in ('/', '/stations.geojson'):
+                        window = urllib.parse.parse_qs(url.query).get('window_s')
+                        body = live.geojson(float(window[0]) if window else None)
+                    elif url.path.startswith('/stations/'):
+                        body = live.station(urllib.parse.unquote(url.path[len('/stations/'):]))
+                    elif url.path == '/stats':
+                        (content_type, body) = ('text/plain', (live.stats() + '\n').encode())
+                except ValueError: # Bad window_s
+                    (status, content_type, body) = (400, 'text/plain', b'window_s must be a number of seconds\n')
+                if body is None:
+                    (status, content_type, body) = (404, 'text/plain', b'Not found\n')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Access-Control-Allow-Origin', '*') # For a map page served from elsewhere
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args): # Keep map polls out of the collector's output
+                pass
+        server = http.server.ThreadingHTTPServer((address, port), Handler)
+        threading.Thread(target=server.serve_forever, name='aprsdb-live', daemon=True).start()
+        return server
+
+if __name__ == "__main__": # Fetch and summarize a running collector's live table
+    import urllib.request
+    parser = argparse.ArgumentParser(description='List the stations in a running aprsdb collector\'s live table')
+    parser.add_argument('-u', '--url', default='http://127.0.0.1:8081/stations.geojson', help='Live table URL ([live] address and port)')
+    parser.add_argument('--window-s', type=float, help='Only stations heard within this many seconds')
+    args = parser.parse_args(sys.argv[1:])
+    url = args.url + ('?window_s={}'.format(args.window_s) if args.window_s is not None else '')
+    with urllib.request.urlopen(url) as response:
+        collection = json.load(response)
+    for feature in sorted(collection['features'], key=lambda x: x['properties']['age_s']):
+        p = feature['properties']
+        (lon, lat) = feature['geometry']['coordinates']
+        print("{:<10} {:9.4f} {:10.4f} {}{} {:>7.0f}s ago via {}".format(p['name'], lat, lon, p['symbol_table'] or ' ', p['symbol'] or ' ', p['age_s'], ','.join(p['path']) or '-'))
@@ -0,0 +1,256 @@
+# aprsmetrics.py
+# Per-stage latency histograms and database round-trip counts for the aprsdb collector
+# Nothing here runs unless metrics are turned on: the collector only wraps its
+# stages and swaps in the metered connection when a Metrics object exists.
+
+import bisect, os, threading, time
+import http.server
+import psycopg2.extensions
+
+SECONDS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5) # Upper bounds, plus +Inf
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64) # Statements or commits per packet, plus +Inf
+
+# process_packet/store_packet return codes (anything positive is a pid)
+RESULTS = {-2:'common insert failed', -3:'format insert failed', -4:'third-party subpacket failed', -5:'unparsable',
+        -6:'unsalvageable', -7:'data error (logged)', -8:'error logging failed'}
+
+class Histogram:
+    """Fixed-bucket histogram (Prometheus style)"""
+
+    def __init__(self, bounds=SECONDS_BUCKETS):
+        """bounds: ascending bucket upper bounds; values above the last go in +Inf"""
+        self.bounds = bounds
+        self.buckets = [0]*(len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Count one value"""
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        q: quantile (0-1)
+        returns: upper bound of the bucket holding that quantile (inf past the last bound, 0 if empty)
+        """
+        if self.count == 0:
+            return 0
+        rank = q*self.count
+        seen = 0
+        for (i, n) in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n > 0:
+                return self.bounds[i] if i < len(self.bounds) else float('inf')
+        return float('inf')
+
+class MeteredCursor(psycopg2.extensions.cursor):
+    """Cursor that counts and times each statement it sends"""
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self.connection.metrics.statement(time.perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self.connection.metrics.statement(time.perf_counter() - start)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            self.connection.metrics.statement(time.perf_counter() - start)
+
+class MeteredConnection(psycopg2.extensions.connection):
+    """Connection whose cursors are metered, and which counts and times its commits"""
+
+    def cursor(self, *args, **kwargs):
+        if kwargs.get('cursor_factory') is None:
+            kwargs['cursor_factory'] = MeteredCursor
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            self.metrics.commits += 1
+            self.metrics.observe('commit', time.perf_counter() - start)
+
+class Metrics:
+    """Collector metrics: a latency histogram per stage, statements and commits
+    (in total and per packet), and the distribution of packet results.
+    Updated from the collector's threads without locking, so a report read while
+    packets are flowing may be off by a packet or so.
+    """
+
+    def __init__(self, report_s=60, filename=None):
+        """
+        report_s: seconds between log lines (and metrics file updates); 0 for none
+        filename: Prometheus text file to keep updated, or None
+        """
+        self.report_s = report_s
+        self.filename = filename
+        self.stages = {} # stage name: Histogram of seconds
+        self.statements = 0
+        self.commits = 0
+        self.per_packet = {'statements':Histogram(COUNT_BUCKETS), 'commits':Histogram(COUNT_BUCKETS)}
+        self.results = {} # 'ok' or negative return code: count
+        self.packets = 0
+        self.started = time.time()
+        self.last_report = self.started
+        self.server = None
+        self.gauges = {} # name: (help text, function returning the current value)
+
+    def connect(self, dsn, *args, **kwargs):
+        """Connection factory for psycopg2.connect(connection_factory=...)"""
+        conn = MeteredConnection(dsn, *args, **kwargs)
+        conn.metrics = self
+        return conn
+
+    def observe(self, stage, seconds):
+        """Count time spent in a stage"""
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages.setdefault(stage, Histogram())
+        histogram.observe(seconds)
+
+    def gauge(self, name, help, function):
+        """
+        Export a value kept elsewhere (e.g. a cache's size or hit count)
+        name: metric name (exported as aprsdb_<name>)
+        help: description
+        function: function returning the current value
+        """
+        self.gauges[name] = (help, function)
+
+    def statement(self, seconds):
+        """Count one SQL statement (a round trip to the server)"""
+        self.statements += 1
+        self.observe('sql', seconds)
+
+    def timed(self, stage, function):
+        """
+        stage: name for the stage's histogram
+        function: function to time
+        returns: function wrapped to count its run time under stage
+        """
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.observe(stage, time.perf_counter() - start)
+        return wrapper
+
+    def packets_wrapper(self, function):
+        """
+        function: function storing one packet and returning a pid or negative error code (store_packet)
+        returns: function wrapped to time it, count its statements, commits, and result,
+        and log (and write the metrics file) every report_s seconds
+        """
+        def wrapper(*args, **kwargs):
+            (statements, commits) = (self.statements, self.commits)
+            start = time.perf_counter()
+            result = 'exception'
+            try:
+                mypacketid = function(*args, **kwargs)
+                result = 'ok' if mypacketid is not None and mypacketid > 0 else mypacketid
+                return mypacketid
+            finally:
+                self.observe('packet', time.perf_counter() - start)
+                self.per_packet['statements'].observe(self.statements - statements)
+                self.per_packet['commits'].observe(self.commits - commits)
+                self.results[result] = self.results.get(result, 0) + 1
+                self.packets += 1
+                if self.report_s > 0 and time.time() - self.last_report >= self.report_s:
+                    print(self.report())
+                    self.write()
+        return wrapper
+
+    def report(self):
+        """returns: one-line summary (stage latencies are bucket upper bounds)"""
+        self.last_report = time.time()
+        packets = max(self.packets, 1)
+        stages = ', '.join("{} {:.2f}/{:.2f}".format(name, h.quantile(0.5)*1000, h.quantile(0.99)*1000)
+                for (name, h) in sorted(self.stages.items()))
+        results = ', '.join("{}{}: {}".format(k, ' ' + RESULTS[k] if k in RESULTS else '', v)
+                for (k, v) in sorted(self.results.items(), key=str))
+        return("metrics: {} packets, {:.2f} statements/packet, {:.2f} commits/packet; p50/p99 ms: {}; results: {}".format(
+            self.packets, self.statements/packets, self.commits/packets, stages, results))
+
+    def prometheus(self):
+        """returns: the metrics in the Prometheus text exposition format"""
+        lines = []
+        def histogram(name, h, labels=''):
+            cumulative = 0
+            for (bound, n) in zip(list(h.bounds) + ['+Inf'], h.buckets):
+                cumulative += n
+                lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, labels, bound, cumulative))
+            labels = '{' + labels.rstrip(',') + '}' if labels != '' else ''
+            lines.append('{}_sum{} {}'.format(name, labels, h.sum))
+            lines.append('{}_count{} {}'.format(name, labels, h.count))
+        lines.append('# HELP aprsdb_stage_seconds Time spent in each collector stage')
+        lines.append('# TYPE aprsdb_stage_seconds histogram')
+        for (name, h) in sorted(self.stages.items()):
+            histogram('aprsdb_stage_seconds', h, 'stage="{}",'.format(name))
+        for (name, h) in sorted(self.per_packet.items()):
+            lines.append('# HELP aprsdb_{0}_per_packet SQL {0} per stored packet'.format(name))
+            lines.append('# TYPE aprsdb_{}_per_packet histogram'.format(name))
+            histogram('aprsdb_{}_per_packet'.format(name), h)
+        lines.append('# HELP aprsdb_statements_total SQL statements sent')
+        lines.append('# TYPE aprsdb_statements_total counter')
+        lines.append('aprsdb_statements_total {}'.format(self.statements))
+        lines.append('# HELP aprsdb_commits_total Transactions committed')
+        lines.append('# TYPE aprsdb_commits_total counter')
+        lines.append('aprsdb_commits_total {}'.format(self.commits))
+        lines.append('# HELP aprsdb_packets_total Packets handled, by result (ok, or the negative return code)')
+        lines.append('# TYPE aprsdb_packets_total counter')
+        for (result, n) in sorted(self.results.items(), key=str):
+            lines.append('aprsdb_packets_total{{result="{}"}} {}'.format(result, n))
+        for (name, (help, function)) in sorted(self.gauges.items()):
+            lines.append('# HELP aprsdb_{} {}'.format(name, help))
+            lines.append('# TYPE aprsdb_{} gauge'.format(name))
+            lines.append('aprsdb_{} {}'.format(name, function()))
+        lines.append('# HELP aprsdb_start_time_seconds When the collector started')
+        lines.append('# TYPE aprsdb_start_time_seconds gauge')
+        lines.append('aprsdb_start_time_seconds {}'.format(self.started))
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """Replace the metrics file (if any) with the current metrics"""
+        if self.filename is None:
+            return
+        temp = self.filename + '.tmp'
+        with open(temp, 'w') as out:
+            out.write(self.prometheus())
+        os.replace(temp, self.filename) # Readers never see a half-written file
+
+    def serve(self, port, address='127.0.0.1'):
+        """
+        Serve the metrics over HTTP (any path) from a background thread
+        port: TCP port
+        address: address to listen on (local only by default)
+        """
+        metrics = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args): # Keep scrapes out of the collector's output
+                pass
+        self.server = http.server.ThreadingHTTPServer((address, port), Handler)
+        threading.Thread(target=self.server.serve_forever, name='aprsdb-metrics', daemon=True).start()
@@ -0,0 +1,83 @@
+# aprsmigrate.py
+# Versioned schema migrations for aprsdb
+
+import os, re, time
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_FILE = re.compile(r'^(\d+)_(\w+)\.sql$') # e.g. 001_lookup_indexes.sql
+
+def list_migrations(path=MIGRATIONS_DIR):
+    """
+    Find the migration scripts in a directory
+    path: directory holding NNN_name.sql scripts
+    returns: list of (version, name, filename), in version order
+    """
+    migrations = []
+    for filename in os.listdir(path):
+        match = MIGRATION_FILE.match(filename)
+        if match is not None:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(path, filename)))
+    migrations.sort()
+    return(migrations)
+
+def latest_version(path=MIGRATIONS_DIR):
+    """returns: the schema version this copy of aprsdb expects (0 for the original aprsdb_creation.sql)"""
+    migrations = list_migrations(path)
+    return(migrations[-1][0] if migrations != [] else 0)
+
+def schema_version(cur):
+    """
+    Read the database's schema version
+    cur: psycopg2 database cursor
+    returns: highest applied migration, or 0 if none have been applied
+    """
+    cur.execute("SELECT to_regclass('schema_version') IS NOT NULL;")
+    if not cur.fetchone()[0]:
+        return(0)
+    cur.execute("SELECT coalesce(max(version), 0) FROM schema_version;")
+    return(cur.fetchone()[0])
+
+def migrate(conn, path=MIGRATIONS_DIR):
+    """
+    Apply pending migrations, each in its own transaction
+    conn: psycopg2 database connection
+    path: directory holding the migration scripts
+    returns: schema version after migrating
+    """
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE IF NOT EXISTS schema_version(version INTEGER PRIMARY KEY, name VARCHAR(64), applied_utc_s BIGINT);")
+    conn.commit()
+    version = schema_version(cur)
+    for (number, name, filename) in list_migrations(path):
+        if number <= version:
+            continue
+        print("Applying migration {:03d} ({})".format(number, name))
+        try:
+            with open(filename) as script:
+                cur.execute(script.read())
+            cur.execute("INSERT INTO schema_version (version, name, applied_utc_s) VALUES (%s, %s, %s);", (number, name, time.time()))
+            conn.commit()
+        except:
+            conn.rollback()
+            print("Migration {:03d} failed; the schema is still at version {}".format(number, version))
+            raise
+        version = number
+    return(version)
+
+def check_version(conn, path=MIGRATIONS_DIR):
+    """
+    Make sure the database schema is current
+    conn: psycopg2 database connection
+    path: directory holding the migration scripts
+    returns: the database's schema version
+    raises: RuntimeError if migrations are pending
+    """
+    cur = conn.cursor()
+    version = schema_version(cur)
+    conn.commit()
+    expected = latest_version(path)
+    if version < expected:
+        raise RuntimeError("Database schema is at version {}, but aprsdb needs version {}; run aprsdb.py --migrate".format(version, expected))
+    if version > expected:
+        print("Database schema version {} is newer than this aprsdb ({}); continuing".format(version, expected))
+    return(version)
@@ -0,0 +1,112 @@
+# aprsparallel.py
+# Multi-core decoding and parsing of capture files for offline replays
+
+import os, time, itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import aprsdirewolf # Direwolf line decoding
+import aprsparse # Packet parsing
+
+def split_file(filename, chunk_bytes=1<<22):
+    """
+    Split a file into byte ranges that start and end on line boundaries
+    filename: file to split
+    chunk_bytes: approximate size of each range
+    returns: list of (start, end) byte offsets
+    """
+    size = os.path.getsize(filename)
+    bounds = []
+    with open(filename, 'rb') as capture:
+        start = 0
+        while start < size:
+            capture.seek(min(start + chunk_bytes, size))
+            capture.readline() # Finish the line we landed in
+            end = min(capture.tell(), size)
+            bounds.append((start, end))
+            start = end
+    return(bounds)
+
+def parse_chunk(filename, start, end, decoder=None):
+    """
+    Decode and parse the lines in one byte range of a capture file (runs in a worker process)
+    Lines are handled as the collector handles stdin: undecodable lines are skipped,
+    and packets without a Direwolf timestamp are stamped with the current time.
+    filename: capture file
+    start: byte offset of the first line
+    end: byte offset just past the last line
+    decoder: aprsdirewolf.LineDecoder for the capture's timestamp format (default: aprsdirewolf.default_decoder)
+    returns: ([(rxtime, packet, parsed), ...], decode seconds, parse seconds),
+        where parsed is from aprsparse.parse_packet
+    """
+    with open(filename, 'rb') as capture:
+        capture.seek(start)
+        data = capture.read(end - start)
+    results = []
+    t0 = time.perf_counter()
+    lines = []
+    for raw in data.splitlines(keepends=True): # Same line endings as reading stdin
+        try:
+            lines.append(raw.decode('utf-8'))
+        except UnicodeDecodeError: # The collector skips these too
+            continue
+    decoder = decoder or aprsdirewolf.default_decoder
+    (channels, rxtimes, packets) = decoder.decode_block(lines)
+    decode_s = time.perf_counter() - t0
+    for (rxtime, packet) in zip(rxtimes, packets):
+        if rxtime is None:
+            rxtime = decoder.now()
+        parsed = aprsparse.parse_packet(packet)
+        results.append((rxtime, packet, parsed))
+    parse_s = time.perf_counter() - t0 - decode_s
+    return((results, decode_s, parse_s))
+
+class ReplayStats:
+    """Line counts and time spent per stage of a replay"""
+
+    def __init__(self):
+        self.start = time.time()
+        self.lines = 0
+        self.decode_s = 0.0 # Summed over all workers
+        self.parse_s = 0.0 # Summed over all workers
+        self.write_s = 0.0 # Database writer (this process)
+
+    def report(self):
+        """returns: per-stage throughput summary"""
+        wall = max(time.time() - self.start, 1e-9)
+        rate = lambda s: self.lines/s if s > 0 else 0.0
+        return("{} lines in {:.1f} s ({:.0f} lines/s); decode {:.1f} cpu-s ({:.0f} lines/s), parse {:.1f} cpu-s ({:.0f} lines/s), write {:.1f} s ({:.0f} lines/s)".format(
+            self.lines, wall, self.lines/wall, self.decode_s, rate(self.decode_s), self.parse_s, rate(self.parse_s), self.write_s, rate(self.write_s)))
+
+def replay(filenames, store, jobs=None, chunk_bytes=1<<22, report_s=10, decoder=None):
+    """
+    Parse capture files on several cores, handing packets to a single writer in file order
+    filenames: list of capture files
+    store: function(parsed, packet, rxtime) that writes one packet (e.g. a wrapper for store_packet)
+    jobs: number of worker processes (default: one per core)
+    chunk_bytes: approximate size of the file ranges given to workers
+    report_s: seconds between throughput reports (0 for none)
+    decoder: aprsdirewolf.LineDecoder for the captures' timestamp format (default: aprsdirewolf.default_decoder)
+    returns: ReplayStats
+    """
+    jobs = jobs or os.cpu_count() or 1
+    stats = ReplayStats()
+    last_report = time.time()
+    chunks = ((filename, start, end) for filename in filenames for (start, end) in split_file(filename, chunk_bytes))
+    with ProcessPoolExecutor(jobs) as pool:
+        # Keep a couple of chunks per worker in flight; results are used in submission order
+        pending = deque(pool.submit(parse_chunk, *chunk, decoder) for chunk in itertools.islice(chunks, 2*jobs))
+        while pending:
+            (results, decode_s, parse_s) = pending.popleft().result()
+            for chunk in itertools.islice(chunks, 1):
+                pending.append(pool.submit(parse_chunk, *chunk, decoder))
+            stats.decode_s += decode_s
+            stats.parse_s += parse_s
+            t0 = time.perf_counter()
+            for (rxtime, packet, parsed) in results:
+                store(parsed, packet, rxtime)
+            stats.write_s += time.perf_counter() - t0
+            stats.lines += len(results)
+            if report_s > 0 and time.time() - last_report > report_s:
+                print(stats.report())
+                last_report = time.time()
+    return(stats)
@@ -0,0 +1,149 @@
+# aprsparse.py
+# APRS packet parsing and field normalization for aprsdb (no database access)
+
+import aprslib # APRS parsing
+import collections, time
+
+# Faster parsers for particular packet types, tried before aprslib (see register_fast_parser)
+fast_parsers = {} # packet type character (first character of the information field): function
+
+def register_fast_parser(packet_types, function):
+    """
+    Use a faster parser for some packet types, falling back to aprslib when it declines
+    packet_types: string of packet type characters (e.g. '!=/@' for uncompressed/compressed positions)
+    function: function(packet, head, body) returning a dictionary just as aprslib.parse would, or None to fall back
+    """
+    for packet_type in packet_types:
+        fast_parsers[packet_type] = function
+
+def parse_packet(packet):
+    """
+    Parse a raw APRS packet, salvaging what headers we can if the body can't be parsed
+    packet: APRS packet string
+    returns: aprslib parsed packet dictionary, or negative integer if not parseable
+        -6: unable to partially parse packet
+        -5: unable to parse packet
+    """
+    if fast_parsers:
+        try:
+            (head, body) = packet.rstrip("\r\n").split(':', 1)
+            function = fast_parsers.get(body[:1])
+            parsed = function(packet, head, body) if function is not None else None
+        except: # Let aprslib decide what is wrong with it
+            parsed = None
+        if parsed is not None:
+            return(parsed)
+    try:  # Parse it
+        parsed = aprslib.parse(packet)
+    except aprslib.exceptions.ParseError as pe:
+        try: # Salvage what data we can from the header of an unparseable packet
+            parsed = pe.parsed
+            parsed['format']="parseerror"
+        except: # Couldn't salvage anything
+            return(-6) # Unable to partially parse packet
+    except aprslib.exceptions.UnknownFormat as uf:
+        # Save what headers we can if the format is unknown
+        parsed = uf.parsed
+        parsed['format']="unknown"
+    except:
+        # Something else went wrong
+        return(-5) # Unable to parse packet
+    return(parsed)
+
+def copy_parsed(parsed):
+    """
+    parsed: parsed aprs packet dictionary
+    returns: copy that can be changed without touching the original (nested dictionaries and lists are copied too)
+    """
+    mycopy = {}
+    for (k, v) in parsed.items():
+        if type(v) is dict:
+            v = copy_parsed(v)
+        elif type(v) is list:
+            v = [copy_parsed(x) if type(x) is dict else x for x in v]
+        mycopy[k] = v
+    return(mycopy)
+
+class ParseCache:
+    """Recently parsed packets, keyed on the packet without its path, so the copies of a
+    packet heard from several digipeaters are only parsed once.  Each hit is a fresh copy,
+    with the raw text and path of the copy being parsed.  Entries are kept for window_s
+    seconds after they are first parsed (aprslib reads short timestamps relative to the
+    current date, so a much longer window could reuse a stale date).
+    """
+
+    def __init__(self, window_s=30, max_size=10000):
+        """
+        window_s: seconds a parsed packet is reused
+        max_size: most packets kept (oldest are dropped)
+        """
+        self.window_s = window_s
+        self.max_size = max_size
+        self.entries = collections.OrderedDict() # key: (expiry time, parsed packet), oldest first
+        self.hits = 0
+        self.misses = 0
+        self.hit_s = 0.0 # Time spent on hits (copying)
+        self.miss_s = 0.0 # Time spent parsing misses
+
+    def parse(self, packet):
+        """
+        Parse a raw APRS packet, reusing a recent parse of the same packet
+        packet: APRS packet string
+        returns: as parse_packet
+        """
+        start = time.perf_counter()
+        try:
+            packet = packet.rstrip("\r\n")
+            (head, body) = packet.split(':', 1)
+            (src, route) = head.split('>', 1)
+            key = src + '>' + route.split(',', 1)[0] + ':' + body
+        except ValueError: # No header to key on
+            return(parse_packet(packet))
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > start:
+            try:
+                parsed = copy_parsed(entry[1])
+                parsed.update(aprslib.parsing.parse_header(head)) # This copy's path
+                parsed['raw'] = packet
+                self.hits += 1
+                self.hit_s += time.perf_counter() - start
+                return(parsed)
+            except aprslib.exceptions.ParseError: # This copy's path is bad; let parse_packet deal with it
+                pass
+        parsed = parse_packet(packet)
+        if type(parsed) is dict and parsed['format'] != 'parseerror': # Only cache clean parses
+            self.entries.pop(key, None)
+            self.entries[key] = (start + self.window_s, copy_parsed(parsed))
+            while self.entries and (len(self.entries) > self.max_size or next(iter(self.entries.values()))[0] <= start):
+                self.entries.popitem(last=False)
+        self.misses += 1
+        self.miss_s += time.perf_counter() - start
+        return(parsed)
+
+    def stats(self):
+        """returns: one-line summary of hit rate and parsing time saved"""
+        total = self.hits + self.misses
+        rate = 100.0*self.hits/total if total > 0 else 0.0
+        saved = self.hits*self.miss_s/self.misses - self.hit_s if self.misses > 0 else 0.0
+        return("parse cache: {} entries, {} hits, {} misses ({:.1f}% hit), about {:.2f} s of parsing saved".format(
+            len(self.entries), self.hits, self.misses, rate, saved))
+
+def normalize_parsed(parsed):
+    """
+    Work around potential SQL reserved words, characters, and case-sensitivity
+    parsed: parsed aprs packet dictionary from aprslib (renamed in place)
+    returns: copy of parsed with database-friendly, lower-case field names
+    """
+    parsed['dest'] = parsed.pop('to')
+    parsed['src'] = parsed.pop('from')
+    if parsed['format'] == 'mic-e':
+        parsed['format'] = 'mic_e'
+    if parsed['format'] == 'telemetry-message':
+        parsed['format'] = 'telemetry_message'
+    try:
+        parsed['addressee'] = parsed['addresse']
+    except:
+        pass
+
+    # Ensure all field names are lower-case
+    return(dict((k.lower(), v) for k,v in parsed.items()))
@@ -0,0 +1,257 @@
+# aprspartition.py
+# Optional time partitioning of the packet tables, and partition maintenance
+
+import datetime, re
+from psycopg2 import sql
+
+# Tables partitioned by rxtime; common goes first (its rxtime is copied to the others)
+PARTITIONED_TABLES = ['common', 'paths', 'map_entry', 'uncompressed', 'compressed', 'object', 'mic_e', 'message', 'status', 'wx', 'thirdparty', 'telemetry_message']
+INTERVALS = {'month':'%Y%m', 'day':'%Y%m%d'} # Partition interval: name suffix format
+MAX_RXTIME = 32503680000 # 3000-01-01 UTC
+PARTITION_BOUND = re.compile(r"FROM \('?([-0-9.e+]+)'?\) TO \('?([-0-9.e+]+)'?\)")
+
+def period_start(t, interval='month'):
+    """
+    Find the start of the partition period holding a time
+    t: seconds since epoch
+    interval: 'month' or 'day'
+    returns: UTC datetime at the start of the period
+    """
+    start = datetime.datetime.fromtimestamp(t, datetime.timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    if interval == 'month':
+        start = start.replace(day=1)
+    return(start)
+
+def add_periods(start, count, interval='month'):
+    """
+    Step a period start forward (or back, for negative counts)
+    start: UTC datetime at the start of a period
+    count: number of periods
+    interval: 'month' or 'day'
+    returns: UTC datetime at the start of the new period
+    """
+    if interval == 'month':
+        months = start.year*12 + start.month - 1 + count
+        return(start.replace(year=months//12, month=months%12 + 1))
+    return(start + datetime.timedelta(days=count))
+
+def partition_name(table, start, interval='month'):
+    """returns: name of the partition of table that starts at start (e.g. common_p202405)"""
+    return(table + '_p' + start.strftime(INTERVALS[interval]))
+
+def data_periods(cur, table, interval='month'):
+    """
+    Find the periods a table has rows in
+    cur: psycopg2 database cursor
+    table: table with an rxtime column
+    interval: 'month' or 'day'
+    returns: set of UTC datetimes at the start of each period
+    """
+    # Implausible times (before 1970, or past the year 3000) are left to the default partition
+    cur.execute(sql.SQL("SELECT DISTINCT date_trunc(%s, to_timestamp(rxtime), 'UTC') FROM {} WHERE rxtime >= 0 AND rxtime < %s;").format(sql.Identifier(table)), (interval, MAX_RXTIME))
+    return({period_start(x[0].timestamp(), interval) for x in cur.fetchall()})
+
+def is_partitioned(cur, table='common'):
+    """
+    cur: psycopg2 database cursor
+    returns: True if the table is partitioned
+    """
+    cur.execute("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid=to_regclass(%s));", (table,))
+    return(cur.fetchone()[0])
+
+def list_partitions(cur, table):
+    """
+    List the range partitions of a table
+    cur: psycopg2 database cursor
+    table: partitioned table
+    returns: list of (name, lower bound, upper bound), bounds in seconds since epoch, oldest first
+    """
+    cur.execute("""SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits AS i
+            INNER JOIN pg_class AS c ON i.inhrelid=c.oid WHERE i.inhparent=to_regclass(%s);""", (table,))
+    partitions = []
+    for (name, bound) in cur.fetchall():
+        match = PARTITION_BOUND.search(bound)
+        if match is not None: # Skip the default partition
+            partitions.append((name, float(match.group(1)), float(match.group(2))))
+    partitions.sort(key=lambda p: p[1])
+    return(partitions)
+
+def create_partition(cur, table, start, interval='month'):
+    """
+    Add a partition for one period, moving any of its rows out of the default partition
+    cur: psycopg2 database cursor
+    table: partitioned table
+    start: UTC datetime at the start of the period
+    interval: 'month' or 'day'
+    returns: True if the partition was created, False if it already existed
+    """
+    name = partition_name(table, start, interval)
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (name,))
+    if cur.fetchone()[0]:
+        return(False)
+    lower = start.timestamp()
+    upper = add_periods(start, 1, interval).timestamp()
+    default = sql.Identifier(table + '_default')
+    cur.execute(sql.SQL("SELECT EXISTS (SELECT 1 FROM {} WHERE rxtime >= %s AND rxtime < %s);").format(default), (lower, upper))
+    moving = cur.fetchone()[0] # The new range can't be added while the default partition holds rows in it
+    if moving:
+        cur.execute(sql.SQL("ALTER TABLE {} DETACH PARTITION {};").format(sql.Identifier(table), default))
+    cur.execute(sql.SQL("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s);").format(sql.Identifier(name), sql.Identifier(table)), (lower, upper))
+    if moving:
+        cur.execute(sql.SQL("INSERT INTO {} SELECT * FROM {} WHERE rxtime >= %s AND rxtime < %s;").format(sql.Identifier(table), default), (lower, upper))
+        cur.execute(sql.SQL("DELETE FROM {} WHERE rxtime >= %s AND rxtime < %s;").format(default), (lower, upper))
+        cur.execute(sql.SQL("ALTER TABLE {} ATTACH PARTITION {} DEFAULT;").format(sql.Identifier(table), default))
+    print("Created partition " + name)
+    return(True)
+
+def create_partitions(conn, interval='month', premake=3, now=None):
+    """
+    Make sure every partitioned table has partitions from the current period through premake
+    periods ahead, and for any period that has rows waiting in the default partition
+    conn: psycopg2 database connection
+    interval: 'month' or 'day'
+    premake: number of future periods to create
+    now: current time, seconds since epoch
+    returns: number of partitions created
+    """
+    cur = conn.cursor()
+    current = period_start(now if now is not None else datetime.datetime.now(datetime.timezone.utc).timestamp(), interval)
+    periods = {add_periods(current, i, interval) for i in range(premake + 1)}
+    created = 0
+    for table in PARTITIONED_TABLES:
+        if not is_partitioned(cur, table):
+            continue
+        stray = data_periods(cur, table + '_default', interval) # e.g. from replays of old captures
+        for start in sorted(periods | stray):
+            created += create_partition(cur, table, start, interval)
+    conn.commit()
+    return(created)
+
+def expire_partitions(conn, retention, interval='month', action='drop', now=None):
+    """
+    Drop (or detach, for archiving) partitions older than the retention period
+    conn: psycopg2 database connection
+    retention: number of whole periods to keep before the current one (0 keeps everything)
+    interval: 'month' or 'day'
+    action: 'drop' to delete old partitions, 'detach' to keep them as stand-alone tables
+    now: current time, seconds since epoch
+    returns: list of the partitions removed
+    """
+    if retention <= 0:
+        return([])
+    if action not in ('drop', 'detach'):
+        raise ValueError("Unknown retention action " + action)
+    cur = conn.cursor()
+    current = period_start(now if now is not None else datetime.datetime.now(datetime.timezone.utc).timestamp(), interval)
+    cutoff = add_periods(current, -retention, interval).timestamp()
+    removed = []
+    for table in reversed(PARTITIONED_TABLES): # common last
+        if not is_partitioned(cur, table):
+            continue
+        for (name, lower, upper) in list_partitions(cur, table):
+            if upper > cutoff:
+                break
+            if action == 'drop':
+                cur.execute(sql.SQL("DROP TABLE {};").format(sql.Identifier(name)))
+            else:
+                cur.execute(sql.SQL("ALTER TABLE {} DETACH PARTITION {};").format(sql.Identifier(table), sql.Identifier(name)))
+            print(("Dropped " if action == 'drop' else "Detached ") + name)
+            removed.append(name)
+    conn.commit()
+    return(removed)
+
+def dependent_views(cur, tables):
+    """
+    Find the views that read from some tables, directly or through other views
+    cur: psycopg2 database cursor
+    tables: list of table names
+    returns: list of (view name, definition), in creation order
+    """
+    views = {}
+    found = tables
+    while found != []:
+        cur.execute("""SELECT DISTINCT v.oid, v.relname, pg_get_viewdef(v.oid) FROM pg_depend AS d
+                INNER JOIN pg_rewrite AS r ON d.objid=r.oid
+                INNER JOIN pg_class AS v ON r.ev_class=v.oid
+                WHERE d.classid='pg_rewrite'::regclass AND v.relkind='v' AND v.oid<>d.refobjid
+                    AND d.refobjid=ANY(SELECT to_regclass(x) FROM unnest(%s::text[]) AS x);""", (found,))
+        found = []
+        for (oid, name, definition) in cur.fetchall():
+            if name not in views:
+                views[name] = (oid, definition)
+                found.append(name)
+    return([(name, views[name][1]) for name in sorted(views, key=lambda n: views[n][0])])
+
+def convert(conn, interval='month', premake=3, now=None):
+    """
+    Convert the packet tables to tables partitioned by rxtime, in one transaction.
+    Each table keeps its columns, defaults, indexes, triggers, and foreign keys, except that the
+    tables besides common gain an rxtime column (copied from common), primary keys
+    become (pid, rxtime), and foreign keys to common(pid) are dropped (a partitioned
+    common has no unique pid).  Views on the tables are recreated; grants are not, so
+    run db_access_privs.sql again afterwards.
+    conn: psycopg2 database connection
+    interval: 'month' or 'day'
+    premake: number of future periods to create
+    now: current time, seconds since epoch
+    returns: False if the tables were already partitioned, True once converted
+    """
+    cur = conn.cursor()
+    if is_partitioned(cur, 'common'):
+        return(False)
+    views = dependent_views(cur, PARTITIONED_TABLES)
+    for (name, definition) in reversed(views):
+        cur.execute(sql.SQL("DROP VIEW {};").format(sql.Identifier(name)))
+    for table in PARTITIONED_TABLES:
+        print("Partitioning " + table)
+        old = table + '_unpartitioned'
+        # Everything to carry over, read before the rename so definitions name the table itself
+        cur.execute("SELECT column_name FROM information_schema.columns WHERE table_schema=current_schema() AND table_name=%s ORDER BY ordinal_position;", (table,))
+        columns = [x[0] for x in cur.fetchall()]
+        cur.execute("SELECT conname FROM pg_constraint WHERE conrelid=to_regclass(%s) AND contype='p';", (table,))
+        pkey = cur.fetchone()
+        cur.execute("""SELECT indexname, indexdef FROM pg_indexes WHERE schemaname=current_schema() AND tablename=%s
+                AND indexname NOT IN (SELECT conname FROM pg_constraint WHERE conrelid=to_regclass(%s) AND contype IN ('p', 'u'));""", (table, table))
+        indexes = cur.fetchall()
+        cur.execute("""SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+                WHERE conrelid=to_regclass(%s) AND contype='f' AND confrelid<>'common'::regclass;""", (table,))
+        foreign_keys = cur.fetchall()
+        cur.execute("SELECT pg_get_triggerdef(oid) FROM pg_trigger WHERE tgrelid=to_regclass(%s) AND NOT tgisinternal;", (table,))
+        triggers = [x[0] for x in cur.fetchall()] # e.g. common_pending (migration 008), recreated once the rows are copied
+        cur.execute("SELECT x, pg_get_serial_sequence(%s, x) FROM unnest(%s::text[]) AS x;", (table, columns))
+        sequences = [(x[0], x[1]) for x in cur.fetchall() if x[1] is not None]
+
+        cur.execute(sql.SQL("ALTER TABLE {} RENAME TO {};").format(sql.Identifier(table), sql.Identifier(old)))
+        cur.execute(sql.SQL("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS{}) PARTITION BY RANGE (rxtime);").format(
+            sql.Identifier(table), sql.Identifier(old), sql.SQL('') if 'rxtime' in columns else sql.SQL(', rxtime DOUBLE PRECISION')))
+        cur.execute(sql.SQL("CREATE TABLE {} PARTITION OF {} DEFAULT;").format(sql.Identifier(table + '_default'), sql.Identifier(table)))
+        if table == 'common':
+            current = period_start(now if now is not None else datetime.datetime.now(datetime.timezone.utc).timestamp(), interval)
+            periods = data_periods(cur, old, interval) | {add_periods(current, i, interval) for i in range(premake + 1)}
+        for start in sorted(periods):
+            create_partition(cur, table, start, interval)
+
+        if 'rxtime' in columns:
+            cur.execute(sql.SQL("INSERT INTO {} SELECT * FROM {};").format(sql.Identifier(table), sql.Identifier(old)))
+        else:
+            cur.execute(sql.SQL("INSERT INTO {} SELECT o.*, c.rxtime FROM {} AS o LEFT JOIN common AS c ON o.pid=c.pid;").format(
+                sql.Identifier(table), sql.Identifier(old)))
+        for (column, sequence) in sequences: # Keep the sequence when the old table goes
+            cur.execute(sql.SQL("ALTER SEQUENCE {} OWNED BY {}.{};").format(sql.SQL(sequence), sql.Identifier(table), sql.Identifier(column)))
+        cur.execute(sql.SQL("DROP TABLE {} CASCADE;").format(sql.Identifier(old)))
+
+        if pkey is not None:
+            cur.execute(sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} PRIMARY KEY (pid, rxtime);").format(sql.Identifier(table), sql.Identifier(pkey[0])))
+        for (name, definition) in indexes:
+            cur.execute(definition)
+        if 'rxtime' not in columns:
+            cur.execute(sql.SQL("CREATE INDEX {} ON {} (rxtime);").format(sql.Identifier(table + '_rxtime_idx'), sql.Identifier(table)))
+        for (name, definition) in foreign_keys:
+            cur.execute(sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} {};").format(sql.Identifier(table), sql.Identifier(name), sql.SQL(definition)))
+        for definition in triggers:
+            cur.execute(definition)
+        cur.execute(sql.SQL("ANALYZE {};").format(sql.Identifier(table)))
+    for (name, definition) in views:
+        cur.execute(sql.SQL("CREATE VIEW {} AS {}").format(sql.Identifier(name), sql.SQL(definition)))
+    conn.commit()
+    return(True)
@@ -0,0 +1,117 @@
+# aprspipeline.py
+# Threaded read -> parse -> write pipeline for the aprsdb collector
+
+import queue
+import threading
+import time
+
+STOP = object() # Passed down the pipeline at end of input
+
+class MeteredQueue(queue.Queue):
+    """Bounded queue that keeps backpressure statistics: how deep it got,
+    and how often (and for how long) its producer was blocked because it was full.
+    Statistics assume a single producer thread.
+    """
+
+    def __init__(self, name, maxsize):
+        """
+        name: name used in stats()
+        maxsize: most items the queue holds before put() blocks
+        """
+        super().__init__(maxsize)
+        self.name = name
+        self.count = 0 # Items put
+        self.high_water = 0 # Deepest the queue has been
+        self.blocked = 0 # Number of puts that had to wait
+        self.blocked_s = 0.0 # Total time spent waiting
+
+    def put(self, item, timeout=None):
+        """
+        Put an item, waiting (and counting the wait) if the queue is full
+        timeout: longest wait in seconds (None: no limit)
+        raises: queue.Full if the wait timed out
+        """
+        try:
+            super().put(item, block=False)
+        except queue.Full:
+            self.blocked += 1
+            start = time.monotonic()
+            try:
+                super().put(item, timeout=timeout)
+            finally:
+                self.blocked_s += time.monotonic() - start
+        if item is not STOP:
+            self.count += 1
+        self.high_water = max(self.high_water, self.qsize())
+
+    def stats(self):
+        """returns: one-line summary of throughput and backpressure"""
+        return("{}: {} items, depth {}/{} (high water {}), producer blocked {} times for {:.1f} s".format(
+            self.name, self.count, self.qsize(), self.maxsize, self.high_water, self.blocked, self.blocked_s))
+
+class Pipeline:
+    """Run a reader and a parser on their own threads, feeding a writer on the calling thread.
+    The reader returns None at end of input; everything read before that is parsed
+    and handed to the writer before get() returns STOP.
+    """
+
+    def __init__(self, read, parse, queue_size=1000):
+        """
+        read: function returning the next item, or None at end of input
+        parse: function turning a read item into a parsed item (should not raise)
+        queue_size: most items waiting between stages
+        """
+        self.read = read
+        self.parse = parse
+        self.lines = MeteredQueue('read', queue_size)
+        self.parsed = MeteredQueue('parsed', queue_size)
+        self.error = None # Exception that stopped a stage, re-raised by get()
+        self.threads = [threading.Thread(target=self._read_loop, name='aprsdb-read', daemon=True),
+                threading.Thread(target=self._parse_loop, name='aprsdb-parse', daemon=True)]
+
+    def start(self):
+        """Start the reader and parser threads"""
+        for thread in self.threads:
+            thread.start()
+
+    def _read_loop(self):
+        """Stage one: read items until end of input"""
+        try:
+            while True:
+                item = self.read()
+                if item is None:
+                    break
+                self.lines.put(item)
+        except BaseException as e: # Stop the pipeline, and let get() report why
+            self.error = e
+        finally:
+            self.lines.put(STOP)
+
+    def _parse_loop(self):
+        """Stage two: parse items until the reader stops"""
+        try:
+            while True:
+                item = self.lines.get()
+                if item is STOP:
+                    break
+                self.parsed.put(self.parse(item))
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.parsed.put(STOP)
+
+    def get(self, timeout=None):
+        """
+        Get the next parsed item (stage three reads these)
+        timeout: seconds to wait, or None to wait as long as it takes
+        returns: parsed item, or STOP once the pipeline is drained
+        raises: queue.Empty on timeout; the stage's exception if a stage failed
+        """
+        item = self.parsed.get(timeout=timeout)
+        if item is STOP and self.error is not None:
+            raise self.error
+        return item
+
+    def stats(self):
+        """returns: backpressure summary for both queues"""
+        return(self.lines.stats() + '\n' + self.parsed.stats())
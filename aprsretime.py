@@ -0,0 +1,108 @@
+# aprsretime.py
+# Apply sessions.session_offset corrections to stored receive times, in small transactions
+
+import time
+from psycopg2 import sql
+import aprspartition # Tables that carry a copy of rxtime once partitioned
+
+# Copies of common.rxtime besides the partitioned tables (see migrations/003_live_window.sql)
+LIVE_TABLES = ['recent_positions', 'recent_hops']
+
+def pending_sessions(cur):
+    """
+    cur: psycopg2 database cursor
+    returns: list of (session_id, offset still to apply), for sessions whose rows aren't fully corrected
+    """
+    cur.execute("""SELECT s.session_id, coalesce(r.target_offset, s.session_offset) - s.applied_offset FROM sessions AS s
+        LEFT JOIN session_retime AS r ON r.session_id=s.session_id
+        WHERE s.session_offset IS DISTINCT FROM s.applied_offset OR r.session_id IS NOT NULL ORDER BY s.session_id;""")
+    return(cur.fetchall())
+
+def rxtime_tables(cur):
+    """
+    cur: psycopg2 database cursor
+    returns: tables other than common with an rxtime copied from common (keyed on pid)
+    """
+    cur.execute("SELECT table_name FROM information_schema.columns WHERE table_schema=current_schema() AND column_name='rxtime' AND table_name = ANY(%s);",
+            (aprspartition.PARTITIONED_TABLES[1:] + LIVE_TABLES,))
+    return([x[0] for x in cur.fetchall()])
+
+def retime_session(conn, session_id, chunk=10000):
+    """
+    Add the part of a session's session_offset not yet applied to its rows' rxtime, chunk
+    packets per transaction so no lock is held for long.  Progress is kept in
+    session_retime, so an interrupted run resumes without shifting any row twice.
+    Changing session_offset while a re-timing is unfinished takes effect on the next run.
+    conn: psycopg2 database connection
+    session_id: session to correct
+    chunk: packets (and aprsdb_errs rows) per transaction
+    returns: (packets, errors) re-timed
+    """
+    cur = conn.cursor()
+    cur.execute("""INSERT INTO session_retime (session_id, target_offset) SELECT session_id, session_offset FROM sessions
+        WHERE session_id=%s AND session_offset IS DISTINCT FROM applied_offset ON CONFLICT (session_id) DO NOTHING;""", (session_id,))
+    cur.execute("""SELECT r.target_offset - s.applied_offset, r.last_pid, r.last_eid FROM session_retime AS r
+        JOIN sessions AS s ON s.session_id=r.session_id WHERE r.session_id=%s;""", (session_id,))
+    myresult = cur.fetchone()
+    conn.commit()
+    if myresult is None: # Nothing to do
+        return((0, 0))
+    (delta, last_pid, last_eid) = myresult
+    tables = rxtime_tables(cur)
+    packets = 0
+    errors = 0
+    while True: # Packets, with their third-party subpackets (which have no rxsession of their own)
+        cur.execute("SELECT max(pid), count(*) FROM (SELECT pid FROM common WHERE rxsession=%s AND pid > %s ORDER BY pid LIMIT %s) AS c;",
+                (session_id, last_pid, chunk))
+        (upper, count) = cur.fetchone()
+        if upper is None:
+            break
+        cur.execute("""CREATE TEMPORARY TABLE IF NOT EXISTS retime_pids (pid BIGINT PRIMARY KEY) ON COMMIT DELETE ROWS;
+            INSERT INTO retime_pids SELECT pid FROM common WHERE rxsession=%s AND pid > %s AND pid <= %s;
+            INSERT INTO retime_pids SELECT t.subpacket_id FROM thirdparty AS t JOIN retime_pids AS r ON r.pid=t.pid
+                WHERE t.subpacket_id > 0 ON CONFLICT DO NOTHING;""", (session_id, last_pid, upper))
+        for table in ['common'] + tables:
+            cur.execute(sql.SQL("UPDATE {} SET rxtime = rxtime + %s WHERE pid IN (SELECT pid FROM retime_pids);").format(sql.Identifier(table)), (delta,))
+        cur.execute("UPDATE session_retime SET last_pid=%s WHERE session_id=%s;", (upper, session_id))
+        conn.commit()
+        (last_pid, packets) = (upper, packets + count)
+    while True:
+        cur.execute("""UPDATE aprsdb_errs SET rxtime = rxtime + %s WHERE eid IN
+            (SELECT eid FROM aprsdb_errs WHERE rxsession=%s AND eid > %s ORDER BY eid LIMIT %s) RETURNING eid;""", (delta, session_id, last_eid, chunk))
+        eids = [x[0] for x in cur.fetchall()]
+        if eids == []:
+            break
+        last_eid = max(eids)
+        cur.execute("UPDATE session_retime SET last_eid=%s WHERE session_id=%s;", (last_eid, session_id))
+        conn.commit()
+        errors += len(eids)
+    # Mark the offset applied, and let the live window count back from the corrected newest packet
+    cur.execute("UPDATE sessions SET applied_offset=(SELECT target_offset FROM session_retime WHERE session_id=%s) WHERE session_id=%s;", (session_id, session_id))
+    cur.execute("DELETE FROM session_retime WHERE session_id=%s;", (session_id,))
+    cur.execute("UPDATE live_window SET latest_rxtime=(SELECT max(rxtime) FROM common);")
+    conn.commit()
+    return((packets, errors))
+
+def retime(conn, session_ids=None, chunk=10000):
+    """
+    Re-time sessions, printing progress
+    conn: psycopg2 database connection
+    session_ids: sessions to correct (default: every session with an offset not yet applied)
+    chunk: packets per transaction
+    returns: number of packets re-timed
+    """
+    cur = conn.cursor()
+    pending = dict(pending_sessions(cur))
+    conn.commit()
+    if session_ids is None:
+        session_ids = sorted(pending)
+    total = 0
+    for session_id in session_ids:
+        if session_id not in pending:
+            print("Session {}: nothing to apply".format(session_id))
+            continue
+        start = time.time()
+        (packets, errors) = retime_session(conn, session_id, chunk)
+        print("Session {}: {:+.3f} s applied to {} packets and {} errors in {:.1f} s".format(session_id, pending[session_id], packets, errors, time.time() - start))
+        total += packets
+    return(total)
@@ -0,0 +1,59 @@
+# aprssettle.py
+# Settled pid ranges for readers that pick up where they left off (--export, aprsanalytics), so
+# packets still being written, or committed out of pid order, are read once they are complete
+
+import time
+
+SETTLE_S = 60 # Default: packets received this recently may still be getting their positions and hops
+GAP_KEEP_S = 86400 # Missing pids are looked for again for this long (a --bulk chunk or writer batch commits well within it)
+
+# Highest pid before the first packet received within the settle time: without a batch, the collector
+# commits common before map_entry and paths, and other writers commit their pids out of order
+SETTLED_SQL = """SELECT coalesce((SELECT min(pid) - 1 FROM common WHERE pid > %s AND rxtime > extract(epoch FROM now()) - %s),
+        (SELECT max(pid) FROM common WHERE pid > %s), %s);"""
+
+# Runs of pids missing from common within each range (after, upto], e.g. reserved by a writer that hasn't committed
+GAPS_SQL = """WITH r AS (SELECT * FROM unnest(%s::bigint[], %s::bigint[]) AS r(after, upto))
+    SELECT r_after, after, upto FROM (
+        SELECT r_after, lag(pid, 1, r_after) OVER (PARTITION BY r_after ORDER BY pid) AS after, pid - 1 AS upto
+        FROM (SELECT r.after AS r_after, c.pid FROM r INNER JOIN common AS c ON c.pid > r.after AND c.pid <= r.upto
+            UNION ALL SELECT after, upto + 1 FROM r) AS x) AS y
+    WHERE upto > after ORDER BY after;"""
+
+def settled_pid(cur, after_pid, settle_s=SETTLE_S):
+    """
+    cur: cursor, in the reader's snapshot
+    after_pid: highest pid already read
+    settle_s: seconds a packet must have been received before it is read (0 for everything committed)
+    returns: highest pid to read up to (after_pid if there is nothing new)
+    """
+    cur.execute(SETTLED_SQL, (after_pid, settle_s, after_pid, after_pid))
+    return cur.fetchone()[0]
+
+def pid_ranges(gaps, after_pid, to_pid):
+    """
+    gaps: missing pid runs still being looked for, [after, upto, found_utc_s] (as from find_gaps)
+    after_pid, to_pid: new pids to read, (after_pid, to_pid]
+    returns: (afters, uptos), the ranges to read, as arrays for the queries
+    """
+    ranges = [(gap[0], gap[1]) for gap in gaps] + ([(after_pid, to_pid)] if to_pid > after_pid else [])
+    return([x[0] for x in ranges], [x[1] for x in ranges])
+
+def find_gaps(cur, gaps, after_pid, to_pid, keep_s=GAP_KEEP_S):
+    """
+    Work out which pids are still missing after reading pid_ranges(gaps, after_pid, to_pid)
+    cur: cursor, in the snapshot the ranges were read in
+    gaps: gaps before the read
+    after_pid, to_pid: new pids read
+    keep_s: seconds to keep looking for a missing pid (unused reservations and rolled-back packets never appear)
+    returns: the gaps to look in next time, [after, upto, found_utc_s]
+    """
+    now = time.time()
+    found = {gap[0]: gap[2] for gap in gaps} # When each old gap was first missed, by where it starts
+    cur.execute(GAPS_SQL, pid_ranges(gaps, after_pid, to_pid))
+    remaining = []
+    for (range_after, after, upto) in cur.fetchall():
+        found_utc_s = found.get(range_after, now) # What is left of an old gap keeps its age
+        if found_utc_s >= now - keep_s:
+            remaining.append([after, upto, found_utc_s])
+    return remaining
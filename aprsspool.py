@@ -0,0 +1,182 @@
+# aprsspool.py
+# Durable local spool between the radio and the database, so the collector rides out database outages
+
+import sqlite3, threading, time
+import psycopg2
+
+UNAVAILABLE = (psycopg2.OperationalError, psycopg2.InterfaceError) # Lost or refused connections (worth waiting out)
+
+class Spool:
+    """Append-only SQLite file of received packets.  The reader records each packet
+    (raw text, rxtime, and session) here before any database work, and the drainer
+    reads them back in order and deletes them once they are committed.  Entries
+    survive a restart, so packets heard while the database is down are stored when it
+    comes back.  Each thread gets its own SQLite connection.
+    """
+
+    def __init__(self, path, synchronous='NORMAL'):
+        """
+        path: spool file (created if needed)
+        synchronous: SQLite synchronous setting (NORMAL survives a collector crash; FULL also survives power loss)
+        """
+        self.path = path
+        self.synchronous = synchronous
+        self.local = threading.local()
+        self.arrived = threading.Event() # Set on each append, to wake the drainer
+        self.appended = 0
+        self.acked = 0
+        db = self._db()
+        # rxtime has no type, so it comes back exactly as it was given (int or float)
+        db.execute("CREATE TABLE IF NOT EXISTS spool (id INTEGER PRIMARY KEY AUTOINCREMENT, rxtime, rxsession INTEGER, packet TEXT);")
+        db.commit()
+        self.backlog = db.execute("SELECT count(*) FROM spool;").fetchone()[0] # Left over from an earlier run
+
+    def _db(self):
+        """returns: this thread's SQLite connection to the spool"""
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=60)
+            db.execute("PRAGMA journal_mode=WAL;") # Appends don't wait on the drainer's reads
+            db.execute("PRAGMA synchronous={};".format(self.synchronous))
+            self.local.db = db
+        return db
+
+    def append(self, rxtime, rxsession, packet):
+        """
+        Record a received packet durably
+        rxtime: time packet was received, as seconds since epoch
+        rxsession: session_id of the receiving session
+        packet: APRS packet string
+        """
+        db = self._db()
+        db.execute("INSERT INTO spool (rxtime, rxsession, packet) VALUES (?, ?, ?);", (rxtime, rxsession, packet))
+        db.commit()
+        self.appended += 1
+        self.arrived.set()
+
+    def read(self, after_id, limit):
+        """
+        after_id: spool id of the last entry already read (0 for the first)
+        limit: most entries to return
+        returns: list of (id, rxtime, rxsession, packet), oldest first
+        """
+        return self._db().execute("SELECT id, rxtime, rxsession, packet FROM spool WHERE id > ? ORDER BY id LIMIT ?;", (after_id, limit)).fetchall()
+
+    def ack(self, upto_id):
+        """Delete the entries up to and including upto_id, once they are safely in the database"""
+        db = self._db()
+        self.acked += db.execute("DELETE FROM spool WHERE id <= ?;", (upto_id,)).rowcount
+        db.commit()
+
+    def wait(self, timeout):
+        """
+        Wait for an append
+        timeout: most seconds to wait
+        returns: True if a packet was appended since the last wait
+        """
+        arrived = self.arrived.wait(timeout)
+        self.arrived.clear()
+        return arrived
+
+    def depth(self):
+        """returns: number of packets waiting in the spool"""
+        return self.backlog + self.appended - self.acked
+
+class Drainer:
+    """Store spooled packets in the database on a background thread, in order.
+    Entries are deleted from the spool only once their packets are committed.  When
+    the connection is lost, the drainer waits (1 s at first, doubling up to
+    retry_max_s), reconnects, and starts again from the first uncommitted entry, so
+    a packet may be stored twice only if the collector dies between a commit and the
+    spool deletion.  The reader never waits on any of this.
+    """
+
+    def __init__(self, spool, store, flush, flush_after, reconnect, chunk=500, retry_max_s=60):
+        """
+        spool: Spool to drain
+        store: function(rxtime, rxsession, packet) storing one packet, returning True if it
+            and everything stored before it are committed (called on the drainer's thread only)
+        flush: function() committing whatever store() has left uncommitted
+        flush_after: function() returning seconds until uncommitted packets are due to be flushed, or None if there are none
+        reconnect: function() replacing the database connection, forgetting anything uncommitted
+        chunk: most entries read from the spool at a time
+        retry_max_s: longest wait between reconnection attempts, in seconds
+        """
+        self.spool = spool
+        self.store = store
+        self.flush = flush
+        self.flush_after = flush_after
+        self.reconnect = reconnect
+        self.chunk = chunk
+        self.retry_max_s = retry_max_s
+        self.stored = 0
+        self.outages = 0
+        self.outage_s = 0.0 # Time spent waiting for the database
+        self.error = None # Exception that stopped the drainer
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='aprsdb-drain', daemon=True)
+
+    def start(self):
+        """Start draining on the background thread"""
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Finish draining everything spooled so far, then stop
+        timeout: most seconds to wait (anything not yet stored stays in the spool for next time)
+        returns: True if the spool was drained
+        raises: the exception that stopped the drainer, if any
+        """
+        self.stopping.set()
+        self.spool.arrived.set()
+        self.thread.join(timeout)
+        if self.error is not None:
+            raise self.error
+        return not self.thread.is_alive()
+
+    def _run(self):
+        """Store spooled packets until stopped and drained, waiting out database outages"""
+        position = 0 # Last spool id handed to store()
+        committed = 0 # Last spool id known to be committed
+        acked = 0
+        wait = 1.0
+        try:
+            while True:
+                try:
+                    entries = self.spool.read(position, self.chunk)
+                    for (spool_id, rxtime, rxsession, packet) in entries:
+                        if self.store(rxtime, rxsession, packet):
+                            committed = spool_id
+                        position = spool_id
+                        self.stored += 1
+                    if entries == []: # Caught up
+                        due = self.flush_after()
+                        if due is not None and (due == 0 or self.stopping.is_set()):
+                            self.flush()
+                            committed = position
+                        elif self.stopping.is_set():
+                            break
+                        else:
+                            self.spool.wait(1.0 if due is None else min(due, 1.0))
+                    if committed > acked:
+                        self.spool.ack(committed)
+                        acked = committed
+                    wait = 1.0
+                except UNAVAILABLE as e:
+                    self.outages += 1
+                    print("Database unavailable ({}); {} packets spooled, retrying in {:.0f} s".format(str(e).strip(), self.spool.depth(), wait)) # DEBUG
+                    start = time.monotonic()
+                    time.sleep(wait)
+                    wait = min(wait*2, self.retry_max_s)
+                    position = committed # Everything since the last commit is stored again
+                    try:
+                        self.reconnect()
+                    except UNAVAILABLE as e:
+                        print("Reconnect failed: " + str(e).strip()) # DEBUG
+                    self.outage_s += time.monotonic() - start
+        except BaseException as e: # Stop, and let stop() report why
+            self.error = e
+
+    def stats(self):
+        """returns: one-line summary of packets drained and outages waited out"""
+        return("spool: {} packets stored, {} waiting, {} outages ({:.1f} s)".format(self.stored, self.spool.depth(), self.outages, self.outage_s))
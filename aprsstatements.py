@@ -0,0 +1,61 @@
+# aprsstatements.py
+# Server-side prepared INSERT statements for aprsdb, one per table and column set
+
+import collections
+from psycopg2 import sql
+
+class StatementCache:
+    """Prepared INSERT statements, keyed on (table, sorted columns, coda).  Each shape is
+    composed and PREPAREd once per connection, and afterwards sent as a short EXECUTE,
+    so the server skips parsing and planning.  Prepared statements belong to the
+    session and survive rollbacks; they are forgotten (and re-prepared) if the cache is
+    used with a different connection.  Not for use through a transaction-pooling proxy
+    (e.g. pgbouncer in transaction mode), which can't keep session state.
+    """
+
+    def __init__(self, max_size=256):
+        """max_size: most statements kept prepared (least recently used are deallocated)"""
+        self.max_size = max_size
+        self.statements = collections.OrderedDict() # (table, columns, coda): (EXECUTE text, columns)
+        self.conn = None # Connection the statements were prepared on
+        self.prepared = 0 # Total PREPAREs (count of misses)
+        self.hits = 0
+
+    def execute(self, cur, table, mydict, codastring=''):
+        """
+        Insert the keys/values in mydict into table with a prepared statement
+        cur: psycopg2 database cursor
+        table: the table where values will be inserted
+        mydict: dictionary of field:value pairs, all of which will be inserted
+        codastring: string to go at the query's end ('RETURNING pid')
+        """
+        if cur.connection is not self.conn: # New session: nothing is prepared there yet
+            self.statements.clear()
+            self.conn = cur.connection
+        columns = tuple(sorted(mydict))
+        key = (table, columns, codastring)
+        statement = self.statements.get(key)
+        if statement is None:
+            name = "aprsdb_insert_{}".format(self.prepared + 1)
+            cur.execute(sql.SQL("PREPARE {} AS INSERT INTO {} ({}) VALUES ({}) {};").format(
+                    sql.Identifier(name),
+                    sql.Identifier(table),
+                    sql.SQL(', ').join(map(sql.Identifier, columns)),
+                    sql.SQL(', ').join(sql.SQL('$' + str(i + 1)) for i in range(len(columns))),
+                    sql.SQL(codastring)))
+            self.prepared += 1
+            statement = (sql.SQL("EXECUTE {} ({});").format(sql.Identifier(name), sql.SQL(', ').join(sql.Placeholder()*len(columns))).as_string(cur), name)
+            self.statements[key] = statement
+            while len(self.statements) > self.max_size:
+                (_, (_, oldname)) = self.statements.popitem(last=False)
+                cur.execute(sql.SQL("DEALLOCATE {};").format(sql.Identifier(oldname)))
+        else:
+            self.hits += 1
+            self.statements.move_to_end(key)
+        cur.execute(statement[0], [mydict[x] for x in columns])
+
+    def stats(self):
+        """returns: one-line summary of size and hit rate"""
+        total = self.hits + self.prepared
+        rate = 100.0*self.hits/total if total > 0 else 0.0
+        return("statements: {} prepared, {} prepares, {} hits ({:.1f}% hit)".format(len(self.statements), self.prepared, self.hits, rate))
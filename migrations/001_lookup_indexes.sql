@@ -0,0 +1,27 @@
+-- 001_lookup_indexes.sql
+-- B-tree indexes for the columns the collector looks up and the views filter on,
+-- and a unique (src, dest) on routes so new routes can be added with ON CONFLICT
+
+-- Older collectors could add the same route twice; keep the lowest route_id of each
+UPDATE paths AS p1 SET route_id = r1.keep
+	FROM (SELECT route_id, min(route_id) OVER (PARTITION BY src, dest) AS keep FROM routes) AS r1
+	WHERE p1.route_id = r1.route_id AND r1.route_id <> r1.keep;
+DELETE FROM routes AS r1 USING routes AS r2
+	WHERE r1.src = r2.src AND r1.dest = r2.dest AND r1.route_id > r2.route_id;
+CREATE UNIQUE INDEX IF NOT EXISTS route_src_dest ON routes (src, dest);
+
+CREATE INDEX IF NOT EXISTS location_lat_lon_idx ON location (latitude, longitude);
+CREATE INDEX IF NOT EXISTS common_src_idx ON common (src);
+CREATE INDEX IF NOT EXISTS common_rxtime_idx ON common (rxtime);
+CREATE INDEX IF NOT EXISTS common_format_idx ON common (format);
+CREATE INDEX IF NOT EXISTS paths_pid_hop_idx ON paths (pid, hop);
+CREATE INDEX IF NOT EXISTS paths_route_id_idx ON paths (route_id);
+CREATE INDEX IF NOT EXISTS thirdparty_subpacket_id_idx ON thirdparty (subpacket_id);
+CREATE INDEX IF NOT EXISTS map_entry_lid_idx ON map_entry (lid);
+
+ANALYZE location;
+ANALYZE common;
+ANALYZE paths;
+ANALYZE routes;
+ANALYZE thirdparty;
+ANALYZE map_entry;
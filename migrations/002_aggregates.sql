@@ -0,0 +1,158 @@
+-- 002_aggregates.sql
+-- Summary tables for the statistics views, kept current by refresh_aggregates(),
+-- which only reads packets and routes added since the last refresh
+
+CREATE TABLE aggregate_state(
+	name VARCHAR(32) PRIMARY KEY,
+	last_id BIGINT NOT NULL DEFAULT 0, -- High-water mark (common.pid or routes.route_id) already counted
+	refreshed_utc_s DOUBLE PRECISION
+);
+
+INSERT INTO aggregate_state (name) VALUES ('common'), ('routes');
+
+CREATE TABLE station_counts(
+	call VARCHAR(9) PRIMARY KEY,
+	rf_count BIGINT NOT NULL DEFAULT 0, -- Packets from this call (not third-party subpackets)
+	thirdparty_count BIGINT NOT NULL DEFAULT 0, -- Third-party packets from this call
+	heard BIGINT NOT NULL DEFAULT 0, -- Routes ending at this call
+	heard_by BIGINT NOT NULL DEFAULT 0 -- Routes starting at this call
+);
+
+CREATE TABLE route_counts(
+	route_id INTEGER PRIMARY KEY REFERENCES routes(route_id) ON DELETE CASCADE,
+	count BIGINT NOT NULL DEFAULT 0 -- Hops over this route
+);
+
+CREATE TABLE first_hop_counts(
+	src VARCHAR(9) NOT NULL,
+	format VARCHAR(64) NOT NULL,
+	digi VARCHAR(9) NOT NULL,
+	lid BIGINT NOT NULL REFERENCES location(lid) ON DELETE CASCADE, -- Where the source was
+	count BIGINT NOT NULL DEFAULT 0,
+	PRIMARY KEY (src, format, digi, lid)
+);
+
+-- Count packets and routes added since the last refresh.  Counts are exact as long as
+-- only one writer adds packets between refreshes (e.g. the collector, which refreshes
+-- after its own commits); pids committed out of order by overlapping writers may be missed.
+-- returns: number of packets counted
+CREATE FUNCTION refresh_aggregates() RETURNS BIGINT AS $$
+DECLARE
+	from_pid BIGINT;
+	to_pid BIGINT;
+	from_route BIGINT;
+	to_route BIGINT;
+	counted BIGINT := 0;
+BEGIN
+	PERFORM pg_advisory_xact_lock(hashtext('refresh_aggregates')); -- One refresh at a time
+	SELECT last_id INTO from_pid FROM aggregate_state WHERE name='common';
+	SELECT coalesce(max(pid), from_pid) INTO to_pid FROM common WHERE pid > from_pid;
+	SELECT last_id INTO from_route FROM aggregate_state WHERE name='routes';
+	SELECT coalesce(max(route_id), from_route) INTO to_route FROM routes WHERE route_id > from_route;
+
+	IF to_pid > from_pid THEN
+		INSERT INTO station_counts (call, rf_count, thirdparty_count)
+			SELECT src, count(*) FILTER (WHERE is_subpacket=False), count(*) FILTER (WHERE format='thirdparty')
+			FROM common WHERE pid > from_pid AND pid <= to_pid AND src IS NOT NULL
+			GROUP BY src
+		ON CONFLICT (call) DO UPDATE SET rf_count = station_counts.rf_count + EXCLUDED.rf_count,
+			thirdparty_count = station_counts.thirdparty_count + EXCLUDED.thirdparty_count;
+
+		INSERT INTO route_counts (route_id, count)
+			SELECT route_id, count(*) FROM paths
+			WHERE pid > from_pid AND pid <= to_pid AND route_id IS NOT NULL
+			GROUP BY route_id
+		ON CONFLICT (route_id) DO UPDATE SET count = route_counts.count + EXCLUDED.count;
+
+		INSERT INTO first_hop_counts (src, format, digi, lid, count)
+			SELECT c1.src, c1.format, r1.src, e1.lid, count(*)
+			FROM common AS c1
+				INNER JOIN map_entry AS e1 ON c1.pid=e1.pid
+				INNER JOIN paths AS p1 ON p1.pid=c1.pid
+				INNER JOIN routes AS r1 ON p1.route_id=r1.route_id
+			WHERE c1.pid > from_pid AND c1.pid <= to_pid
+				AND p1.hop=1 AND c1.is_subpacket=False AND c1.src IS NOT NULL AND e1.lid IS NOT NULL
+			GROUP BY c1.src, c1.format, r1.src, e1.lid
+		ON CONFLICT (src, format, digi, lid) DO UPDATE SET count = first_hop_counts.count + EXCLUDED.count;
+
+		SELECT count(*) INTO counted FROM common WHERE pid > from_pid AND pid <= to_pid;
+		UPDATE aggregate_state SET last_id=to_pid WHERE name='common';
+	END IF;
+
+	IF to_route > from_route THEN
+		INSERT INTO station_counts (call, heard)
+			SELECT dest, count(*) FROM routes WHERE route_id > from_route AND route_id <= to_route GROUP BY dest
+		ON CONFLICT (call) DO UPDATE SET heard = station_counts.heard + EXCLUDED.heard;
+		INSERT INTO station_counts (call, heard_by)
+			SELECT src, count(*) FROM routes WHERE route_id > from_route AND route_id <= to_route GROUP BY src
+		ON CONFLICT (call) DO UPDATE SET heard_by = station_counts.heard_by + EXCLUDED.heard_by;
+		UPDATE aggregate_state SET last_id=to_route WHERE name='routes';
+	END IF;
+
+	UPDATE aggregate_state SET refreshed_utc_s=extract(epoch FROM now());
+	RETURN counted;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Recount everything (e.g. after old partitions are dropped)
+-- returns: number of packets counted
+CREATE FUNCTION rebuild_aggregates() RETURNS BIGINT AS $$
+BEGIN
+	PERFORM pg_advisory_xact_lock(hashtext('refresh_aggregates'));
+	DELETE FROM station_counts;
+	DELETE FROM route_counts;
+	DELETE FROM first_hop_counts;
+	UPDATE aggregate_state SET last_id=0;
+	RETURN refresh_aggregates();
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT rebuild_aggregates(); -- Count what is already stored
+
+CREATE OR REPLACE VIEW rf_digi_counts AS
+	SELECT ROW_NUMBER() OVER (), d1.call, d1.aprs_sym,
+		d1.aprs_table, s1.rf_count AS count, d1.loc
+	FROM digis AS d1 INNER JOIN station_counts AS s1 ON s1.call=d1.call
+	WHERE s1.rf_count > 0
+	ORDER BY count DESC, d1.call;
+
+CREATE OR REPLACE VIEW first_hops AS
+	SELECT ROW_NUMBER() OVER (ORDER BY f1.src),
+		f1.src,
+		f1.format,
+		d1.call AS digi,
+		ST_SetSRID(ST_MakeLine(d1.loc, l1.linestring), 4326) AS hopline,
+		ST_DistanceSphere(d1.loc, l1.linestring)/1000 AS dist_km,
+		SUM(f1.count)::BIGINT AS count
+	FROM first_hop_counts AS f1
+		INNER JOIN location AS l1 ON f1.lid=l1.lid
+		INNER JOIN digis AS d1 ON f1.digi=d1.call
+	WHERE f1.src NOT IN (SELECT call FROM digis)
+	GROUP BY f1.src, f1.format, d1.call, hopline, dist_km
+	ORDER BY count DESC, f1.src, d1.call, dist_km DESC;
+
+CREATE OR REPLACE VIEW link_stats AS
+	SELECT ROW_NUMBER() OVER (),
+		ST_SetSRID(ST_MakeLine(src.loc, dest.loc), 4326),
+		ST_DistanceSphere(src.loc, dest.loc)/1000 AS dist_km,
+		src.call AS src,
+		dest.call AS dest,
+		n1.count
+	FROM route_counts AS n1 INNER JOIN routes AS r1 ON n1.route_id = r1.route_id
+		INNER JOIN digis AS src ON r1.src = src.call
+		INNER JOIN digis AS dest ON r1.dest = dest.call
+	WHERE n1.count > 0;
+
+CREATE OR REPLACE VIEW tx_igate_counts AS
+	SELECT ROW_NUMBER() OVER (),
+		d1.call,
+		d1.loc,
+		s1.thirdparty_count AS count
+	FROM digis AS d1 INNER JOIN station_counts AS s1 ON s1.call=d1.call
+	WHERE s1.thirdparty_count > 0;
+
+CREATE OR REPLACE VIEW digi_stats AS
+	SELECT d1.*,
+		coalesce(s1.heard,0) AS heard,
+		coalesce(s1.heard_by,0) AS heard_by
+	FROM digis AS d1 LEFT JOIN station_counts AS s1 ON d1.call=s1.call;
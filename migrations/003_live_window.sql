@@ -0,0 +1,140 @@
+-- 003_live_window.sql
+-- Rolling copies of the last hour or so of positions and hops, with the newest rxtime
+-- tracked, so the last-N-minutes views don't scan common for max(rxtime)
+
+CREATE TABLE live_window(
+	id INTEGER PRIMARY KEY DEFAULT 1 CHECK (id = 1), -- Single row
+	last_pid BIGINT NOT NULL DEFAULT 0, -- High-water mark of common.pid already copied
+	latest_rxtime DOUBLE PRECISION -- Newest rxtime stored (what "the last N minutes" count back from)
+);
+
+INSERT INTO live_window (latest_rxtime) SELECT max(rxtime) FROM common;
+
+CREATE TABLE recent_positions(
+	pid BIGINT NOT NULL,
+	rxtime DOUBLE PRECISION NOT NULL,
+	src VARCHAR(9),
+	object_name VARCHAR(16),
+	format VARCHAR(64),
+	symbol CHAR,
+	symbol_table CHAR,
+	lid BIGINT,
+	is_subpacket BOOL,
+	igate VARCHAR(9) -- For third-party subpackets, the station that sent them
+);
+
+CREATE INDEX recent_positions_rxtime_idx ON recent_positions (rxtime);
+
+CREATE TABLE recent_hops(
+	pid BIGINT NOT NULL,
+	rxtime DOUBLE PRECISION NOT NULL,
+	route_id INTEGER
+);
+
+CREATE INDEX recent_hops_rxtime_idx ON recent_hops (rxtime);
+
+-- Copy packets stored since the last refresh into the recent tables, and drop what
+-- has fallen out of the window (same single-writer caveat as refresh_aggregates())
+-- keep_s: seconds before the newest rxtime to keep; windows can't reach back further
+-- returns: number of packets copied
+CREATE FUNCTION refresh_live_window(keep_s DOUBLE PRECISION DEFAULT 3600) RETURNS BIGINT AS $$
+DECLARE
+	from_pid BIGINT;
+	to_pid BIGINT;
+	latest DOUBLE PRECISION;
+	copied BIGINT := 0;
+BEGIN
+	PERFORM pg_advisory_xact_lock(hashtext('refresh_live_window')); -- One refresh at a time
+	SELECT last_pid, latest_rxtime INTO from_pid, latest FROM live_window;
+	SELECT coalesce(max(pid), from_pid), count(*), greatest(max(rxtime), latest) INTO to_pid, copied, latest
+		FROM common WHERE pid > from_pid;
+	IF to_pid > from_pid THEN
+		INSERT INTO recent_positions (pid, rxtime, src, object_name, format, symbol, symbol_table, lid, is_subpacket, igate)
+			SELECT c1.pid, c1.rxtime, c1.src, o1.object_name, c1.format, m1.symbol, m1.symbol_table, m1.lid, c1.is_subpacket, c2.src
+			FROM common AS c1
+				INNER JOIN map_entry AS m1 ON c1.pid=m1.pid
+				LEFT JOIN object AS o1 ON c1.pid=o1.pid
+				LEFT JOIN thirdparty AS t1 ON c1.pid=t1.subpacket_id
+				LEFT JOIN common AS c2 ON t1.pid=c2.pid
+			WHERE c1.pid > from_pid AND c1.pid <= to_pid AND c1.rxtime >= latest - keep_s;
+		INSERT INTO recent_hops (pid, rxtime, route_id)
+			SELECT c1.pid, c1.rxtime, p1.route_id
+			FROM common AS c1 INNER JOIN paths AS p1 ON c1.pid=p1.pid
+			WHERE c1.pid > from_pid AND c1.pid <= to_pid AND c1.rxtime >= latest - keep_s
+				AND c1.is_subpacket=False;
+		UPDATE live_window SET last_pid=to_pid, latest_rxtime=latest;
+	END IF;
+	DELETE FROM recent_positions WHERE rxtime < latest - keep_s;
+	DELETE FROM recent_hops WHERE rxtime < latest - keep_s;
+	RETURN copied;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Windowed versions of the rf_positions, tx_igate_positions, and links views
+-- seconds: how far back from the newest packet to look (up to refresh_live_window's keep_s)
+
+CREATE FUNCTION rf_positions_window(seconds DOUBLE PRECISION)
+RETURNS TABLE(row_number BIGINT, src VARCHAR, format VARCHAR, symbol CHAR, symbol_table CHAR, count BIGINT, linestring GEOMETRY) AS $$
+	SELECT row_number() OVER (),
+		CASE WHEN r1.format='object' THEN r1.object_name
+			ELSE r1.src
+			END,
+		r1.format,
+		r1.symbol,
+		r1.symbol_table,
+		count(l1.linestring),
+		l1.linestring
+	FROM recent_positions AS r1
+		INNER JOIN location AS l1 ON l1.lid=r1.lid
+	WHERE r1.rxtime > (SELECT latest_rxtime FROM live_window) - seconds
+		AND r1.is_subpacket=False
+	GROUP BY r1.src, r1.format, r1.symbol, r1.symbol_table, l1.linestring, r1.object_name;
+$$ LANGUAGE SQL STABLE;
+
+CREATE FUNCTION tx_igate_positions_window(seconds DOUBLE PRECISION)
+RETURNS TABLE(row_number BIGINT, call VARCHAR, src VARCHAR, format VARCHAR, linestring GEOMETRY, count BIGINT, dist_km DOUBLE PRECISION) AS $$
+	SELECT ROW_NUMBER() OVER (),
+		d1.call,
+		r1.src,
+		r1.format,
+		l1.linestring,
+		COUNT(l1.linestring),
+		ST_DistanceSphere(l1.linestring, d1.loc)/1000
+	FROM recent_positions AS r1
+		INNER JOIN location AS l1 ON r1.lid=l1.lid
+		INNER JOIN digis AS d1 ON r1.igate=d1.call
+	WHERE r1.rxtime > (SELECT latest_rxtime FROM live_window) - seconds
+	GROUP BY d1.call, r1.src, r1.format, l1.linestring, ST_DistanceSphere(l1.linestring, d1.loc)/1000;
+$$ LANGUAGE SQL STABLE;
+
+CREATE FUNCTION links_window(seconds DOUBLE PRECISION)
+RETURNS TABLE(row_number BIGINT, st_setsrid GEOMETRY, dist_km DOUBLE PRECISION, src VARCHAR, dest VARCHAR, count BIGINT) AS $$
+	SELECT ROW_NUMBER() OVER(),
+		ST_SetSRID(ST_MakeLine(src.loc, dest.loc), 4326),
+		ST_DistanceSphere(src.loc, dest.loc)/1000,
+		src.call,
+		dest.call,
+		COUNT(*)
+	FROM recent_hops AS h1
+		INNER JOIN routes AS r1 ON r1.route_id=h1.route_id
+		INNER JOIN digis AS src ON r1.src=src.call
+		INNER JOIN digis AS dest ON r1.dest=dest.call
+	WHERE h1.rxtime > (SELECT latest_rxtime FROM live_window) - seconds
+	GROUP BY r1.route_id, src.call, dest.call, src.loc, dest.loc;
+$$ LANGUAGE SQL STABLE;
+
+SELECT refresh_live_window(); -- Fill with the newest hour already stored
+
+DROP VIEW IF EXISTS tx_igate_positions_last_10;
+DROP VIEW IF EXISTS tx_igate_positions_last_60;
+DROP VIEW IF EXISTS rf_positions_last_10;
+DROP VIEW IF EXISTS rf_positions_last_60;
+DROP VIEW IF EXISTS links_last_10;
+DROP VIEW IF EXISTS links_last_60;
+
+CREATE VIEW tx_igate_positions_last_10 AS SELECT * FROM tx_igate_positions_window(600); -- 600 sec = 10 min
+CREATE VIEW tx_igate_positions_last_60 AS SELECT * FROM tx_igate_positions_window(3600); -- 3600 sec = 60 min
+CREATE VIEW rf_positions_last_10 AS SELECT * FROM rf_positions_window(600);
+CREATE VIEW rf_positions_last_60 AS SELECT * FROM rf_positions_window(3600);
+CREATE VIEW links_last_10 AS SELECT * FROM links_window(600);
+CREATE VIEW links_last_60 AS SELECT * FROM links_window(3600);
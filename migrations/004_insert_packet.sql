@@ -0,0 +1,151 @@
+-- 004_insert_packet.sql
+-- Store a whole packet in one call (aprsdb's server_insert mode), for collectors far
+-- from the database: the client sends the rows it would have inserted one by one,
+-- and the lookups and upserts of digis, locations, and routes happen here.
+
+-- Insert a row given as a JSON object (keys are column names)
+-- tbl: table name
+-- r: the row; values are converted to the column types as if typed in as text
+-- returning_col: column to return (e.g. pid), or NULL
+-- returns: the returning_col value of the new row, or NULL
+CREATE FUNCTION insert_json_row(tbl TEXT, r JSONB, returning_col TEXT DEFAULT NULL) RETURNS BIGINT AS $$
+DECLARE
+	cols TEXT;
+	result BIGINT;
+BEGIN
+	SELECT string_agg(quote_ident(k), ', ') INTO cols FROM jsonb_object_keys(r) AS k;
+	IF returning_col IS NULL THEN
+		EXECUTE format('INSERT INTO %I (%s) SELECT %s FROM jsonb_populate_record(NULL::%I, $1)', tbl, cols, cols, tbl) USING r;
+	ELSE
+		EXECUTE format('INSERT INTO %I (%s) SELECT %s FROM jsonb_populate_record(NULL::%I, $1) RETURNING %I', tbl, cols, cols, tbl, returning_col)
+			USING r INTO result;
+	END IF;
+	RETURN result;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Fill in ids the client couldn't know (pid, lid, subpacket_id), for the keys the row already has
+CREATE FUNCTION fill_json_ids(r JSONB, ids JSONB) RETURNS JSONB AS $$
+	SELECT r || coalesce((SELECT jsonb_object_agg(key, value) FROM jsonb_each(ids) WHERE r ? key), '{}'::JSONB);
+$$ LANGUAGE SQL IMMUTABLE;
+
+-- Add a digipeater by call alone, if it is new
+CREATE FUNCTION known_digi(digi_call TEXT) RETURNS VOID AS $$
+	INSERT INTO digis (call) SELECT digi_call
+		WHERE NOT EXISTS (SELECT 1 FROM digis WHERE call=digi_call)
+		ON CONFLICT (call) DO NOTHING;
+$$ LANGUAGE SQL;
+
+-- Add a digipeater, or update its symbol and location (as aprsdb.py process_digi does)
+-- d: {"call", "symbol", "symbol_table", "longitude", "latitude", "loc" (hex EWKB)}
+CREATE FUNCTION upsert_digi(d JSONB) RETURNS VOID AS $$
+DECLARE
+	old RECORD;
+BEGIN
+	SELECT digi_id, aprs_sym, aprs_table, ST_X(loc) AS lon, ST_Y(loc) AS lat INTO old FROM digis WHERE call=d->>'call';
+	IF NOT FOUND THEN
+		INSERT INTO digis (call, aprs_sym, aprs_table, loc) VALUES (d->>'call', d->>'symbol', d->>'symbol_table', (d->>'loc')::geometry)
+			ON CONFLICT (call) DO NOTHING;
+	ELSIF old.aprs_sym = '#' AND d->>'symbol' IS DISTINCT FROM '#' THEN
+		RETURN; -- Ignore non-unique gates
+	ELSIF old.lon IS DISTINCT FROM (d->>'longitude')::DOUBLE PRECISION OR old.lat IS DISTINCT FROM (d->>'latitude')::DOUBLE PRECISION
+			OR old.aprs_sym IS DISTINCT FROM d->>'symbol' OR old.aprs_table IS DISTINCT FROM d->>'symbol_table' THEN
+		UPDATE digis SET loc=(d->>'loc')::geometry, aprs_sym=d->>'symbol', aprs_table=d->>'symbol_table' WHERE digi_id=old.digi_id;
+	END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Store one packet, as aprsdb.py process_parsed does, and return its pid
+-- p: {"common": row, "errs": aprsdb_errs row (without msg),
+--     "digi": digi (see upsert_digi) if the packet has a symbol, "thirdparty_src": call of a third-party packet's sender,
+--     "subpacket": the same structure for a third-party packet's contents,
+--     "wx": wx row for non-wx packets with weather,
+--     "location": location row, "map_entry": row, "format_table": table name, "format_row": row,
+--     "path": digipeater calls (WIDEn-N removed) for RF packets, "rxcall": receiving station, "path_extra": extra paths columns}
+-- Rows carry null pid/lid/subpacket_id keys where those ids belong.
+-- returns: pid; -4 if the third-party subpacket couldn't be stored; -7 for bad data (logged to aprsdb_errs)
+CREATE FUNCTION insert_packet(p JSONB) RETURNS BIGINT AS $$
+DECLARE
+	new_pid BIGINT;
+	new_lid BIGINT;
+	sub_id BIGINT;
+	fmt TEXT := p->'common'->>'format';
+	src_call TEXT := p->'common'->>'src';
+	calls TEXT[];
+	digi_src BOOLEAN;
+	new_route BIGINT;
+BEGIN
+	new_pid := insert_json_row('common', p->'common', 'pid');
+
+	IF p ? 'digi' THEN -- Digis and igates are # and &; also watch for known digis using other symbols
+		IF p->'digi'->>'symbol' IN ('#', '&')
+				OR (fmt NOT IN ('object', 'item') AND EXISTS (SELECT 1 FROM digis WHERE call=src_call)) THEN
+			IF p->'digi'->>'loc' IS NOT NULL THEN
+				PERFORM upsert_digi(p->'digi');
+			END IF;
+		END IF;
+	END IF;
+
+	IF p ? 'subpacket' THEN -- Third-party packet
+		PERFORM known_digi(p->>'thirdparty_src');
+		sub_id := insert_packet(p->'subpacket');
+		IF sub_id < 0 THEN
+			RAISE EXCEPTION 'Unable to store third-party subpacket' USING ERRCODE = 'AP004';
+		END IF;
+	END IF;
+
+	IF p ? 'wx' THEN -- Weather from an object or position
+		PERFORM insert_json_row('wx', fill_json_ids(p->'wx', jsonb_build_object('pid', new_pid, 'subpacket_id', sub_id)));
+	END IF;
+
+	IF p ? 'location' THEN
+		SELECT lid INTO new_lid FROM location
+			WHERE latitude=(p->'location'->>'latitude')::DOUBLE PRECISION AND longitude=(p->'location'->>'longitude')::DOUBLE PRECISION
+			LIMIT 1;
+		IF new_lid IS NULL THEN
+			new_lid := insert_json_row('location', p->'location', 'lid');
+		END IF;
+		PERFORM insert_json_row('map_entry', fill_json_ids(p->'map_entry', jsonb_build_object('pid', new_pid, 'lid', new_lid)));
+	END IF;
+
+	IF p ? 'format_table' THEN
+		PERFORM insert_json_row(p->>'format_table', fill_json_ids(p->'format_row', jsonb_build_object('pid', new_pid, 'lid', new_lid, 'subpacket_id', sub_id)));
+	END IF;
+
+	IF p ? 'path' THEN -- RF path, one paths row per hop
+		calls := ARRAY(SELECT jsonb_array_elements_text(p->'path'));
+		digi_src := EXISTS (SELECT 1 FROM digis WHERE call=src_call);
+		IF digi_src THEN
+			calls := src_call || calls; -- First hop is from the digi itself (hop 0)
+		END IF;
+		IF cardinality(calls) > 0 THEN
+			FOR i IN 1..cardinality(calls) LOOP
+				PERFORM known_digi(calls[i]);
+			END LOOP;
+			calls := calls || (p->>'rxcall'); -- All packets end at RX site
+			FOR i IN 1..cardinality(calls)-1 LOOP
+				SELECT route_id INTO new_route FROM routes WHERE src=calls[i] AND dest=calls[i+1];
+				IF NOT FOUND THEN
+					INSERT INTO routes (src, dest) VALUES (calls[i], calls[i+1]) ON CONFLICT (src, dest) DO NOTHING RETURNING route_id INTO new_route;
+					IF new_route IS NULL THEN -- Added by another writer meanwhile
+						SELECT route_id INTO new_route FROM routes WHERE src=calls[i] AND dest=calls[i+1];
+					END IF;
+				END IF;
+				PERFORM insert_json_row('paths', jsonb_build_object('pid', new_pid, 'hop', CASE WHEN digi_src THEN i-1 ELSE i END, 'route_id', new_route)
+					|| coalesce(p->'path_extra', '{}'::JSONB));
+			END LOOP;
+		END IF;
+	END IF;
+
+	RETURN new_pid;
+EXCEPTION
+	WHEN data_exception OR integrity_constraint_violation THEN -- Bad packet data; log it and drop only this packet
+		INSERT INTO aprsdb_errs (rxtime, rxsession, raw, msg) SELECT rxtime, rxsession, raw, left(SQLERRM, 512)
+			FROM jsonb_populate_record(NULL::aprsdb_errs, p->'errs');
+		RETURN -7;
+	WHEN SQLSTATE 'AP004' THEN
+		INSERT INTO aprsdb_errs (rxtime, rxsession, raw, msg) SELECT rxtime, rxsession, raw, SQLERRM
+			FROM jsonb_populate_record(NULL::aprsdb_errs, p->'errs');
+		RETURN -4;
+END;
+$$ LANGUAGE plpgsql;
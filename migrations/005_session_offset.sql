@@ -0,0 +1,20 @@
+-- 005_session_offset.sql
+-- Receive-time corrections applied to the stored rows themselves, so queries on rxtime
+-- use its index instead of joining sessions to add session_offset to every row
+
+-- Corrections come from clock differences, so they aren't whole seconds
+ALTER TABLE sessions ALTER COLUMN session_offset TYPE DOUBLE PRECISION;
+-- How much of session_offset has been added to the session's rxtime values (aprsdb.py --retime applies the rest)
+ALTER TABLE sessions ADD COLUMN applied_offset DOUBLE PRECISION NOT NULL DEFAULT 0;
+
+-- Re-timings in progress, so an interrupted one picks up where it stopped instead of shifting rows twice
+CREATE TABLE session_retime(
+	session_id BIGINT PRIMARY KEY REFERENCES sessions(session_id) ON DELETE CASCADE,
+	target_offset DOUBLE PRECISION NOT NULL, -- session_offset being applied
+	last_pid BIGINT NOT NULL DEFAULT 0, -- Highest common.pid of the session already shifted
+	last_eid BIGINT NOT NULL DEFAULT 0 -- Highest aprsdb_errs.eid of the session already shifted
+);
+
+-- Find a session's rows without scanning the tables
+CREATE INDEX IF NOT EXISTS common_rxsession_idx ON common (rxsession, pid);
+CREATE INDEX IF NOT EXISTS aprsdb_errs_rxsession_idx ON aprsdb_errs (rxsession, eid);
@@ -0,0 +1,4 @@
+-- 006_session_receiver.sql
+-- Which receiver a session belongs to, now that one collector can run several (aprsdb.py --kiss)
+
+ALTER TABLE sessions ADD COLUMN receiver VARCHAR(64); -- [receiver NAME] config section, or NULL for a single-station collector
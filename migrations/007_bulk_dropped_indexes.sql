@@ -0,0 +1,9 @@
+-- 007_bulk_dropped_indexes.sql
+-- Indexes the bulk loader has dropped for a load, so that a load killed before rebuilding them
+-- doesn't lose them for good (aprsdb.py --maintain, or the next --bulk, rebuilds them)
+
+CREATE TABLE IF NOT EXISTS bulk_dropped_indexes(
+	name VARCHAR(64) PRIMARY KEY,
+	definition TEXT NOT NULL,
+	dropped_utc_s DOUBLE PRECISION
+);
@@ -0,0 +1,178 @@
+-- 008_pending_ids.sql
+-- Gap-safe refreshes of the summary tables and the live window.  New packets and routes
+-- are queued by triggers as they are inserted, and each refresh takes the queued ids that
+-- have been committed, leaving the rest for the next one.  (A high-water mark of pid missed
+-- packets committed late with lower pids than ones already counted, e.g. from a --kiss
+-- writer pool or a --bulk load next to a running collector.)
+
+CREATE TABLE pending_ids(
+	queue VARCHAR(16) NOT NULL, -- 'aggregates' and 'live' (common.pid), or 'routes' (routes.route_id)
+	id BIGINT NOT NULL
+);
+
+CREATE FUNCTION queue_pending_pids() RETURNS TRIGGER AS $$
+BEGIN
+	INSERT INTO pending_ids (queue, id)
+		SELECT q.queue, n.pid FROM new_rows AS n CROSS JOIN (VALUES ('aggregates'), ('live')) AS q(queue);
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION queue_pending_routes() RETURNS TRIGGER AS $$
+BEGIN
+	INSERT INTO pending_ids (queue, id) SELECT 'routes', route_id FROM new_rows;
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER common_pending AFTER INSERT ON common REFERENCING NEW TABLE AS new_rows
+	FOR EACH STATEMENT EXECUTE FUNCTION queue_pending_pids();
+CREATE TRIGGER routes_pending AFTER INSERT ON routes REFERENCING NEW TABLE AS new_rows
+	FOR EACH STATEMENT EXECUTE FUNCTION queue_pending_routes();
+
+-- Make sure this session has refresh_batch, the ids a refresh is counting (emptied at commit)
+CREATE FUNCTION create_refresh_batch() RETURNS VOID AS $$
+BEGIN
+	IF to_regclass('pg_temp.refresh_batch') IS NULL THEN
+		CREATE TEMPORARY TABLE refresh_batch(queue VARCHAR(16), id BIGINT) ON COMMIT DELETE ROWS;
+	END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Move a queue's committed ids from pending_ids to refresh_batch; ids still being written stay queued
+CREATE FUNCTION take_pending(batch_queue VARCHAR) RETURNS VOID AS $$
+BEGIN
+	PERFORM create_refresh_batch();
+	DELETE FROM refresh_batch WHERE queue=batch_queue;
+	WITH taken AS (DELETE FROM pending_ids WHERE queue=batch_queue RETURNING id) -- Only sees committed rows
+		INSERT INTO refresh_batch (queue, id) SELECT DISTINCT batch_queue, id FROM taken;
+	ANALYZE refresh_batch; -- So the counts join it to the packet tables by index
+END;
+$$ LANGUAGE plpgsql;
+
+-- Count the packets and routes in refresh_batch into the summary tables
+-- returns: number of packets counted
+CREATE FUNCTION count_refresh_batch() RETURNS BIGINT AS $$
+DECLARE
+	counted BIGINT;
+BEGIN
+	INSERT INTO station_counts (call, rf_count, thirdparty_count)
+		SELECT c1.src, count(*) FILTER (WHERE c1.is_subpacket=False), count(*) FILTER (WHERE c1.format='thirdparty')
+		FROM refresh_batch AS b INNER JOIN common AS c1 ON c1.pid=b.id
+		WHERE b.queue='aggregates' AND c1.src IS NOT NULL
+		GROUP BY c1.src
+	ON CONFLICT (call) DO UPDATE SET rf_count = station_counts.rf_count + EXCLUDED.rf_count,
+		thirdparty_count = station_counts.thirdparty_count + EXCLUDED.thirdparty_count;
+
+	INSERT INTO route_counts (route_id, count)
+		SELECT p1.route_id, count(*)
+		FROM refresh_batch AS b INNER JOIN paths AS p1 ON p1.pid=b.id
+		WHERE b.queue='aggregates' AND p1.route_id IS NOT NULL
+		GROUP BY p1.route_id
+	ON CONFLICT (route_id) DO UPDATE SET count = route_counts.count + EXCLUDED.count;
+
+	INSERT INTO first_hop_counts (src, format, digi, lid, count)
+		SELECT c1.src, c1.format, r1.src, e1.lid, count(*)
+		FROM refresh_batch AS b
+			INNER JOIN common AS c1 ON c1.pid=b.id
+			INNER JOIN map_entry AS e1 ON c1.pid=e1.pid
+			INNER JOIN paths AS p1 ON p1.pid=c1.pid
+			INNER JOIN routes AS r1 ON p1.route_id=r1.route_id
+		WHERE b.queue='aggregates' AND p1.hop=1 AND c1.is_subpacket=False AND c1.src IS NOT NULL AND e1.lid IS NOT NULL
+		GROUP BY c1.src, c1.format, r1.src, e1.lid
+	ON CONFLICT (src, format, digi, lid) DO UPDATE SET count = first_hop_counts.count + EXCLUDED.count;
+
+	INSERT INTO station_counts (call, heard)
+		SELECT r1.dest, count(*) FROM refresh_batch AS b INNER JOIN routes AS r1 ON r1.route_id=b.id
+		WHERE b.queue='routes' GROUP BY r1.dest
+	ON CONFLICT (call) DO UPDATE SET heard = station_counts.heard + EXCLUDED.heard;
+	INSERT INTO station_counts (call, heard_by)
+		SELECT r1.src, count(*) FROM refresh_batch AS b INNER JOIN routes AS r1 ON r1.route_id=b.id
+		WHERE b.queue='routes' GROUP BY r1.src
+	ON CONFLICT (call) DO UPDATE SET heard_by = station_counts.heard_by + EXCLUDED.heard_by;
+
+	SELECT count(*) INTO counted FROM refresh_batch AS b INNER JOIN common AS c1 ON c1.pid=b.id WHERE b.queue='aggregates';
+	-- last_id is now only the highest id counted, for reference
+	UPDATE aggregate_state SET last_id=greatest(last_id, (SELECT max(id) FROM refresh_batch WHERE queue='aggregates')) WHERE name='common';
+	UPDATE aggregate_state SET last_id=greatest(last_id, (SELECT max(id) FROM refresh_batch WHERE queue='routes')) WHERE name='routes';
+	UPDATE aggregate_state SET refreshed_utc_s=extract(epoch FROM now());
+	RETURN counted;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Count packets and routes committed since the last refresh.  Each is counted once, whatever
+-- order writers commit in; packets still being written are counted by a later refresh.
+-- returns: number of packets counted
+CREATE OR REPLACE FUNCTION refresh_aggregates() RETURNS BIGINT AS $$
+BEGIN
+	PERFORM pg_advisory_xact_lock(hashtext('refresh_aggregates')); -- One refresh at a time
+	PERFORM take_pending('aggregates');
+	PERFORM take_pending('routes');
+	RETURN count_refresh_batch();
+END;
+$$ LANGUAGE plpgsql;
+
+-- Recount everything, e.g. after old partitions are dropped, or to recover counts from before
+-- this migration (packets a high-water mark skipped).  Waits for writers in progress, and holds
+-- off new ones until it commits, so nothing is counted twice.
+-- returns: number of packets counted
+CREATE OR REPLACE FUNCTION rebuild_aggregates() RETURNS BIGINT AS $$
+BEGIN
+	PERFORM pg_advisory_xact_lock(hashtext('refresh_aggregates'));
+	LOCK TABLE pending_ids IN SHARE ROW EXCLUSIVE MODE;
+	DELETE FROM station_counts;
+	DELETE FROM route_counts;
+	DELETE FROM first_hop_counts;
+	DELETE FROM pending_ids WHERE queue IN ('aggregates', 'routes');
+	UPDATE aggregate_state SET last_id=0;
+	PERFORM create_refresh_batch();
+	DELETE FROM refresh_batch WHERE queue IN ('aggregates', 'routes');
+	INSERT INTO refresh_batch (queue, id) SELECT 'aggregates', pid FROM common;
+	INSERT INTO refresh_batch (queue, id) SELECT 'routes', route_id FROM routes;
+	ANALYZE refresh_batch;
+	RETURN count_refresh_batch();
+END;
+$$ LANGUAGE plpgsql;
+
+-- Copy packets committed since the last refresh into the recent tables, and drop what
+-- has fallen out of the window
+-- keep_s: seconds before the newest rxtime to keep; windows can't reach back further
+-- returns: number of packets taken
+CREATE OR REPLACE FUNCTION refresh_live_window(keep_s DOUBLE PRECISION DEFAULT 3600) RETURNS BIGINT AS $$
+DECLARE
+	latest DOUBLE PRECISION;
+	copied BIGINT := 0;
+BEGIN
+	PERFORM pg_advisory_xact_lock(hashtext('refresh_live_window')); -- One refresh at a time
+	PERFORM take_pending('live');
+	SELECT latest_rxtime INTO latest FROM live_window;
+	SELECT count(*), greatest(max(c1.rxtime), latest) INTO copied, latest
+		FROM refresh_batch AS b INNER JOIN common AS c1 ON c1.pid=b.id WHERE b.queue='live';
+	IF copied > 0 THEN
+		INSERT INTO recent_positions (pid, rxtime, src, object_name, format, symbol, symbol_table, lid, is_subpacket, igate)
+			SELECT c1.pid, c1.rxtime, c1.src, o1.object_name, c1.format, m1.symbol, m1.symbol_table, m1.lid, c1.is_subpacket, c2.src
+			FROM refresh_batch AS b
+				INNER JOIN common AS c1 ON c1.pid=b.id
+				INNER JOIN map_entry AS m1 ON c1.pid=m1.pid
+				LEFT JOIN object AS o1 ON c1.pid=o1.pid
+				LEFT JOIN thirdparty AS t1 ON c1.pid=t1.subpacket_id
+				LEFT JOIN common AS c2 ON t1.pid=c2.pid
+			WHERE b.queue='live' AND c1.rxtime >= latest - keep_s;
+		INSERT INTO recent_hops (pid, rxtime, route_id)
+			SELECT c1.pid, c1.rxtime, p1.route_id
+			FROM refresh_batch AS b
+				INNER JOIN common AS c1 ON c1.pid=b.id
+				INNER JOIN paths AS p1 ON c1.pid=p1.pid
+			WHERE b.queue='live' AND c1.rxtime >= latest - keep_s
+				AND c1.is_subpacket=False;
+		UPDATE live_window SET last_pid=greatest(last_pid, (SELECT max(id) FROM refresh_batch WHERE queue='live')), latest_rxtime=latest;
+	END IF;
+	DELETE FROM recent_positions WHERE rxtime < latest - keep_s;
+	DELETE FROM recent_hops WHERE rxtime < latest - keep_s;
+	RETURN copied;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Packets stored since the last live window refresh, and everything else recounted
+INSERT INTO pending_ids (queue, id) SELECT 'live', pid FROM common WHERE pid > (SELECT last_pid FROM live_window);
+SELECT rebuild_aggregates();
@@ -1,3 +1,4 @@
+DROP TABLE IF EXISTS session_retime;
 DROP TABLE sessions CASCADE;
 DROP TABLE common CASCADE;
 DROP TABLE aprsdb_errs CASCADE;
@@ -27,3 +28,11 @@ DROP VIEW IF EXISTS heard_digi;
 DROP VIEW IF EXISTS heard_non_digi;
 DROP INDEX location_idx;
 DROP INDEX digi_spatial_idx;
+DROP TABLE IF EXISTS schema_version;
+DROP TABLE IF EXISTS aggregate_state, station_counts, route_counts, first_hop_counts CASCADE;
+DROP TABLE IF EXISTS live_window, recent_positions, recent_hops CASCADE;
+DROP TABLE IF EXISTS pending_ids, bulk_dropped_indexes CASCADE;
+DROP FUNCTION IF EXISTS refresh_aggregates(), rebuild_aggregates(), refresh_live_window(DOUBLE PRECISION),
+	rf_positions_window(DOUBLE PRECISION), tx_igate_positions_window(DOUBLE PRECISION), links_window(DOUBLE PRECISION),
+	insert_packet(JSONB), upsert_digi(JSONB), known_digi(TEXT), fill_json_ids(JSONB, JSONB), insert_json_row(TEXT, JSONB, TEXT),
+	queue_pending_pids(), queue_pending_routes(), create_refresh_batch(), take_pending(VARCHAR), count_refresh_batch() CASCADE;
@@ -0,0 +1,82 @@
+# test_aprsgps.py
+# PositionProvider polling a FakeGpsd
+# Run from the repository directory: python -m pytest tests (or python -m unittest discover tests)
+
+import os, sys, time, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+try:
+    import gpsd # aprsgps needs gpsd-py3; the collector follows the GPS (rover mode) when it is installed and [gps] enabled is true (the default)
+    import aprsgps
+except ImportError:
+    gpsd = None
+
+@unittest.skipIf(gpsd is None, "gpsd-py3 is not installed")
+class TestPositionProvider(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = aprsgps.FakeGpsd(45.0, -93.0, mode=1)
+        self.fake.start()
+        self.updates = [] # (latitude, longitude) given to update()
+        self.provider = aprsgps.PositionProvider(self.update, min_move_m=50, port=self.fake.port)
+        gpsd.connect('127.0.0.1', self.fake.port)
+
+    def tearDown(self):
+        self.fake.stop()
+
+    def update(self, latitude, longitude):
+        self.updates.append((latitude, longitude))
+        return len(self.updates) # rx_loc_id
+
+    def test_no_fix(self):
+        self.assertFalse(self.provider.poll())
+        self.assertIsNone(self.provider.fix)
+        self.assertEqual((self.updates, self.provider.polls, self.fake.polls), ([], 1, 1))
+
+    def test_first_fix(self):
+        self.fake.move(45.12344, -93.12346, mode=2)
+        self.assertTrue(self.provider.poll())
+        self.assertEqual(self.updates, [(45.1234, -93.1235)]) # Rounded to DD.DDDD
+        self.assertEqual(self.provider.fix[:3], (45.1234, -93.1235, 1))
+
+    def test_below_min_move(self):
+        self.fake.move(45.0, -93.0, mode=3)
+        self.assertTrue(self.provider.poll())
+        fix = self.provider.fix
+        self.fake.move(45.0003, -93.0003) # About 40 m
+        self.assertFalse(self.provider.poll())
+        self.assertIs(self.provider.fix, fix)
+        self.fake.move(45.0, -93.0, mode=1) # Losing the fix keeps the last one
+        self.assertFalse(self.provider.poll())
+        self.assertIs(self.provider.fix, fix)
+        self.assertEqual(len(self.updates), 1)
+
+    def test_moved(self):
+        self.fake.move(45.0, -93.0, mode=3)
+        self.assertTrue(self.provider.poll())
+        self.fake.move(45.0005, -93.0) # About 56 m
+        self.assertTrue(self.provider.poll())
+        self.assertEqual(self.updates, [(45.0, -93.0), (45.0005, -93.0)])
+        self.assertEqual(self.provider.fix[:3], (45.0005, -93.0, 2))
+        self.assertEqual((self.provider.polls, self.provider.updates), (2, 2))
+
+    def test_thread(self):
+        """The background thread connects itself and publishes the fix"""
+        self.fake.move(45.0, -93.0, mode=3)
+        self.provider.interval_s = 0.05
+        self.provider.start()
+        start = time.time()
+        while self.provider.fix is None and time.time() - start < 5:
+            time.sleep(0.02)
+        self.provider.stop(5)
+        self.assertEqual(self.provider.fix[:2], (45.0, -93.0))
+        self.assertEqual(self.provider.errors, 0)
+
+@unittest.skipIf(gpsd is None, "gpsd-py3 is not installed")
+class TestDistance(unittest.TestCase):
+
+    def test_distance_m(self):
+        self.assertAlmostEqual(aprsgps.distance_m(45.0, -93.0, 46.0, -93.0), 111195, delta=5) # One degree of latitude
+        self.assertEqual(aprsgps.distance_m(45.0, -93.0, 45.0, -93.0), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+# test_aprskiss.py
+# KISS decoding, and KissClient reading from a FakeKiss endpoint
+# Run from the repository directory: python -m pytest tests (or python -m unittest discover tests)
+
+import os, queue, sys, time, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import aprsdirewolf, aprskiss
+
+PACKETS = ["N0CALL-9>APRS,WIDE1-1,WIDE2-1:!4500.00N/09300.00W>moving",
+    "K0ABC>APDW16,K0DIG-1*,WIDE2-1:>status text",
+    "W0XYZ-7>T0SRTQ,K0DIG-1,K0DIG-2*:`b7Rl_>/]\"4)}="]
+
+def wait_for(condition, timeout=5.0):
+    """Wait until condition() is true, or timeout seconds pass; returns: condition()"""
+    start = time.time()
+    while not condition() and time.time() - start < timeout:
+        time.sleep(0.02)
+    return condition()
+
+class TestKissDecoder(unittest.TestCase):
+
+    def test_round_trip(self):
+        for packet in PACKETS:
+            self.assertEqual(aprskiss.ax25_to_tnc2(aprskiss.tnc2_to_ax25(packet)), packet)
+
+    def test_repeated_marker(self):
+        """Only the last digipeater that has repeated it is starred, as Direwolf prints it"""
+        frame = aprskiss.tnc2_to_ax25("K0ABC>APRS,K0DIG-1,K0DIG-2*,WIDE2-1:>x")
+        self.assertEqual(aprskiss.ax25_to_tnc2(frame), "K0ABC>APRS,K0DIG-1,K0DIG-2*,WIDE2-1:>x")
+
+    def test_split_frames(self):
+        """Frames arriving a byte at a time, or several in one read, come out whole"""
+        stream = b''.join(aprskiss.kiss_frame(aprskiss.tnc2_to_ax25(packet), n) for (n, packet) in enumerate(PACKETS))
+        decoder = aprskiss.KissDecoder()
+        frames = []
+        for n in range(len(stream)):
+            frames += decoder.feed(stream[n:n+1])
+        self.assertEqual([(port, aprskiss.ax25_to_tnc2(frame)) for (port, command, frame) in frames], list(enumerate(PACKETS)))
+        self.assertEqual(aprskiss.KissDecoder().feed(stream + stream)[3:], aprskiss.KissDecoder().feed(stream))
+
+    def test_escaping(self):
+        """FEND and FESC in the frame are escaped on the wire and restored by the decoder"""
+        frame = aprskiss.tnc2_to_ax25("N0CALL>APRS:>a") + bytes([0xC0]) + b'b' + bytes([0xDB]) + b'c' + bytes([0xDB, 0xDC]) + b'd' + bytes([0xDB, 0xDD])
+        wire = aprskiss.kiss_frame(frame, 2)
+        self.assertEqual(wire.count(aprskiss.FEND), 2) # Only the frame delimiters
+        self.assertIn(bytes([aprskiss.FESC, aprskiss.TFEND]), wire)
+        self.assertIn(bytes([aprskiss.FESC, aprskiss.TFESC]), wire)
+        decoder = aprskiss.KissDecoder()
+        frames = decoder.feed(wire[:wire.index(aprskiss.FESC) + 1]) + decoder.feed(wire[wire.index(aprskiss.FESC) + 1:]) # Split inside an escape
+        self.assertEqual(frames, [(2, 0, frame)])
+        self.assertEqual(aprskiss.ax25_to_tnc2(frames[0][2]), "N0CALL>APRS:>a\xc0b\xdbc\xdb\xdcd\xdb\xdd") # Not UTF-8: one character per byte
+
+    def test_info_text(self):
+        """The info field reads as the stdin path stores it: UTF-8, other bytes as Direwolf's <0xNN> escapes unescape"""
+        packet = "N0CALL>APRS:>caf\xe9 \u2192 ok"
+        self.assertTrue(aprskiss.tnc2_to_ax25(packet).endswith("caf\xe9 \u2192 ok".encode('utf-8')))
+        self.assertEqual(aprskiss.ax25_to_tnc2(aprskiss.tnc2_to_ax25(packet)), packet)
+        frame = aprskiss.tnc2_to_ax25("N0CALL>APRS:>") + b'caf\xe9 caf\xc3\xa9\x00!'
+        self.assertEqual(aprskiss.ax25_to_tnc2(frame), "N0CALL>APRS:>" + aprsdirewolf.direwolf_escape("caf<0xe9> caf\xe9<0x00>!"))
+
+    def test_back_to_back_fends(self):
+        decoder = aprskiss.KissDecoder()
+        frame = aprskiss.tnc2_to_ax25(PACKETS[0])
+        self.assertEqual(decoder.feed(bytes([aprskiss.FEND]*3) + aprskiss.kiss_frame(frame)[1:]), [(0, 0, frame)])
+
+    def test_invalid_frames(self):
+        self.assertIsNone(aprskiss.ax25_to_tnc2(b''))
+        self.assertIsNone(aprskiss.ax25_to_tnc2(aprskiss.encode_address('APRS') + aprskiss.encode_address('N0CALL'))) # No last address
+        header = aprskiss.encode_address('APRS') + aprskiss.encode_address('N0CALL', last=True)
+        self.assertIsNone(aprskiss.ax25_to_tnc2(header + bytes([0x3F, 0xF0]) + b'>x')) # Not a UI frame
+        self.assertIsNone(aprskiss.ax25_to_tnc2(aprskiss.encode_address('N0CALL', last=True) + bytes([0x03, 0xF0]))) # One address
+
+class TestKissClient(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = aprskiss.FakeKiss([(0, PACKETS[0]), (1, PACKETS[1])])
+        self.fake.start()
+        self.out = queue.Queue()
+
+    def tearDown(self):
+        self.client.stop(5)
+        self.fake.stop()
+
+    def received(self, count):
+        """returns: (receiver name, packet) for the next count packets queued"""
+        items = [self.out.get(timeout=5) for n in range(count)]
+        return [(receiver.name, packet) for (receiver, rxtime, packet) in items]
+
+    def test_backlog_and_send(self):
+        receiver = aprskiss.Receiver('rx', '127.0.0.1', self.fake.port, None, None)
+        self.client = aprskiss.KissClient('127.0.0.1', self.fake.port, [receiver], self.out)
+        self.client.start()
+        self.assertEqual(self.received(2), [('rx', PACKETS[0]), ('rx', PACKETS[1])])
+        self.fake.send(PACKETS[2], 3)
+        self.assertEqual(self.received(1), [('rx', PACKETS[2])])
+        self.assertEqual((self.client.frames, self.client.ignored, self.client.undecodable, receiver.packets), (3, 0, 0, 3))
+
+    def test_channels(self):
+        """Frames go to the receiver for their channel; channels without one are ignored"""
+        receivers = [aprskiss.Receiver('ch1', '127.0.0.1', self.fake.port, 1, None)]
+        self.client = aprskiss.KissClient('127.0.0.1', self.fake.port, receivers, self.out)
+        self.client.start()
+        self.assertEqual(self.received(1), [('ch1', PACKETS[1])])
+        self.assertTrue(wait_for(lambda: self.client.ignored == 1))
+        self.assertTrue(self.out.empty())
+
+    def test_reconnect(self):
+        receiver = aprskiss.Receiver('rx', '127.0.0.1', self.fake.port, None, None)
+        self.client = aprskiss.KissClient('127.0.0.1', self.fake.port, [receiver], self.out, retry_max_s=1)
+        self.client.start()
+        self.assertEqual(len(self.received(2)), 2)
+        self.assertTrue(wait_for(lambda: self.fake.clients != []))
+        self.fake.disconnect()
+        self.assertEqual(self.received(2), [('rx', PACKETS[0]), ('rx', PACKETS[1])]) # Backlog again on the new connection
+        self.assertEqual((self.client.connects, self.fake.connections), (2, 2))
+
+if __name__ == "__main__":
+    unittest.main()